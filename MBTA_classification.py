@@ -11,13 +11,16 @@
 # This is the classification scheme adopted by the MBTA and communicated to CTPS 
 # in the spring of 2022 by Hannah Lyons-Galante.
 #
+# The classification scheme is defined in mcfrm_schemes.py ('MBTA'); the processing is done by
+# the pipeline shared with the other scripts, in mcfrm_pipeline.py.
+#
 # This script based on the steps executed manually in the spring of 2022 to produce the requested feature class.
 # It has not been "genericized" or "parameterized", but doing this should be relativel straightforward and mostly entail
 # defining a parameter for (1) the input raster dataset, (2) the "working" geodatabase, and (3) the final output feature class.
 #
 # -- B. Krepp, 28 October 2022
 
-import arcpy
+import mcfrm_pipeline
 
 input_probability_raster = "//lilliput/groups/Certification_Activities/Resiliency/data/mcfrm/LEVEL_1/2050/North/Probability/2050_North_Probability.gdb/raster_ds_2050_North_Probability"
 
@@ -25,114 +28,18 @@ working_gdb = "//lilliput/groups/Certification_Activities/Resiliency/data/mcfrm/
 
 final_output_fc = working_gdb + 'probability_score_fc'
 
-# Load 2050 probability raster for the 'north' towns
-arcpy.MakeRasterLayer_management(in_raster=input_probability_raster, 
-                                 out_rasterlayer="2050 Probability - north towns (raster data)", 
-                                 where_clause="", envelope="221641.516430974 834092.936153378 281989.516430974 960748.936153378", band_index="")
-
-# Create >= 10% inundation probability raster
-# Cells with value >= 0.10 are into cells with value = 4, others into cells with value = -1
-output_raster = working_gdb + 'p_ge_10_pct'
-arcpy.gp.RasterCalculator_sa('Con("2050 Probability - north towns (raster data)" > 0.10, 4, -1)', output_raster)
-	
-# Create 1 to 10% inundation probability raster
-# Cells with value between 0.01 and 0.10 are mapped into cells with value = 3, others into cells with value = -1
-output_raster = working_gdb + 'p_1_10_pct'
-arcpy.gp.RasterCalculator_sa('Con(  ( "2050 Probability - north towns (raster data)" >= 0.01 )  &  
-                                    ( "2050 Probability - north towns (raster data)" < 0.10 ), 3, -1)', 
-	                         output_raster)
-    
-# Create 0.2 to 1% inundation probability raster
-# Cells with value between 0.002 and 0.01 are mapped into cells with value = 2, others into cells with value = -1
-output_raster = working_gdb + 'p_0d2_1_pct'
-arcpy.gp.RasterCalculator_sa('Con(  ( "2050 Probability - north towns (raster data)" >= 0.002 )  &  
-                                    ( "2050 Probability - north towns (raster data)" < 0.01 ), 2, -1)', 
-                             output_raster)
-    
-# Create 0.1 to 0.2% inundation probability raster
-# Cells with value between 0.001 and 0.002 are mapped into cells with value = 1, others into cells with value = -1
-output_raster = working_gdb + 'p_0d1_0d2_pct'
-arcpy.gp.RasterCalculator_sa('Con(  ( "2050 Probability - north towns (raster data)" >= 0.001 )  &  
-                                    ( "2050 Probability - north towns (raster data)" < 0.002 ), 1, -1)', 
-                             output_raster)
-    
-# Create <= 0.1% inundation probability raster
-# Cells with value less than 0.001 are mapped into cells with value = 0, others into cells with value = -1
-output_raster = working_gdb + 'p_le_0d1_pct'
-arcpy.gp.RasterCalculator_sa('Con("2050 Probability - north towns (raster data)" <= 0.001, 4, -1)'
-                             output_raster)
-    
-# Create multi-part polygon feature clases from each of the 'classified' probability rasters;
-# the features with gridcode == -1 will be filtered out subseqently
-#
-# >= 10% probability
-input_raster = working_gdb + 'p_ge_10_pct'
-output_fc = working_gdb + 'p_ge_10_pct_temp_fc'
-arcpy.RasterToPolygon_conversion(in_raster=input_raster, 
-                                 out_polygon_features=output_fc, 
-                                 simplify="SIMPLIFY", raster_field="Value", create_multipart_features="MULTIPLE_OUTER_PART", max_vertices_per_feature="")    
-
-# 1 to 10% probability
-input_raster = working_gdb + 'p_1_10_pct'
-output_fc = working_gdb + 'p_1_10_pct_temp_fc'
-arcpy.RasterToPolygon_conversion(in_raster=input_raster, 
-                                 out_polygon_features=output_fc, 
-                                 simplify="SIMPLIFY", raster_field="Value", create_multipart_features="MULTIPLE_OUTER_PART", max_vertices_per_feature="")
-    
-# 0.2 to 1% probability
-input_raster = working_gdb + 'p_0d2_1_pct'
-output_fc = working_gdb + 'p_0d2_1_pct_temp_fc'
-arcpy.RasterToPolygon_conversion(in_raster=input_raster, 
-                                 out_polygon_features=output_fc, 
-                                 simplify="SIMPLIFY", raster_field="Value", create_multipart_features="MULTIPLE_OUTER_PART", max_vertices_per_feature="")
-
-# 0.1 to 0.2% probability
-input_raster = working_gdb + 'p_0d1_0d2_pct'
-output_fc = working_gdb + 'p_0d1_0d2_pct_temp_fc'
-arcpy.RasterToPolygon_conversion(in_raster=input_raster, 
-                                 out_polygon_features=output_fc, 
-                                 simplify="SIMPLIFY", raster_field="Value", create_multipart_features="MULTIPLE_OUTER_PART", max_vertices_per_feature="")
-
-# <= 0.01% probability
-input_raster = working_gdb + 'p_le_0d1_pct'
-output_fc = working_gdb + 'p_le_0d1_pct_temp_fc'
-arcpy.RasterToPolygon_conversion(in_raster=input_raster, 
-                                 out_polygon_features=output_fc, 
-                                 simplify="SIMPLIFY", raster_field="Value", create_multipart_features="MULTIPLE_OUTER_PART", max_vertices_per_feature="")
-
-# Extract features with non-zero gridcode values to indvidual feature classes
-#
-# >= 10% probability (gridcode == 4)
-input_fc = working_gdb + 'p_ge_10_pct_temp_fc'
-output_fc = working_gdb + 'p_ge_10_pct_fc'
-arcpy.Select_analysis(in_features=input_fc, out_feature_class=output_fc, where_clause="gridcode = 4")
-
-# 1 to 10% probability (gridcode == 3)
-input_fc = working_gdb + 'p_1_10_pct_temp_fc'
-output_fc = working_gdb + 'p_1_10_pct_fc'
-arcpy.Select_analysis(in_features=input_fc, out_feature_class=output_fc, where_clause="gridcode = 3")
-    
-# 0.2 to 1% probability (gridcode == 2)
-input_fc = working_gdb + 'p_0d2_1_pct_temp_fc'
-output_fc = working_gdb + 'p_0d2_1_pct_fc'
-arcpy.Select_analysis(in_features=input_fc,  out_feature_class=output_fc, where_clause="gridcode = 2")
-    
-# 0.1 to 0.2% probability (gridcode == 1)
-input_fc = working_gdb + 'p_0d1_0d2_pct_temp_fc'
-output_fc = working_gdb + 'p_0d1_0d2_pct_fc'
-arcpy.Select_analysis(in_features=input_fc,  out_feature_class=output_fc, where_clause="gridcode = 1")
-    
-# <= 0.1% probability (gridcode == 0)
-input_fc = working_gdb + 'p_le_0d1_pct_temp_fc'
-output_fc = working_gdb + 'p_le_d0d1_pct_fc'
-arcpy.Select_analysis(in_features=input_fc, out_feature_class=output_fc, where_clause="gridcode = 0")
-
-# Merge the individual polygon feature classes into a single feature class, the final product
-# First, assemble list of input feature classes:
-inputs_list = [ working_gdb + '/p_ge_10_pct_fc',
-                working_gdb + '/p_1_10_pct_fc',
-                working_gdb + '/p_0d2_1_pct_fc',     
-                working_gdb +  '/p_0d1_0d2_pct_fc',  
-                working_gdb + '/p_le_od1_pct_fc' ]
-# Perform the merge
-arcpy.Merge_management(inputs=inputs_list, output=output_fc)
+# Set to True to also save the class raster in working_gdb, for debugging
+keep_intermediates = False
+
+# Set to a local directory to record the progress of the run there, so that a run that failed part way
+# resumes where it stopped when started again; set force_rebuild to True to start from scratch anyway
+checkpoint_dir = None
+force_rebuild = False
+
+# Classify the 2050 probability raster for the 'north' towns, and generate the final feature class.
+# The raster is streamed in 2048 x 2048 cell blocks, so only the (16-bit) class codes of the whole envelope
+# are held in memory; only the final feature class is written to working_gdb.
+mcfrm_pipeline.run_arcpy(input_probability_raster, working_gdb, {'MBTA': final_output_fc},
+                         envelope="221641.516430974 834092.936153378 281989.516430974 960748.936153378",
+                         block_shape=(2048, 2048), keep_intermediates=keep_intermediates,
+                         checkpoint_dir=checkpoint_dir, force=force_rebuild)
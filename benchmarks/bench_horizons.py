@@ -0,0 +1,119 @@
+# bench_horizons.py
+#
+# Benchmark of multi-horizon classification: one stacked pass over all the horizons (mcfrm_horizons.py)
+# against one tiled classification run per horizon.
+#
+# Four synthetic horizon rasters are derived from one synthetic probability raster (see synthetic.py),
+# with the probabilities scaled up at each later horizon, and written to temporary .npy files. The
+# separate runs are followed by the overlay they need to find where the score changes: their class
+# rasters are read back and combined into the same change-code raster as the stacked pass writes.
+# Both ways are timed, and their outputs checked to be identical.
+#
+#    python benchmarks/bench_horizons.py --size 4096 4096 --scheme CTPS
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcfrm_horizons
+import mcfrm_io
+import mcfrm_tiles
+import synthetic
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import scheme_names
+
+# Horizons, and the factor scaling the probabilities of each
+HORIZONS = (('Present', 1.0), ('2030', 1.6), ('2050', 2.5), ('2070', 4.0))
+
+
+def generate_horizons(directory, shape, seed=0, block_rows=1024):
+    """Write one synthetic probability raster per horizon. Returns [(horizon, path)]."""
+    generator = synthetic.Generator(shape, seed)
+    info = generator.info()
+    paths = [(label, os.path.join(directory, 'p_%s.npy' % label.lower())) for label, _ in HORIZONS]
+    sinks = [mcfrm_io.NpySink(path, info, np.float32) for _, path in paths]
+    try:
+        for window in synthetic._row_blocks(generator.shape, block_rows):
+            block = generator.block(window.row, window.nrows)
+            for sink, (_, factor) in zip(sinks, HORIZONS):
+                sink.write(window, np.minimum(block * np.float32(factor), np.float32(1.0)))
+    finally:
+        for sink in sinks:
+            sink.close()
+    return paths
+
+
+def class_path(directory, scheme, label):
+    return os.path.join(directory, '%s_%s.npy' % (scheme.lower(), label.lower()))
+
+
+def overlay(directory, scheme, horizons, threshold, block_shape):
+    # Change codes from the class rasters of separate runs
+    sources = [mcfrm_io.open_source(class_path(directory, scheme, label)) for label, _ in horizons]
+    info = sources[0].info
+    sink = mcfrm_io.open_sink(os.path.join(directory, scheme.lower() + '_overlay.mcr'), info, CLASS_DTYPE)
+    try:
+        for window in mcfrm_tiles.iter_windows(info.shape, block_shape):
+            scores = np.stack([source.read(window) for source in sources])
+            sink.write(window, mcfrm_horizons.first_reaching(scores, threshold))
+    finally:
+        sink.close()
+        for source in sources:
+            source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark stacked multi-horizon classification against separate runs.')
+    parser.add_argument('--size', type=int, nargs=2, default=(4096, 4096), metavar=('ROWS', 'COLS'))
+    parser.add_argument('--block-size', type=int, nargs=2, default=(1024, 1024), metavar=('ROWS', 'COLS'),
+                        help='block shape of the separate runs; the stacked pass reads as many cells per block')
+    parser.add_argument('--scheme', action='append', choices=scheme_names())
+    parser.add_argument('--threshold', type=int, default=3)
+    args = parser.parse_args(argv)
+    schemes = args.scheme or ['CTPS']
+    block_shape = tuple(args.block_size)
+
+    tmp = tempfile.mkdtemp(prefix='mcfrm_bench_')
+    try:
+        horizons = generate_horizons(tmp, tuple(args.size))
+        cells = args.size[0] * args.size[1] * len(horizons)
+
+        start = time.perf_counter()
+        for label, path in horizons:
+            outputs = dict((s, class_path(tmp, s, label)) for s in schemes)
+            mcfrm_tiles.classify_file_tiled(path, schemes, outputs, block_shape)
+        for s in schemes:
+            overlay(tmp, s, horizons, args.threshold, block_shape)
+        separate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        scores = dict((s, os.path.join(tmp, s.lower() + '_scores.npy')) for s in schemes)
+        changes = dict((s, os.path.join(tmp, s.lower() + '_first.mcr')) for s in schemes)
+        stacked_block = (max(block_shape[0] // len(horizons), 1), block_shape[1])
+        mcfrm_horizons.classify_horizons(horizons, schemes, args.threshold, scores, changes, block_shape=stacked_block)
+        stacked = time.perf_counter() - start
+
+        identical = True
+        for s in schemes:
+            stack = mcfrm_horizons.read_scores(scores[s])[0]
+            for band, (label, _) in enumerate(horizons):
+                identical &= bool(np.array_equal(stack[band], mcfrm_io.read_raster(class_path(tmp, s, label))[0]))
+            identical &= bool(np.array_equal(mcfrm_io.read_raster(changes[s])[0],
+                                             mcfrm_io.read_raster(os.path.join(tmp, s.lower() + '_overlay.mcr'))[0]))
+        print('%-10s %10s %14s' % ('', 'seconds', 'cells/s'))
+        print('%-10s %10.3f %14.0f' % ('separate', separate, cells / separate))
+        print('%-10s %10.3f %14.0f' % ('stacked', stacked, cells / stacked))
+        print('speedup %.2f, scores identical: %s' % (separate / stacked, identical))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# bench_parallel.py
+#
+# Benchmark of parallel tiled classification: cells per second against number of worker processes.
+#
+# A synthetic probability raster (see synthetic.py) is written to a temporary .npy file and classified with the
+# requested schemes using 1, 2, 4, ... worker processes (up to the number of CPUs). Each parallel
+# output is checked to be byte-identical to the serial (1 worker) output.
+#
+#    python benchmarks/bench_parallel.py --size 8192 8192 --block-size 1024 1024
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcfrm_parallel
+import synthetic
+from mcfrm_schemes import scheme_names
+
+
+def worker_counts(max_workers):
+    counts, n = [], 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark parallel tiled classification against worker count.')
+    parser.add_argument('--size', type=int, nargs=2, default=(4096, 4096), metavar=('ROWS', 'COLS'))
+    parser.add_argument('--block-size', type=int, nargs=2, default=(1024, 1024), metavar=('ROWS', 'COLS'))
+    parser.add_argument('--max-workers', type=int, default=mcfrm_parallel.default_workers())
+    parser.add_argument('--scheme', action='append', choices=scheme_names())
+    args = parser.parse_args(argv)
+    schemes = args.scheme or scheme_names()
+
+    tmp = tempfile.mkdtemp(prefix='mcfrm_bench_')
+    try:
+        input_path = os.path.join(tmp, 'probability.npy')
+        synthetic.generate(input_path, tuple(args.size))
+        cells = args.size[0] * args.size[1]
+        reference = None
+        print('%8s %10s %14s %8s %10s' % ('workers', 'seconds', 'cells/s', 'speedup', 'identical'))
+        for workers in worker_counts(args.max_workers):
+            out_dir = os.path.join(tmp, 'out_%d' % workers)
+            os.makedirs(out_dir)
+            outputs = dict((s, os.path.join(out_dir, s.lower() + '.npy')) for s in schemes)
+            start = time.perf_counter()
+            mcfrm_parallel.classify_parallel(input_path, schemes, outputs, tuple(args.block_size), workers)
+            elapsed = time.perf_counter() - start
+            results = dict((s, open(path, 'rb').read()) for s, path in outputs.items())
+            if reference is None:
+                reference, serial_elapsed = results, elapsed
+            print('%8d %10.3f %14.0f %8.2f %10s' % (workers, elapsed, cells / elapsed, serial_elapsed / elapsed,
+                                                    results == reference))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
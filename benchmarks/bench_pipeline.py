@@ -0,0 +1,189 @@
+# bench_pipeline.py
+#
+# Benchmark suite of the classification pipeline: per-stage timings of each scheme across raster sizes,
+# compared against a saved baseline.
+#
+# For each size (see synthetic.SIZES: town, city, region, north, statewide) a synthetic MC-FRM-like
+# probability raster is generated (synthetic.py; the same for a given seed on any machine), and each
+# scheme (CTPS, MBTA, BOS) is run through mcfrm_pipeline.classify_file with polygons, under an
+# mcfrm_instrument.Recorder. Each run is repeated, and the fastest wall time of each stage is kept,
+# with its CPU time, peak memory and counts (cells, features, vertices).
+#
+# The results are written as JSON to the results directory. Given a baseline (a results file saved
+# earlier with --save-baseline), every stage is compared with it: a stage is a regression if it is
+# slower by more than the tolerance (and by more than --min-seconds, so that millisecond stages do
+# not raise false alarms), or if its feature or vertex counts differ, i.e. its output changed. The
+# exit status is 1 if there are regressions, so the suite can gate a change:
+#
+#    python benchmarks/bench_pipeline.py --size town --size city --save-baseline baseline.json
+#    ... change the code ...
+#    python benchmarks/bench_pipeline.py --size town --size city --baseline baseline.json
+#
+# Everything runs headless and offline; only NumPy is required. The region size and above need
+# several GB of disk and memory; --data-dir keeps the generated rasters between runs.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcfrm_cache
+import mcfrm_pipeline
+import synthetic
+from mcfrm_instrument import Recorder
+from mcfrm_schemes import scheme_names
+
+DEFAULT_SIZES = ('town', 'city')
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# Counts that must not change between runs of the same code on the same input
+_OUTPUT_COUNTS = ('features', 'vertices')
+
+
+def _quiet(message):
+    pass
+
+
+def _git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('ascii').strip()
+
+
+def input_raster(data_dir, size, seed):
+    """Path of the synthetic raster of a size, generating it if it is not in data_dir already."""
+    path = os.path.join(data_dir, '%s-seed%d-v%d.npy' % (size, seed, synthetic.VERSION))
+    if not (os.path.exists(path) and os.path.exists(path + '.json')):
+        synthetic.generate(path, size, seed)
+    return path
+
+
+def run_case(input_path, scheme, work_dir, repeat=3, block_shape=None, workers=1):
+    """Run one scheme on one raster repeat times. Returns {stage path: measurements}, fastest run of each stage."""
+    stages = {}
+    for n in range(repeat):
+        out_dir = os.path.join(work_dir, '%s_%d' % (scheme.lower(), n))
+        recorder = Recorder()
+        with recorder.stage('total', scheme=scheme):
+            mcfrm_pipeline.classify_file(input_path, [scheme], out_dir, block_shape=block_shape, workers=workers,
+                                         polygons=True, recorder=recorder, log=_quiet)
+        shutil.rmtree(out_dir, ignore_errors=True)
+        for s in recorder.stages:
+            record = {'wall_s': round(s.wall, 6), 'cpu_s': round(s.cpu + s.child_cpu, 6),
+                      'peak_rss_bytes': s.peak_rss, 'counts': s.counts}
+            if s.path not in stages or record['wall_s'] < stages[s.path]['wall_s']:
+                stages[s.path] = record
+    return stages
+
+
+def run_suite(sizes, schemes, repeat=3, seed=0, block_shape=None, workers=1, data_dir=None, log=print):
+    """Run every scheme on the synthetic raster of every size. Returns the results as a JSON-serializable dict."""
+    tmp = tempfile.mkdtemp(prefix='mcfrm_bench_')
+    try:
+        cases = []
+        for size in sizes:
+            start = time.perf_counter()
+            input_path = input_raster(data_dir or tmp, size, seed)
+            log('%s: %d x %d cells (%.1f s to prepare)' % ((size,) + synthetic.SIZES[size]
+                                                           + (time.perf_counter() - start,)))
+            for scheme in schemes:
+                stages = run_case(input_path, scheme, tmp, repeat, block_shape, workers)
+                cases.append({'size': size, 'shape': list(synthetic.SIZES[size]), 'scheme': scheme, 'stages': stages})
+                log('  %-5s %9.3f s' % (scheme, stages['total']['wall_s']))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(),
+            'tool_version': mcfrm_cache.tool_version(), 'generator_version': synthetic.VERSION, 'seed': seed,
+            'repeat': repeat, 'block_shape': list(block_shape) if block_shape else None, 'workers': workers,
+            'python': sys.version.split()[0], 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'cases': cases}
+
+
+def _flatten(results):
+    return dict(('%s/%s/%s' % (case['size'], case['scheme'], path), stage)
+                for case in results['cases'] for path, stage in case['stages'].items())
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05):
+    """Compare results with a baseline. Returns (rows, regressions), each row being
+    (stage, baseline seconds, seconds, ratio, verdict); regressions are the rows not 'ok'.
+    """
+    current, base = _flatten(results), _flatten(baseline)
+    rows = []
+    for key in sorted(set(current) & set(base)):
+        new, old = current[key], base[key]
+        ratio = new['wall_s'] / old['wall_s'] if old['wall_s'] > 0 else float('inf')
+        changed = [c for c in _OUTPUT_COUNTS if new['counts'].get(c) != old['counts'].get(c)]
+        if changed:
+            verdict = 'OUTPUT CHANGED (%s)' % ', '.join(changed)
+        elif ratio > 1 + tolerance and new['wall_s'] - old['wall_s'] > min_seconds:
+            verdict = 'SLOWER'
+        elif ratio < 1 - tolerance and old['wall_s'] - new['wall_s'] > min_seconds:
+            verdict = 'faster'
+        else:
+            verdict = 'ok'
+        rows.append((key, old['wall_s'], new['wall_s'], ratio, verdict))
+    regressions = [row for row in rows if row[4] not in ('ok', 'faster')]
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages of each scheme on synthetic rasters.')
+    parser.add_argument('--size', action='append', choices=list(synthetic.SIZES),
+                        help='raster size (may be repeated; default: %s)' % ', '.join(DEFAULT_SIZES))
+    parser.add_argument('--scheme', action='append', choices=scheme_names(),
+                        help='scheme (may be repeated; default: all schemes)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case; the fastest of each stage is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic rasters')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        help='classify in blocks of this shape (default: whole raster)')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes classifying blocks')
+    parser.add_argument('--data-dir', help='keep the generated rasters in this directory between runs')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR, help='directory for the results')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--save-baseline', metavar='FILE', help='also save the results as a baseline to this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction by which a stage may be slower than the baseline (default: 0.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='ignore slowdowns of less than this many seconds (default: 0.05)')
+    args = parser.parse_args(argv)
+    if args.data_dir:
+        os.makedirs(args.data_dir, exist_ok=True)
+
+    results = run_suite(args.size or DEFAULT_SIZES, args.scheme or scheme_names(), args.repeat, args.seed,
+                        tuple(args.block_size) if args.block_size else None, args.workers, args.data_dir)
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, 'bench-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    for p in [path] + ([args.save_baseline] if args.save_baseline else []):
+        with open(p, 'w') as f:
+            json.dump(results, f, indent=1)
+    print('Results written to %s' % path)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('seed') != results['seed'] or baseline.get('generator_version') != results['generator_version']:
+        print('Warning: the baseline was run on different synthetic rasters (seed or generator version)')
+    rows, regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    print('%-60s %10s %10s %7s  %s' % ('stage', 'baseline', 'seconds', 'ratio', ''))
+    for key, old, new, ratio, verdict in rows:
+        print('%-60s %10.3f %10.3f %7.2f  %s' % (key, old, new, ratio, verdict))
+    print('%d regression(s) against %s' % (len(regressions), args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# synthetic.py
+#
+# Synthetic MC-FRM-like flood probability rasters, for benchmarking without the //lilliput share.
+#
+# The rasters mimic the structure of the MC-FRM probability datasets:
+#    * an irregular coastline running north-south, with the ocean to the east as NoData,
+#    * probabilities that are highest at the shore and decay inland, modulated by smooth terrain-like
+#      noise, with the decay slower along a few tidal rivers running inland,
+#    * near-zero (or zero) probabilities over most of the land, and
+#    * a few inland NoData areas outside the model domain.
+# Everything is driven by a seed and computed from the global cell coordinates, so a raster is the
+# same whatever block size it is generated with, and can be generated block by block straight into
+# a memory-mapped .npy file, at any size up to statewide.
+#
+#    python benchmarks/synthetic.py town town.npy
+
+import argparse
+import collections
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcfrm_io
+
+# Raster sizes (rows, columns), from a single town up to statewide
+SIZES = collections.OrderedDict([
+    ('town', (1024, 1024)),
+    ('city', (2048, 2048)),
+    ('region', (8192, 4096)),
+    ('north', (24576, 12288)),
+    ('statewide', (49152, 32768)),
+])
+
+# Bumped whenever the generator's output changes, so stored rasters are regenerated
+VERSION = 1
+
+# Georeferencing of the generated rasters: 5 m cells anchored near the 2050 'North' envelope
+_X_MIN, _Y_MAX, _CELL_SIZE = 221640.0, 960750.0, 5.0
+
+
+class _Noise(object):
+    # Smooth value noise: random values on a coarse lattice, interpolated bilinearly
+
+    def __init__(self, shape, scale, rng):
+        self.scale = float(scale)
+        self.lattice = rng.random((int(shape[0] / scale) + 2, int(shape[1] / scale) + 2))
+
+    def __call__(self, rows, cols):
+        r, c = rows / self.scale, cols / self.scale
+        r0, c0 = np.floor(r).astype(np.int64), np.floor(c).astype(np.int64)
+        fr, fc = r - r0, c - c0
+        g = self.lattice
+        top = g[r0, c0] * (1 - fc) + g[r0, c0 + 1] * fc
+        bottom = g[r0 + 1, c0] * (1 - fc) + g[r0 + 1, c0 + 1] * fc
+        return top * (1 - fr) + bottom * fr
+
+
+class Generator(object):
+    """Generator of one synthetic raster of the given shape."""
+
+    def __init__(self, shape, seed=0):
+        self.shape = (int(shape[0]), int(shape[1]))
+        rows, cols = self.shape
+        rng = np.random.default_rng(seed)
+        # Coastline: column of the shore at each row, 70% of the way across, wandering by up to 10%
+        self.coast_noise = _Noise((rows, 1), max(rows / 24.0, 8), rng)
+        self.coast_wobble = rng.uniform(0, 2 * np.pi, 2)
+        self.terrain = _Noise(self.shape, max(min(rows, cols) / 48.0, 4), rng)
+        self.detail = _Noise(self.shape, 6, rng)
+        # Tidal rivers: rows where they meet the coast, and how they meander inland
+        self.rivers = [(rng.uniform(0.05, 0.95) * rows, rng.uniform(0.02, 0.08) * rows, rng.uniform(1, 4))
+                       for _ in range(max(2, rows // 4096 + 2))]
+        # Inland NoData areas: ellipses (center row, center column, radii)
+        self.holes = [(rng.uniform(0, rows), rng.uniform(0, 0.6 * cols),
+                       rng.uniform(0.01, 0.05) * rows, rng.uniform(0.01, 0.05) * cols) for _ in range(3)]
+
+    def coast(self, rows):
+        _, cols = self.shape
+        phase = rows / self.shape[0] * 2 * np.pi
+        wander = (0.04 * np.sin(3 * phase + self.coast_wobble[0]) + 0.03 * np.sin(7 * phase + self.coast_wobble[1])
+                  + 0.06 * (self.coast_noise(rows, np.zeros_like(rows)) - 0.5))
+        return (0.7 + wander) * cols
+
+    def block(self, row, nrows):
+        """Probabilities of rows [row, row + nrows), as float32 with NaN for NoData."""
+        _, cols = self.shape
+        r = np.arange(row, row + nrows, dtype=np.float64)[:, None]
+        c = np.arange(cols, dtype=np.float64)[None, :]
+        rr, cc = np.broadcast_arrays(r, c)
+        inland = self.coast(r) - c                        # distance from the shore, in cells
+        decay = np.full(rr.shape, max(cols / 60.0, 8.0))
+        for river_row, meander, waves in self.rivers:
+            center = river_row + meander * np.sin(c / cols * waves * 2 * np.pi)
+            along = np.exp(-((r - center) / max(self.shape[0] / 300.0, 3)) ** 2)
+            decay = decay * (1 + 6 * along)
+        terrain = 0.4 + 1.2 * self.terrain(rr, cc)
+        p = 0.6 * np.exp(-np.maximum(inland, 0) / decay) * terrain * (0.85 + 0.3 * self.detail(rr, cc))
+        p[p < 2e-5] = 0.0
+        p = np.minimum(p, 1.0).astype(np.float32)
+        p[inland < 0] = np.nan
+        for hr, hc, ar, ac in self.holes:
+            p[((rr - hr) / ar) ** 2 + ((cc - hc) / ac) ** 2 < 1] = np.nan
+        return p
+
+    def info(self):
+        return mcfrm_io.RasterInfo(_X_MIN, _Y_MAX, _CELL_SIZE, self.shape, float('nan'), 'EPSG:26986')
+
+
+def generate(path, shape, seed=0, block_rows=1024):
+    """Write a synthetic probability raster to a .npy file, block by block. Returns its RasterInfo."""
+    if isinstance(shape, str):
+        shape = SIZES[shape]
+    generator = Generator(shape, seed)
+    info = generator.info()
+    sink = mcfrm_io.NpySink(path, info, np.float32)
+    try:
+        for window in _row_blocks(generator.shape, block_rows):
+            sink.write(window, generator.block(window.row, window.nrows))
+    finally:
+        sink.close()
+    return info
+
+
+def _row_blocks(shape, block_rows):
+    for row in range(0, shape[0], block_rows):
+        yield mcfrm_io.Window(row, 0, min(block_rows, shape[0] - row), shape[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic MC-FRM-like probability raster.')
+    parser.add_argument('size', choices=list(SIZES), help='raster size')
+    parser.add_argument('output', help='output .npy file')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    info = generate(args.output, args.size, args.seed)
+    print('Wrote %s: %d x %d cells' % (args.output, info.shape[0], info.shape[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,467 @@
+# mcfrm_backends.py
+#
+# Storage backends of the classification pipeline: where the input raster is read from, and where the
+# class rasters and the multipart polygon feature classes are written to.
+#
+# The classification and vectorization themselves are NumPy code (mcfrm_schemes.py, mcfrm_vectorize.py);
+# only the storage needs ArcGIS. mcfrm_pipeline.run() does all of its reading and writing through a
+# Backend, so the same pipeline runs
+#    * with ArcpyBackend: ArcGIS raster datasets in, feature classes in a file geodatabase out (the
+#      toolbox scripts, and final publication), on a licensed ArcGIS seat, or
+#    * with OpenBackend: .npy, GeoTIFF or .mcr rasters in and out, and polygons written to GeoPackage
+#      (with the standard library's sqlite3, see mcfrm_geopackage.py) or GeoJSON, on any machine with
+#      NumPy, e.g. Linux workers classifying many rasters in parallel. Its class rasters are .mcr files
+#      by default; GeoTIFF, in or out, also needs rasterio or GDAL.
+# Only ArcpyBackend imports arcpy, when it is first used. Tiled runs read and write their rasters
+# block by block through the backend too (open_source() and open_sink()).
+#
+# compare() runs the pipeline on one input with two backends and checks that they produce the same
+# class counts and the same geometries; run it on a reference dataset on an ArcGIS machine:
+#
+#    python mcfrm_backends.py reference.tif --scheme CTPS --backend arcpy=C:/scratch/compare.gdb --backend open=compare
+
+import argparse
+import collections
+import json
+import os
+import sys
+
+import numpy as np
+
+import mcfrm_geopackage
+import mcfrm_io
+import mcfrm_vectorize
+from mcfrm_reclassify import CLASS_DTYPE, NODATA
+from mcfrm_schemes import get_scheme, scheme_names
+
+# Extensions of the files OpenBackend reads and writes
+_RASTER_EXTENSIONS = ('.npy', '.tif', '.tiff', '.mcr')
+_FEATURE_EXTENSIONS = ('.gpkg', '.geojson')
+
+
+class Backend(object):
+    """Raster and feature storage used by the pipeline; see ArcpyBackend and OpenBackend."""
+
+    name = None
+
+    def read_raster(self, path, envelope=None):
+        """Read a probability raster. Returns (array, RasterInfo)."""
+        raise NotImplementedError
+
+    def write_raster(self, path, array, info):
+        """Write a class raster."""
+        raise NotImplementedError
+
+    def read_class_raster(self, path):
+        """Read a class raster written by write_raster() (or by a RasterSink on path). Returns (codes, RasterInfo)."""
+        raise NotImplementedError
+
+    def open_source(self, path, envelope=None):
+        """Open a RasterSource reading a probability raster block by block."""
+        raise NotImplementedError
+
+    def open_sink(self, path, info, dtype):
+        """Open a RasterSink writing a class raster block by block."""
+        raise NotImplementedError
+
+    def class_raster_path(self, workspace, name):
+        """Path of a class raster called name in a workspace."""
+        raise NotImplementedError
+
+    def feature_class_path(self, workspace, name):
+        """Path of a feature class called name in a workspace."""
+        raise NotImplementedError
+
+    def make_workspace(self, workspace):
+        """Create a workspace if the backend can (a geodatabase must already exist)."""
+
+    def features_exist(self, output):
+        raise NotImplementedError
+
+    def delete(self, path):
+        """Delete a class raster or feature class, if it exists."""
+        raise NotImplementedError
+
+    def write_features(self, output, features, field='gridcode', crs=None):
+        """Write Features to a new multipart polygon feature class with a single integer field."""
+        raise NotImplementedError
+
+    def replace_features(self, output, features, codes, field='gridcode'):
+        """Replace the features of the given codes in an existing feature class."""
+        raise NotImplementedError
+
+    def update_features(self, output, features, codes, field='gridcode', crs=None):
+        """Replace the features of the changed codes if the feature class exists, otherwise write all of them."""
+        if self.features_exist(output):
+            self.replace_features(output, features, codes, field)
+        else:
+            self.write_features(output, features, field, crs)
+
+    def read_features(self, output, field='gridcode'):
+        """Read the Features of a feature class."""
+        raise NotImplementedError
+
+    def log(self, text):
+        print(text)
+
+    def __repr__(self):
+        return '%s()' % type(self).__name__
+
+
+class ArcpyBackend(Backend):
+    """ArcGIS raster datasets and feature classes, through arcpy."""
+
+    name = 'arcpy'
+
+    def read_raster(self, path, envelope=None):
+        return mcfrm_io.read_arcpy_raster(path, envelope=envelope)
+
+    def write_raster(self, path, array, info):
+        mcfrm_io.write_arcpy_raster(path, array, info)
+
+    def read_class_raster(self, path):
+        # Class rasters come back from arcpy as floats, with NaN for NoData
+        array, info = mcfrm_io.read_arcpy_raster(path)
+        codes = np.full(array.shape, NODATA, dtype=CLASS_DTYPE)
+        valid = ~np.isnan(array)
+        codes[valid] = array[valid]
+        return codes, info.replace(nodata=NODATA)
+
+    def open_source(self, path, envelope=None):
+        return mcfrm_io.ArcpySource(path, envelope)
+
+    def open_sink(self, path, info, dtype):
+        return mcfrm_io.ArcpySink(path, info, dtype)
+
+    def class_raster_path(self, workspace, name):
+        return workspace.rstrip('/\\') + '/' + name
+
+    def feature_class_path(self, workspace, name):
+        return workspace.rstrip('/\\') + '/' + name
+
+    def features_exist(self, output):
+        import arcpy
+        return arcpy.Exists(output)
+
+    def delete(self, path):
+        import arcpy
+        if arcpy.Exists(path):
+            arcpy.Delete_management(path)
+
+    def write_features(self, output, features, field='gridcode', crs=None):
+        mcfrm_vectorize.write_arcpy_features(output, features, field, crs)
+
+    def replace_features(self, output, features, codes, field='gridcode'):
+        mcfrm_vectorize.update_arcpy_features(output, features, codes, field)
+
+    def read_features(self, output, field='gridcode'):
+        import arcpy
+        features = []
+        with arcpy.da.SearchCursor(output, ['SHAPE@', field]) as cursor:
+            for shape, code in cursor:
+                parts = []
+                for part in shape or []:
+                    rings, ring = [], []
+                    for point in part:
+                        if point is None:           # separates the rings of a part
+                            rings.append(np.array(ring))
+                            ring = []
+                        else:
+                            ring.append((point.X, point.Y))
+                    if ring:
+                        rings.append(np.array(ring))
+                    parts.append(rings)
+                features.append(mcfrm_vectorize.Feature(code, parts))
+        return features
+
+    def log(self, text):
+        try:
+            import arcpy
+        except ImportError:
+            print(text)
+        else:
+            arcpy.AddMessage(text)
+
+
+class OpenBackend(Backend):
+    """.npy, GeoTIFF and .mcr rasters, and GeoPackage or GeoJSON polygons; needs only NumPy (but for GeoTIFF).
+
+    raster_extension  - file type of the class rasters written to a workspace (see class_raster_path);
+                        '.tif' needs rasterio or GDAL
+    feature_extension - file type of the feature classes written to a workspace: '.gpkg' or '.geojson'
+    """
+
+    name = 'open'
+
+    def __init__(self, raster_extension='.mcr', feature_extension='.gpkg'):
+        if raster_extension not in _RASTER_EXTENSIONS:
+            raise ValueError('raster_extension must be one of %s, got %r' % (', '.join(_RASTER_EXTENSIONS),
+                                                                              raster_extension))
+        if feature_extension not in _FEATURE_EXTENSIONS:
+            raise ValueError('feature_extension must be one of %s, got %r' % (', '.join(_FEATURE_EXTENSIONS),
+                                                                               feature_extension))
+        self.raster_extension = raster_extension
+        self.feature_extension = feature_extension
+
+    def read_raster(self, path, envelope=None):
+        if envelope:
+            raise ValueError('An envelope can only be given for ArcGIS raster datasets')
+        return mcfrm_io.read_raster(path)
+
+    def write_raster(self, path, array, info):
+        _make_parent(path)
+        mcfrm_io.write_raster(path, array, info)
+
+    def read_class_raster(self, path):
+        return mcfrm_io.read_raster(path)
+
+    def open_source(self, path, envelope=None):
+        _check_raster_file(path)
+        return mcfrm_io.open_source(path, envelope)
+
+    def open_sink(self, path, info, dtype):
+        _check_raster_file(path)
+        _make_parent(path)
+        return mcfrm_io.open_sink(path, info, dtype)
+
+    def class_raster_path(self, workspace, name):
+        return os.path.join(workspace, name + self.raster_extension)
+
+    def feature_class_path(self, workspace, name):
+        return os.path.join(workspace, name + self.feature_extension)
+
+    def make_workspace(self, workspace):
+        os.makedirs(workspace, exist_ok=True)
+
+    def features_exist(self, output):
+        if mcfrm_geopackage.is_geopackage(output):
+            return mcfrm_geopackage.exists(output)
+        return os.path.exists(output)
+
+    def delete(self, path):
+        if mcfrm_geopackage.is_geopackage(path):
+            mcfrm_geopackage.delete_layer(path)
+            return
+        for name in (path, path + '.json'):
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def write_features(self, output, features, field='gridcode', crs=None):
+        if mcfrm_geopackage.is_geopackage(output):
+            _make_parent(mcfrm_geopackage.split_path(output)[0])
+            mcfrm_geopackage.write_features(output, features, field, crs)
+        else:
+            _make_parent(output)
+            mcfrm_vectorize.write_geojson(output, features, field, crs)
+
+    def replace_features(self, output, features, codes, field='gridcode'):
+        if mcfrm_geopackage.is_geopackage(output):
+            mcfrm_geopackage.update_features(output, features, codes, field)
+            return
+        codes = set(codes)
+        existing, crs = read_geojson(output, field)
+        kept = [f for f in existing if f.gridcode not in codes]
+        added = [f for f in features if f.gridcode in codes]
+        mcfrm_vectorize.write_geojson(output, sorted(kept + added, key=lambda f: f.gridcode), field, crs)
+
+    def read_features(self, output, field='gridcode'):
+        if mcfrm_geopackage.is_geopackage(output):
+            return mcfrm_geopackage.read_features(output, field)[0]
+        return read_geojson(output, field)[0]
+
+    def __repr__(self):
+        return 'OpenBackend(%r, %r)' % (self.raster_extension, self.feature_extension)
+
+
+def _check_raster_file(path):
+    # mcfrm_io falls back to arcpy for paths that are not raster files
+    if os.path.splitext(path)[1].lower() not in _RASTER_EXTENSIONS:
+        raise ValueError('Not a .npy, GeoTIFF or .mcr raster: ' + path)
+
+
+def _make_parent(path):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+
+
+def read_geojson(path, field='gridcode'):
+    """Read the Features of a GeoJSON file written by mcfrm_vectorize.write_geojson(). Returns (Features, CRS)."""
+    with open(path) as f:
+        data = json.load(f)
+    features = []
+    for feature in data.get('features', []):
+        geometry = feature.get('geometry') or {}
+        coordinates = geometry.get('coordinates', [])
+        if geometry.get('type') == 'Polygon':
+            coordinates = [coordinates]
+        parts = [[np.asarray(ring, dtype=np.float64)[::-1, :2] for ring in part] for part in coordinates]
+        features.append(mcfrm_vectorize.Feature(feature['properties'][field], parts))
+    crs = (data.get('crs') or {}).get('properties', {}).get('name')
+    return features, crs
+
+
+def is_file_output(path):
+    """Whether an output path names a file OpenBackend writes, rather than an ArcGIS dataset."""
+    return (os.path.splitext(path)[1].lower() in _RASTER_EXTENSIONS + ('.geojson',)
+            or mcfrm_geopackage.is_geopackage(path))
+
+
+def backend_for(path):
+    """The backend writing an output: OpenBackend for files it handles, otherwise ArcpyBackend."""
+    return OpenBackend() if is_file_output(path) else ArcpyBackend()
+
+
+def get_backend(name, **options):
+    """Backend by name: 'arcpy' or 'open' (options are passed to OpenBackend)."""
+    if name == ArcpyBackend.name:
+        return ArcpyBackend()
+    if name == OpenBackend.name:
+        return OpenBackend(**options)
+    raise ValueError('Unknown backend %r; expected arcpy or open' % name)
+
+
+#####################
+# Equivalence of backends
+
+def class_counts(codes):
+    """{class code: number of cells} of a class raster."""
+    values, counts = np.unique(codes, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def _area(ring):
+    x, y = ring[:, 0], ring[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y)) / 2.0
+
+
+def _normalized_ring(ring):
+    # Ring without its closing vertex, clockwise, starting at its lowest (x, y) vertex
+    ring = np.asarray(ring, dtype=np.float64)
+    if len(ring) > 1 and np.array_equal(ring[0], ring[-1]):
+        ring = ring[:-1]
+    x, y = ring[:, 0], ring[:, 1]
+    if np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y) > 0:
+        ring = ring[::-1]
+    start = int(np.lexsort((ring[:, 1], ring[:, 0]))[0])
+    return np.concatenate([ring[start:], ring[:start]])
+
+
+def _rings_by_code(features, tolerance):
+    # {code: normalized rings of all the features of the code, in a canonical order}
+    rings = collections.defaultdict(list)
+    for f in features:
+        rings[f.gridcode].extend(_normalized_ring(ring) for part in f.parts for ring in part)
+    grid = tolerance * 10
+    for code in rings:
+        rings[code].sort(key=lambda r: (len(r),) + tuple(np.round(r[:4].ravel() / grid).tolist()))
+    return rings
+
+
+def compare_features(reference, other, tolerance=1e-3):
+    """Differences between two lists of Features, compared class by class.
+
+    Rings are compared irrespective of their orientation, starting vertex, order and grouping into
+    parts and features; vertices match if they are within tolerance (map units) of each other.
+    Returns a list of messages, empty if the geometries are equivalent.
+    """
+    differences = []
+    a, b = _rings_by_code(reference, tolerance), _rings_by_code(other, tolerance)
+    for code in sorted(set(a) | set(b)):
+        ra, rb = a.get(code, []), b.get(code, [])
+        if len(ra) != len(rb):
+            differences.append('class %s: %d rings against %d' % (code, len(ra), len(rb)))
+            continue
+        area_a, area_b = sum(_area(r) for r in ra), sum(_area(r) for r in rb)
+        mismatched = sum(1 for p, q in zip(ra, rb) if p.shape != q.shape or not np.allclose(p, q, rtol=0, atol=tolerance))
+        if mismatched:
+            differences.append('class %s: %d of %d rings differ (areas %.3f and %.3f)'
+                               % (code, mismatched, len(ra), area_a, area_b))
+    return differences
+
+
+def compare_class_rasters(reference, other):
+    """Differences between two class rasters (arrays): their shapes, class counts and differing cells."""
+    if reference.shape != other.shape:
+        return ['shapes %s and %s' % (reference.shape, other.shape)]
+    differences = []
+    a, b = class_counts(reference), class_counts(other)
+    for code in sorted(set(a) | set(b)):
+        if a.get(code, 0) != b.get(code, 0):
+            differences.append('class %s: %d cells against %d' % (code, a.get(code, 0), b.get(code, 0)))
+    cells = int(np.count_nonzero(reference != other))
+    if cells:
+        differences.append('%d cells differ' % cells)
+    return differences
+
+
+def compare(input_raster, schemes, reference, other, reference_workspace, other_workspace, envelope=None,
+            block_shape=None, tolerance=1e-3, log=print):
+    """Run the pipeline on one input with two backends, and compare the class rasters and polygons.
+
+    reference, other - Backends; each writes its class rasters ("<scheme>_classes") and feature
+                       classes ("<scheme>_polygons") to its workspace
+    Returns {scheme name: {'counts': {code: cells}, 'differences': [messages]}}; the backends are
+    equivalent on this input when every list of differences is empty.
+    """
+    import mcfrm_pipeline
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    names = [get_scheme(s).name for s in schemes]
+    results = {}
+    for backend, workspace in ((reference, reference_workspace), (other, other_workspace)):
+        outputs = dict((name, backend.feature_class_path(workspace, name.lower() + '_polygons')) for name in names)
+        mcfrm_pipeline.run(input_raster, outputs, backend=backend, workspace=workspace, envelope=envelope,
+                           block_shape=block_shape, keep_intermediates=True, log=log)
+        for name in names:
+            classes = backend.read_class_raster(backend.class_raster_path(workspace, name.lower() + '_classes'))[0]
+            field = get_scheme(name).score_field or 'gridcode'
+            results.setdefault(name, []).append((classes, backend.read_features(outputs[name], field)))
+    report = {}
+    for name in names:
+        (classes_a, features_a), (classes_b, features_b) = results[name]
+        differences = compare_class_rasters(classes_a, classes_b)
+        differences += compare_features(features_a, features_b, tolerance)
+        report[name] = {'counts': class_counts(classes_a), 'differences': differences}
+    return report
+
+
+def _backend_arg(text):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError('expected BACKEND=WORKSPACE, got %r' % text)
+    return tuple(text.split('=', 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that two pipeline backends give equivalent results on an input.')
+    parser.add_argument('input', help='reference probability raster, readable by both backends (e.g. GeoTIFF)')
+    parser.add_argument('--scheme', action='append', choices=scheme_names(),
+                        help='classification scheme (may be repeated; default: all schemes)')
+    parser.add_argument('--backend', type=_backend_arg, action='append', required=True, metavar='BACKEND=WORKSPACE',
+                        help='backend (arcpy or open) and the workspace it writes to: a file geodatabase for arcpy, '
+                             'a directory for open; give two, the reference first')
+    parser.add_argument('--raster-format', choices=['npy', 'tif', 'mcr'], default='mcr',
+                        help='file type of the class rasters of the open backend (default: mcr; tif needs rasterio '
+                             'or GDAL)')
+    parser.add_argument('--envelope', help='"x_min y_min x_max y_max" limiting the area processed (arcpy only)')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'))
+    parser.add_argument('--tolerance', type=float, default=1e-3,
+                        help='distance in map units within which vertices match (default: 0.001)')
+    args = parser.parse_args(argv)
+    if len(args.backend) != 2:
+        parser.error('give --backend twice: the reference backend, then the one to compare with it')
+    backends = [get_backend(name, **({'raster_extension': '.' + args.raster_format} if name == 'open' else {}))
+                for name, _ in args.backend]
+    report = compare(args.input, args.scheme or scheme_names(), backends[0], backends[1], args.backend[0][1],
+                     args.backend[1][1], args.envelope, tuple(args.block_size) if args.block_size else None,
+                     args.tolerance)
+    for name, result in sorted(report.items()):
+        counts = ', '.join('%s: %d' % item for item in sorted(result['counts'].items()))
+        print('%s: %s (%s)' % (name, 'equivalent' if not result['differences'] else 'DIFFERENT', counts))
+        for message in result['differences']:
+            print('  ' + message)
+    return 1 if any(result['differences'] for result in report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# mcfrm_batch.py
+#
+# Batch driver: runs a manifest of (input raster, scheme, output) jobs in one go, e.g. the whole
+# matrix of horizons (Present, 2030, 2050, 2070) x regions (North, South) x schemes.
+#
+# The manifest is a CSV file with the columns "input", "scheme", "output" and optionally "envelope",
+# or a JSON file holding a list of objects with the same keys. Relative paths are taken relative to
+# the manifest. The kind of output is given by its extension:
+#    * .npy, .tif, .tiff, .mcr - the class raster
+#    * .geojson                - the multipart polygons, as GeoJSON
+#    * .gpkg (or .gpkg/<layer>) - the multipart polygons, as a GeoPackage layer
+#    * anything else           - the multipart polygons, as an ArcGIS feature class (arcpy required)
+#
+# Jobs on the same input (and envelope) form a group: the input is opened and read once, and
+# classified with all of the group's schemes together (see mcfrm_schemes.classify). Groups run
+# concurrently in worker processes, as many at a time as fit in the memory budget, using a rough
+# estimate of each group's peak memory; a group larger than the budget runs on its own.
+#
+# A failing job (or group, if its input cannot be read) is reported and the batch carries on with
+# the rest. Every job's timing is reported - the classification of its group, which its jobs share,
+# and the writing of its own output - and can be saved as a JSON report:
+#
+#    python mcfrm_batch.py jobs.csv --workers 4 --memory-budget 24 --report batch_report.json
+
+import argparse
+import collections
+import concurrent.futures
+import csv
+import json
+import os
+import sys
+import time
+
+import mcfrm_backends
+import mcfrm_cache
+import mcfrm_geopackage
+import mcfrm_io
+import mcfrm_tiles
+import mcfrm_vectorize
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import classify, get_scheme
+
+# Rough peak memory per cell: the float64 input, the int16 class codes of each scheme, and the
+# working storage of vectorizing one scheme (edges, rings and vertices)
+_INPUT_BYTES_PER_CELL = 8
+_CLASS_BYTES_PER_CELL = 2
+_VECTORIZE_BYTES_PER_CELL = 16
+
+
+class Job(object):
+    """One manifest entry: classify input with scheme, and write output."""
+
+    def __init__(self, input, scheme, output, envelope=None):
+        self.input = input
+        # An unknown scheme fails this job when the batch is run, not the whole manifest
+        try:
+            self.scheme = get_scheme(scheme).name
+            self.error = None
+        except KeyError:
+            self.scheme = scheme
+            self.error = _error()
+        self.output = output
+        self.envelope = envelope or None
+
+    def kind(self):
+        ext = os.path.splitext(self.output)[1].lower()
+        if ext in ('.npy', '.tif', '.tiff', '.mcr'):
+            return 'raster'
+        if ext == '.geojson':
+            return 'geojson'
+        if mcfrm_geopackage.is_geopackage(self.output):
+            return 'geopackage'
+        return 'feature class'
+
+    def to_dict(self):
+        return {'input': self.input, 'scheme': self.scheme, 'output': self.output, 'envelope': self.envelope}
+
+    def __repr__(self):
+        return 'Job(%r, %r, %r)' % (self.input, self.scheme, self.output)
+
+
+def read_manifest(path):
+    """Read the jobs of a CSV or JSON manifest."""
+    base = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows['jobs']
+    else:
+        with open(path, newline='') as f:
+            rows = [row for row in csv.DictReader(f) if any((v or '').strip() for v in row.values())]
+    jobs = []
+    for n, row in enumerate(rows):
+        try:
+            jobs.append(Job(_resolve(base, row['input'].strip()), row['scheme'].strip(),
+                            _resolve(base, row['output'].strip()), (row.get('envelope') or '').strip()))
+        except (KeyError, ValueError) as e:
+            raise ValueError('Manifest %s, job %d: %s' % (path, n + 1, e))
+    return jobs
+
+
+def _resolve(base, path):
+    # Relative file paths are taken relative to the manifest; UNC paths are left alone
+    if path.startswith('//') or path.startswith('\\\\') or os.path.isabs(path):
+        return path
+    return os.path.join(base, path)
+
+
+def group_jobs(jobs):
+    """Group jobs by (input, envelope), in manifest order. Returns an OrderedDict of lists of jobs."""
+    groups = collections.OrderedDict()
+    for job in jobs:
+        groups.setdefault((job.input, job.envelope), []).append(job)
+    return groups
+
+
+def estimate_memory(shape, n_schemes, block_shape=None):
+    """Rough peak memory, in bytes, of classifying a raster of the given shape with n_schemes schemes."""
+    cells = shape[0] * shape[1]
+    if block_shape is not None:
+        input_cells = min(cells, block_shape[0] * block_shape[1])
+    else:
+        input_cells = cells
+    return (input_cells * _INPUT_BYTES_PER_CELL + cells * n_schemes * _CLASS_BYTES_PER_CELL
+            + cells * _VECTORIZE_BYTES_PER_CELL)
+
+
+def _result(job, status, classify_seconds=0.0, seconds=0.0, error=None):
+    result = job.to_dict()
+    result.update({'status': status, 'classify_seconds': round(classify_seconds, 3),
+                   'output_seconds': round(seconds, 3), 'error': error})
+    return result
+
+
+def _error():
+    kind, value = sys.exc_info()[:2]
+    return '%s: %s' % (kind.__name__, value)
+
+
+def run_group(jobs, block_shape=None, cache_dir=None):
+    """Run the jobs of one group (same input and envelope). Returns a list of result dicts.
+
+    The input is read once and classified with all of the group's schemes; class rasters and
+    polygons are taken from, and stored in, the cache in cache_dir if one is given.
+    """
+    input_path, envelope = jobs[0].input, jobs[0].envelope
+    schemes = list(collections.OrderedDict((job.scheme, None) for job in jobs))
+    cache = mcfrm_cache.Cache(cache_dir) if cache_dir else None
+    start = time.time()
+    classes = {}
+    keys = {}
+    try:
+        with mcfrm_io.open_source(input_path, envelope) as source:
+            info = source.info
+            if cache is not None:
+                keys = dict((name, cache.key(input_path, name, envelope)) for name in schemes)
+            todo = [name for name in schemes if cache is None or not cache.has(keys[name], mcfrm_cache.CLASSES)]
+            if todo and block_shape is not None:
+                sinks = dict((name, mcfrm_io.ArraySink(source.shape, CLASS_DTYPE)) for name in todo)
+                mcfrm_tiles.classify_tiled(source, sinks, block_shape)
+                classes = dict((name, sink.array) for name, sink in sinks.items())
+            elif todo:
+                classes = classify(source.read(), todo, nodata=info.nodata)
+        for name in todo:
+            if cache is not None:
+                cache.put_classes(keys[name], classes[name], info.replace(nodata=get_scheme(name).nodata), name)
+    except Exception:
+        error = _error()
+        return [_result(job, 'failed', time.time() - start, error=error) for job in jobs]
+    classify_seconds = time.time() - start
+
+    features = {}
+
+    def class_raster(name):
+        if name in classes:
+            return classes[name], info.replace(nodata=get_scheme(name).nodata)
+        return cache.get_classes(keys[name])
+
+    def polygons(name):
+        if name not in features:
+            hit = cache.get_features(keys[name]) if cache is not None else None
+            if hit is None:
+                scheme = get_scheme(name)
+                array, class_info = class_raster(name)
+                hit = mcfrm_vectorize.vectorize(array, class_info, skip=(scheme.background, scheme.nodata)), class_info
+                if cache is not None:
+                    cache.put_features(keys[name], hit[0], hit[1], name)
+            features[name] = hit
+        return features[name]
+
+    results = []
+    for job in jobs:
+        start = time.time()
+        try:
+            scheme = get_scheme(job.scheme)
+            field = scheme.score_field or 'gridcode'
+            backend = mcfrm_backends.backend_for(job.output)
+            if job.kind() == 'raster':
+                backend.write_raster(job.output, *class_raster(job.scheme))
+            else:
+                fs, class_info = polygons(job.scheme)
+                backend.write_features(job.output, fs, field, class_info.crs)
+        except Exception:
+            results.append(_result(job, 'failed', classify_seconds, time.time() - start, _error()))
+        else:
+            results.append(_result(job, 'ok', classify_seconds, time.time() - start))
+    return results
+
+
+def _group_memory(jobs, block_shape):
+    try:
+        with mcfrm_io.open_source(jobs[0].input, jobs[0].envelope) as source:
+            shape = source.shape
+    except Exception:
+        return 0     # the group will fail, and report why, when it is run
+    return estimate_memory(shape, len(set(job.scheme for job in jobs)), block_shape)
+
+
+def run_batch(jobs, workers=1, memory_budget=None, block_shape=None, cache_dir=None, log=print):
+    """Run a list of Jobs, continuing past failures. Returns the result dicts, in job order.
+
+    workers       - maximum number of groups run at once in worker processes; 1 runs them in turn
+    memory_budget - bytes; groups are started only while their estimated memory fits (default: no limit)
+    """
+    groups = list(group_jobs([job for job in jobs if job.error is None]).values())
+    results = {}
+
+    def report(group_results):
+        for r in group_results:
+            log('%-6s %8.2f s + %8.2f s  %s  %s -> %s%s' % (r['status'], r['classify_seconds'], r['output_seconds'],
+                                                          r['scheme'], r['input'], r['output'],
+                                                          '  (%s)' % r['error'] if r['error'] else ''))
+
+    invalid = [_result(job, 'failed', error=job.error) for job in jobs if job.error is not None]
+    results.update(zip((id(job) for job in jobs if job.error is not None), invalid))
+    report(invalid)
+
+    if workers <= 1:
+        for group in groups:
+            group_results = run_group(group, block_shape, cache_dir)
+            results.update(zip(map(id, group), group_results))
+            report(group_results)
+    else:
+        pending = [(group, _group_memory(group, block_shape)) for group in groups]
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                in_use = sum(memory for group, memory in running.values())
+                for item in list(pending):
+                    if len(running) >= workers:
+                        break
+                    group, memory = item
+                    if running and memory_budget is not None and in_use + memory > memory_budget:
+                        continue
+                    running[executor.submit(run_group, group, block_shape, cache_dir)] = item
+                    pending.remove(item)
+                    in_use += memory
+                done, _ = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    group, memory = running.pop(future)
+                    try:
+                        group_results = future.result()
+                    except Exception:
+                        error = _error()
+                        group_results = [_result(job, 'failed', error=error) for job in group]
+                    results.update(zip(map(id, group), group_results))
+                    report(group_results)
+    return [results[id(job)] for job in jobs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a manifest of MC-FRM classification jobs.')
+    parser.add_argument('manifest', help='CSV or JSON manifest of jobs (input, scheme, output[, envelope])')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of inputs processed at once in worker processes (0: one per CPU)')
+    parser.add_argument('--memory-budget', type=float, metavar='GB',
+                        help='start inputs only while their estimated memory use fits in this many GB')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        help='read and classify each input in blocks of this shape')
+    parser.add_argument('--cache', nargs='?', const=mcfrm_cache.DEFAULT_DIRECTORY, metavar='DIR',
+                        help='reuse class rasters and polygons cached for these inputs')
+    parser.add_argument('--report', help='write the per-job results and timings to this JSON file')
+    args = parser.parse_args(argv)
+    jobs = read_manifest(args.manifest)
+    start = time.time()
+    results = run_batch(jobs, args.workers or os.cpu_count() or 1,
+                        args.memory_budget * 2 ** 30 if args.memory_budget else None,
+                        tuple(args.block_size) if args.block_size else None, args.cache)
+    failed = sum(r['status'] != 'ok' for r in results)
+    print('%d of %d jobs succeeded in %.2f s' % (len(results) - failed, len(results), time.time() - start))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'seconds': round(time.time() - start, 3), 'jobs': results}, f, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,291 @@
+# mcfrm_cache.py
+#
+# Content-addressed cache of class rasters and vectorized features.
+#
+# The same schemes are run against the same MC-FRM probability rasters many times. The cache sits in
+# front of the classification and vectorization stages of mcfrm_pipeline.py: each result is stored
+# under a key that hashes
+#    * the input raster: its bytes (by='content') or its size and modification time (by='metadata'),
+#      plus the envelope processed, if any,
+#    * the definition of the scheme (bounds, codes, background, NoData, score field), and
+#    * the tool version: a hash of the source of the modules that compute the results,
+# so an unchanged input returns the stored result immediately, and any change to the input, the
+# scheme or the code yields a new key. ArcGIS raster datasets have no single file to hash; their
+# key is built from the metadata of every file of the geodatabase (or directory) holding them.
+#
+# Each entry is a directory "<key>-<stage>" holding the result (class rasters are stored as compact
+# .mcr files, see mcfrm_compact.py) and an entry.json record. Entries are evicted least-recently-used
+# first whenever the cache grows past max_bytes; a hit refreshes the entry's access time. Entries are
+# written to a temporary directory and renamed into place, so concurrent runs never see a partial entry.
+#
+# The cache can be inspected and cleared from the command line:
+#
+#    python mcfrm_cache.py info
+#    python mcfrm_cache.py clear
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import mcfrm_io
+import mcfrm_vectorize
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import get_scheme
+
+# Default cache directory and size limit
+DEFAULT_DIRECTORY = os.environ.get('MCFRM_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'mcfrm')
+DEFAULT_MAX_BYTES = 8 * 2 ** 30
+
+# Stages whose results are cached
+CLASSES = 'classes'
+FEATURES = 'features'
+
+# Modules whose source determines the results; any edit to them invalidates the cache
+_TOOL_MODULES = ('mcfrm_reclassify.py', 'mcfrm_schemes.py', 'mcfrm_vectorize.py', 'mcfrm_io.py', 'mcfrm_compact.py')
+
+_CHUNK = 8 * 2 ** 20
+
+
+def tool_version():
+    """Hash of the source of the modules computing the cached results."""
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in _TOOL_MODULES:
+        with open(os.path.join(here, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def scheme_definition(scheme):
+    """JSON-serializable definition of a scheme: everything that determines its class rasters."""
+    scheme = get_scheme(scheme)
+    return {'name': scheme.name, 'score_field': scheme.score_field, 'background': scheme.background,
+            'nodata': scheme.nodata, 'classes': [[c.code, str(c.bounds)] for c in scheme.classes]}
+
+
+def _hash_file(digest, path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(_CHUNK)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+
+def _input_files(path):
+    # Files making up an input raster: the file itself (plus a .npy sidecar), or for an ArcGIS
+    # raster dataset every file of its geodatabase or directory
+    if os.path.isfile(path):
+        return [path] + [p for p in [path + '.json'] if os.path.exists(p)]
+    container = path
+    while container and not os.path.isdir(container):
+        container = os.path.dirname(container.rstrip('/\\'))
+    if not container:
+        raise ValueError('Input raster not found: ' + path)
+    files = []
+    for root, dirs, names in os.walk(container):
+        dirs.sort()
+        files.extend(os.path.join(root, name) for name in sorted(names) if not name.endswith('.lock'))
+    return files
+
+
+def input_key(path, envelope=None, by='content'):
+    """Hash identifying an input raster.
+
+    by - 'content' hashes the bytes of the input file; 'metadata' only its size and modification
+         time. ArcGIS raster datasets are always identified by metadata.
+    """
+    if by not in ('content', 'metadata'):
+        raise ValueError("by must be 'content' or 'metadata', got %r" % by)
+    digest = hashlib.sha256()
+    files = _input_files(path)
+    content = by == 'content' and os.path.isfile(path)
+    for name in files:
+        digest.update(os.path.relpath(name, os.path.dirname(files[0])).encode('utf-8'))
+        if content:
+            _hash_file(digest, name)
+        else:
+            st = os.stat(name)
+            digest.update(('%d %d' % (st.st_size, st.st_mtime_ns)).encode('ascii'))
+    digest.update(repr(envelope).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class Cache(object):
+    """Cache of class rasters and features in a directory, with LRU eviction beyond max_bytes.
+
+    by - how inputs are identified: 'content' (hash of the file bytes) or 'metadata'
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES, by='content'):
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.max_bytes = max_bytes
+        self.by = by
+        self._input_keys = {}
+
+    def key(self, input_path, scheme, envelope=None):
+        """Cache key of the results of classifying an input raster with a scheme."""
+        ident = (os.path.abspath(input_path) if os.path.exists(input_path) else input_path, envelope)
+        if ident not in self._input_keys:
+            self._input_keys[ident] = input_key(input_path, envelope, self.by)
+        spec = {'input': self._input_keys[ident], 'scheme': scheme_definition(scheme), 'tool': tool_version()}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def variant(self, key, **options):
+        """Key of results that also depend on options (such as polygon simplification), derived from a key.
+
+        Options that are None or 0 are left out, so that the defaults give the key itself.
+        """
+        options = dict((name, value) for name, value in options.items() if value)
+        if not options:
+            return key
+        spec = {'key': key, 'options': options}
+        return hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def _entry(self, key, stage):
+        return os.path.join(self.directory, '%s-%s' % (key, stage))
+
+    def has(self, key, stage):
+        """Whether a result of the given stage (CLASSES or FEATURES) is cached under a key."""
+        return os.path.exists(os.path.join(self._entry(key, stage), 'entry.json'))
+
+    def _hit(self, key, stage):
+        entry = self._entry(key, stage)
+        record = os.path.join(entry, 'entry.json')
+        if not os.path.exists(record):
+            return None
+        try:
+            os.utime(record, None)
+        except OSError:
+            return None
+        return entry
+
+    def get_classes(self, key):
+        """Return the cached (class raster, RasterInfo) for a key, or None."""
+        entry = self._hit(key, CLASSES)
+        if entry is None:
+            return None
+        path = os.path.join(entry, 'classes.mcr')
+        if not os.path.exists(path):
+            path = os.path.join(entry, 'classes.npy')     # entries written before class rasters were compacted
+        return mcfrm_io.read_raster(path, mmap=True)
+
+    def put_classes(self, key, array, info, description=''):
+        """Store a class raster under a key."""
+        def save(tmp):
+            mcfrm_io.write_raster(os.path.join(tmp, 'classes.mcr'), array.astype(CLASS_DTYPE, copy=False), info)
+        self._put(key, CLASSES, save, description)
+
+    def get_features(self, key):
+        """Return the cached (list of Features, RasterInfo of the class raster) for a key, or None."""
+        entry = self._hit(key, FEATURES)
+        if entry is None:
+            return None
+        with open(os.path.join(entry, 'info.json')) as f:
+            info = mcfrm_io.RasterInfo.from_dict(json.load(f))
+        return mcfrm_vectorize.load_features(os.path.join(entry, 'features.npz')), info
+
+    def put_features(self, key, features, info, description=''):
+        """Store the Features vectorized from a class raster under a key."""
+        def save(tmp):
+            mcfrm_vectorize.save_features(os.path.join(tmp, 'features.npz'), features)
+            with open(os.path.join(tmp, 'info.json'), 'w') as f:
+                json.dump(info.to_dict(), f, indent=1)
+        self._put(key, FEATURES, save, description)
+
+    def _put(self, key, stage, save, description):
+        entry = self._entry(key, stage)
+        tmp = '%s.tmp-%d' % (entry, os.getpid())
+        os.makedirs(tmp)
+        try:
+            save(tmp)
+            size = sum(os.path.getsize(os.path.join(tmp, name)) for name in os.listdir(tmp))
+            with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+                json.dump({'key': key, 'stage': stage, 'description': description, 'size': size,
+                           'created': time.time()}, f, indent=1)
+            if os.path.exists(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict()
+
+    def entries(self):
+        """List the entries of the cache, most recently used first, as dicts (see entry.json)."""
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            record = os.path.join(self.directory, name, 'entry.json')
+            if '.tmp-' in name or not os.path.exists(record):
+                continue
+            try:
+                with open(record) as f:
+                    entry = json.load(f)
+                entry['accessed'] = os.path.getmtime(record)
+            except (OSError, ValueError):
+                continue
+            entry['path'] = os.path.join(self.directory, name)
+            entries.append(entry)
+        entries.sort(key=lambda e: e['accessed'], reverse=True)
+        return entries
+
+    def size(self):
+        return sum(e['size'] for e in self.entries())
+
+    def evict(self, max_bytes=None):
+        """Remove least-recently-used entries until the cache holds at most max_bytes.
+
+        Returns the number of entries removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(e['size'] for e in entries)
+        removed = 0
+        while entries and total > max_bytes:
+            entry = entries.pop()
+            shutil.rmtree(entry['path'], ignore_errors=True)
+            total -= entry['size']
+            removed += 1
+        return removed
+
+    def clear(self):
+        """Remove every entry. Returns the number of entries removed."""
+        return self.evict(0)
+
+
+def _format_size(n):
+    if n < 1024:
+        return '%d B' % n
+    for unit in ('KB', 'MB', 'GB'):
+        n /= 1024.0
+        if n < 1024 or unit == 'GB':
+            return '%.1f %s' % (n, unit)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or clear the MC-FRM classification cache.')
+    parser.add_argument('command', choices=['info', 'clear'])
+    parser.add_argument('--cache-dir', default=None, help='cache directory (default: %s)' % DEFAULT_DIRECTORY)
+    args = parser.parse_args(argv)
+    cache = Cache(args.cache_dir)
+    if args.command == 'clear':
+        print('Removed %d entries from %s' % (cache.clear(), cache.directory))
+        return 0
+    entries = cache.entries()
+    print('%s: %d entries, %s (limit %s)' % (cache.directory, len(entries), _format_size(sum(e['size'] for e in entries)),
+                                             _format_size(cache.max_bytes)))
+    for e in entries:
+        print('  %s  %-8s  %10s  %s  %s' % (e['key'], e['stage'], _format_size(e['size']),
+                                            time.strftime('%Y-%m-%d %H:%M', time.localtime(e['accessed'])),
+                                            e.get('description', '')))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
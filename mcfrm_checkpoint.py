@@ -0,0 +1,197 @@
+# mcfrm_checkpoint.py
+#
+# Checkpoints of long-running pipeline runs, so that a failed run resumes where it stopped.
+#
+# mcfrm_pipeline.run() with a checkpoint directory splits its work into units:
+#    * classifying one tile (block of mcfrm_tiles.iter_windows) of the input with every scheme, into
+#      a class raster per scheme kept in the "artifacts" subdirectory of the checkpoint directory,
+#    * vectorizing the class raster of a scheme, into a features file kept there as well,
+#    * saving the class raster of a scheme to the workspace (with keep_intermediates only), and
+#    * writing the final output feature class of a scheme.
+# The journal, checkpoint.json, records every completed unit with a checksum of its output and of
+# its inputs (the output checksums of the units it consumed). It is committed by writing a temporary
+# file and renaming it into place: after every unit, and at most every few seconds while tiles are
+# classified, so an interrupted run loses little work.
+#
+# On a re-run every recorded unit is validated against its artifact - the class codes of the tile,
+# the features file, or the feature class read back from its storage - before it is skipped. A unit
+# that is missing, fails validation or whose inputs changed is redone, and so is everything
+# downstream of it. The journal is discarded and the run rebuilt from scratch when forced to, or
+# whenever the input, the schemes, the tool version, the block shape or the options of the run
+# differ from those it was recorded for.
+#
+# Once a run completes, the artifacts subdirectory is deleted, but the journal is kept: a re-run then
+# only validates the outputs. Nothing else in the checkpoint directory is ever deleted; still, it may
+# not hold the outputs or the workspace of the run (see check_separate). The journal can be shown with
+#
+#    python mcfrm_checkpoint.py checkpoints/ctps_present
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+JOURNAL = 'checkpoint.json'
+ARTIFACTS = 'artifacts'
+
+# Least number of seconds between two saves of the journal while classifying tiles
+SAVE_INTERVAL = 5.0
+
+
+def checksum_array(values):
+    """Checksum of an array's values."""
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+def checksum_features(features):
+    """Checksum of Features: their codes, parts, rings and vertices, in order."""
+    digest = hashlib.sha1()
+    for f in features:
+        digest.update(('%d %d;' % (f.gridcode, len(f.parts))).encode('ascii'))
+        for part in f.parts:
+            digest.update(('%d;' % len(part)).encode('ascii'))
+            for ring in part:
+                digest.update(np.ascontiguousarray(ring, dtype=np.float64).tobytes())
+                digest.update(b';')
+    return digest.hexdigest()
+
+
+def combine(checksums):
+    """Checksum of a sequence of checksums."""
+    return hashlib.sha1(' '.join(checksums).encode('ascii')).hexdigest()
+
+
+def tile_unit(window):
+    return 'tile %d,%d' % (window.row, window.col)
+
+
+def open_array(path, shape, dtype):
+    """Memory-map a .npy file for update, creating it if it is missing or has another shape or dtype."""
+    if os.path.exists(path):
+        try:
+            array = np.lib.format.open_memmap(path, mode='r+')
+        except ValueError:
+            array = None
+        if array is not None and array.shape == tuple(shape) and array.dtype == np.dtype(dtype):
+            return array
+        del array
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def check_separate(directory, paths):
+    """Raise ValueError if any of the paths (outputs, workspace) lies in a checkpoint directory."""
+    root = os.path.normcase(os.path.abspath(directory))
+    for path in paths:
+        target = os.path.normcase(os.path.abspath(path)) if path else None
+        if target is not None and (target == root or target.startswith(root + os.sep)):
+            raise ValueError('The checkpoint directory %s must not contain %s' % (directory, path))
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+class Journal(object):
+    """Completed units of a run, in checkpoint.json of a directory, with their artifacts in its artifacts subdirectory.
+
+    header - JSON-serializable description of the run; the journal is only reused for an equal header
+    force  - if true, discard any existing journal and artifacts
+    """
+
+    def __init__(self, directory, header, force=False, log=print):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL)
+        self.header = json.loads(json.dumps(header))
+        os.makedirs(directory, exist_ok=True)
+        state = _load(self.path)
+        if state is not None and force:
+            log('Forced full rebuild: discarding checkpoint ' + self.path + '.')
+        elif state is not None and state.get('header') != self.header:
+            log('Checkpoint ' + self.path + ' was recorded for another input, scheme or options: starting over.')
+        if state is None or force or state.get('header') != self.header:
+            self.units = {}
+            self.complete = False
+            self.clear_artifacts()
+            self.save()
+        else:
+            self.units = state['units']
+            self.complete = state.get('complete', False)
+        self._saved = time.time()
+
+    def artifact(self, name):
+        """Path of an artifact called name, in the artifacts subdirectory."""
+        directory = os.path.join(self.directory, ARTIFACTS)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def clear_artifacts(self):
+        """Delete the artifacts subdirectory, and nothing else."""
+        shutil.rmtree(os.path.join(self.directory, ARTIFACTS), ignore_errors=True)
+
+    def get(self, unit, inputs=None):
+        """Recorded output of a unit completed from the given inputs, or None."""
+        entry = self.units.get(unit)
+        if entry is None or entry['inputs'] != inputs:
+            return None
+        return entry['output']
+
+    def record(self, unit, output, inputs=None, save=True):
+        """Record a completed unit, and save the journal (if save is true, or else at most every SAVE_INTERVAL s)."""
+        self.units[unit] = {'output': output, 'inputs': inputs, 'time': time.time()}
+        self.complete = False
+        self.save(0 if save else SAVE_INTERVAL)
+
+    def forget(self, unit):
+        if self.units.pop(unit, None) is not None:
+            self.complete = False
+
+    def finish(self):
+        """Mark the run complete, and delete the artifacts no longer needed."""
+        self.complete = True
+        self.save()
+        self.clear_artifacts()
+
+    def save(self, interval=0):
+        if interval and time.time() - self._saved < interval:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'header': self.header, 'complete': self.complete, 'units': self.units}, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        self._saved = time.time()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Show the checkpoint of a pipeline run.')
+    parser.add_argument('directory', help='checkpoint directory of the run')
+    args = parser.parse_args(argv)
+    state = _load(os.path.join(args.directory, JOURNAL))
+    if state is None:
+        print('No checkpoint in ' + args.directory)
+        return 1
+    header = state['header']
+    print('Input:   %s' % header.get('input'))
+    print('Schemes: %s' % ', '.join(s['name'] for s in header.get('schemes', [])))
+    print('Status:  %s' % ('complete' if state.get('complete') else 'incomplete'))
+    tiles = [unit for unit in state['units'] if unit.startswith('tile ')]
+    rows, cols = header['info']['shape']
+    block_rows, block_cols = header['block_shape']
+    print('Blocks classified: %d of %d' % (len(tiles), -(-rows // block_rows) * -(-cols // block_cols)))
+    for unit, entry in sorted(state['units'].items(), key=lambda item: item[1]['time']):
+        if not unit.startswith('tile '):
+            print('%-40s %s' % (unit, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,390 @@
+# mcfrm_compact.py
+#
+# Compact storage of class rasters: the smallest integer pixel type, and per-tile compression.
+#
+# Class codes are small integers (-1 to 7 for the current schemes) but class rasters are computed
+# as int16 with -9999 for NoData, and the original Con() rasters were stored at the full default
+# pixel type. Here a class raster is narrowed to the smallest signed integer type holding its codes,
+# with the minimum of that type reserved for NoData (-128 for int8):
+#
+#    smallest_dtype(vmin, vmax)   ->  (int8, -128), (int16, -32768) or (int32, -2**31)
+#    narrow(array, nodata)        ->  (compact array, its NoData code)
+#    widen(array, nodata, ...)    ->  the class raster back at CLASS_DTYPE
+#
+# Class rasters are also written to ".mcr" files, a tiled, compressed container. The raster is cut
+# into tiles (256 x 256 by default) and each tile is stored in the smallest of these encodings:
+#    * constant - a tile holding a single value (open water, inland areas out of the flood plain,
+#                 all-NoData margins) takes no space at all beyond its entry in the index,
+#    * rle      - run lengths along the rows of the tile, deflated,
+#    * deflate  - the narrowed tile's bytes, deflated (zlib),
+# narrowing each tile to the smallest type holding its own codes. The file is
+#
+#    "MCFRMCR1" | tile payloads | index (JSON) | index length (uint64, little-endian) | "MCFRMCR1"
+#
+# where the index records the georeferencing, the tile shape and, per tile in row-major order, its
+# offset, length, encoding, type and (for constant tiles) value. ClassRasterSource memory-maps the
+# file and decodes only the tiles overlapping the windows read, so downstream consumers can read a
+# small area of a statewide raster cheaply. mcfrm_io reads and writes .mcr files like any other
+# raster; reads return the class raster at CLASS_DTYPE with its original NoData code.
+#
+#    python mcfrm_compact.py convert ctps_classes.npy ctps_classes.mcr
+#    python mcfrm_compact.py info ctps_classes.mcr
+
+import argparse
+import collections
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+import mcfrm_io
+from mcfrm_io import RasterInfo, Window
+from mcfrm_reclassify import CLASS_DTYPE
+
+# Default tile shape (rows, columns) of .mcr files
+DEFAULT_TILE_SHAPE = (256, 256)
+
+MAGIC = b'MCFRMCR1'
+
+# Tile encodings
+CONSTANT = 'constant'
+RLE = 'rle'
+DEFLATE = 'deflate'
+
+# Integer types a class raster is narrowed to, smallest first; the minimum of each is its NoData code
+_DTYPES = (np.int8, np.int16, np.int32)
+
+# Number of decoded tiles a ClassRasterSource keeps
+_TILE_CACHE = 64
+
+
+def smallest_dtype(vmin, vmax):
+    """Smallest signed integer type holding [vmin, vmax] with its minimum left free for NoData.
+
+    Returns (dtype, NoData code).
+    """
+    for dtype in _DTYPES:
+        limits = np.iinfo(dtype)
+        if limits.min < vmin and vmax <= limits.max:
+            return np.dtype(dtype), int(limits.min)
+    raise ValueError('Class codes %d to %d do not fit a 32-bit integer' % (vmin, vmax))
+
+
+def _value_range(array, nodata):
+    valid = array[array != nodata] if nodata is not None else array.ravel()
+    if valid.size == 0:
+        return 0, 0
+    return int(valid.min()), int(valid.max())
+
+
+def narrow(array, nodata, dtype=None):
+    """Narrow a class raster to the smallest integer type holding its codes (or to dtype).
+
+    Returns (array, NoData code); cells equal to nodata get the minimum of the type.
+    """
+    if dtype is None:
+        dtype, compact_nodata = smallest_dtype(*_value_range(array, nodata))
+    else:
+        dtype, compact_nodata = np.dtype(dtype), int(np.iinfo(dtype).min)
+    out = array.astype(dtype)
+    if nodata is not None:
+        out[array == nodata] = compact_nodata
+    return out, compact_nodata
+
+
+def widen(array, compact_nodata, nodata, dtype=CLASS_DTYPE):
+    """Inverse of narrow(): the class raster at dtype, with NoData cells set to nodata."""
+    out = array.astype(dtype)
+    if nodata is not None and nodata != compact_nodata:
+        out[array == compact_nodata] = nodata
+    return out
+
+
+def _encode_rle(tile):
+    flat = tile.ravel()
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size)).astype('<u4')
+    return flat[starts].tobytes() + lengths.tobytes()
+
+
+def _decode_rle(data, dtype, shape):
+    n = len(data) // (dtype.itemsize + 4)
+    values = np.frombuffer(data, dtype=dtype, count=n)
+    lengths = np.frombuffer(data, dtype='<u4', offset=n * dtype.itemsize)
+    return np.repeat(values, lengths).reshape(shape)
+
+
+def encode_tile(tile, nodata, level=6):
+    """Encode one tile of a class raster (CLASS_DTYPE, nodata for NoData).
+
+    Returns (encoding, dtype name, value, payload bytes); value is the code of a constant tile.
+    """
+    first = tile.flat[0]
+    if (tile == first).all():
+        return CONSTANT, None, int(first), b''
+    small, _ = narrow(tile, nodata)
+    small = small.astype(small.dtype.newbyteorder('<'), copy=False)
+    candidates = [(DEFLATE, zlib.compress(small.tobytes(), level)), (RLE, zlib.compress(_encode_rle(small), level))]
+    encoding, payload = min(candidates, key=lambda c: len(c[1]))
+    return encoding, small.dtype.str, None, payload
+
+
+def decode_tile(encoding, dtype, value, payload, shape, nodata):
+    """Decode one tile; returns it at CLASS_DTYPE with nodata for NoData."""
+    if encoding == CONSTANT:
+        return np.full(shape, value, dtype=CLASS_DTYPE)
+    dtype = np.dtype(dtype)
+    data = zlib.decompress(payload)
+    if encoding == RLE:
+        small = _decode_rle(data, dtype, shape)
+    else:
+        small = np.frombuffer(data, dtype=dtype).reshape(shape)
+    return widen(small, int(np.iinfo(dtype).min), nodata)
+
+
+class _Grid(object):
+    # Tile grid over a raster
+
+    def __init__(self, shape, tile_shape):
+        self.shape = shape
+        self.tile_shape = (int(tile_shape[0]), int(tile_shape[1]))
+        self.rows = -(-shape[0] // self.tile_shape[0])
+        self.cols = -(-shape[1] // self.tile_shape[1])
+
+    def window(self, index):
+        tr, tc = divmod(index, self.cols)
+        row, col = tr * self.tile_shape[0], tc * self.tile_shape[1]
+        return Window(row, col, min(self.tile_shape[0], self.shape[0] - row), min(self.tile_shape[1], self.shape[1] - col))
+
+    def overlapping(self, window):
+        # Indices of the tiles overlapping a window
+        r0, r1 = window.row // self.tile_shape[0], (window.row + window.nrows - 1) // self.tile_shape[0]
+        c0, c1 = window.col // self.tile_shape[1], (window.col + window.ncols - 1) // self.tile_shape[1]
+        return [tr * self.cols + tc for tr in range(r0, r1 + 1) for tc in range(c0, c1 + 1)]
+
+
+def _intersection(a, b):
+    row, col = max(a.row, b.row), max(a.col, b.col)
+    return Window(row, col, min(a.row + a.nrows, b.row + b.nrows) - row, min(a.col + a.ncols, b.col + b.ncols) - col)
+
+
+def _local(window, origin):
+    return (slice(window.row - origin.row, window.row - origin.row + window.nrows),
+            slice(window.col - origin.col, window.col - origin.col + window.ncols))
+
+
+def _check_codes(dtype, array=None):
+    # .mcr files hold integer class codes only; anything else would be truncated or wrapped
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.integer):
+        raise ValueError('.mcr files hold integer class codes only, got %s values' % dtype)
+    if array is not None and array.size and (dtype.itemsize > np.dtype(CLASS_DTYPE).itemsize or dtype.kind == 'u'):
+        limits = np.iinfo(CLASS_DTYPE)
+        if array.min() < limits.min or array.max() > limits.max:
+            raise ValueError('Class codes out of the %s range: %d to %d' % (np.dtype(CLASS_DTYPE), array.min(),
+                                                                            array.max()))
+
+
+class ClassRasterSink(mcfrm_io.RasterSink):
+    """Windowed writer of a .mcr file.
+
+    Windows may be of any shape; each tile is encoded and written as soon as it is complete, so
+    memory use is bounded by the tiles the windows written so far leave incomplete. Tiles never
+    written are NoData. Only integer class codes can be written (ValueError otherwise).
+    """
+
+    def __init__(self, path, info, dtype=CLASS_DTYPE, tile_shape=DEFAULT_TILE_SHAPE, level=6):
+        _check_codes(dtype)
+        self.path = path
+        self.info = info
+        self.nodata = info.nodata if info.nodata is not None else int(np.iinfo(CLASS_DTYPE).min)
+        self.grid = _Grid(info.shape, tile_shape)
+        self.level = level
+        self._pending = {}     # tile index: [tile, cells written]
+        self._index = {}       # tile index: (offset, length, encoding, dtype, value)
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+
+    def write(self, window, array):
+        array = np.asarray(array)
+        _check_codes(array.dtype, array)
+        for index in self.grid.overlapping(window):
+            tile_window = self.grid.window(index)
+            part = _intersection(window, tile_window)
+            if part.key() == tile_window.key():
+                self._write_tile(index, array[_local(part, window)])
+                continue
+            if index not in self._pending:
+                self._pending[index] = [np.full(tile_window.shape, self.nodata, dtype=CLASS_DTYPE), 0]
+            pending = self._pending[index]
+            pending[0][_local(part, tile_window)] = array[_local(part, window)]
+            pending[1] += part.nrows * part.ncols
+            if pending[1] >= tile_window.nrows * tile_window.ncols:
+                self._write_tile(index, self._pending.pop(index)[0])
+
+    def _write_tile(self, index, tile):
+        encoding, dtype, value, payload = encode_tile(np.asarray(tile, dtype=CLASS_DTYPE), self.nodata, self.level)
+        offset = self._file.tell()
+        self._file.write(payload)
+        self._index[index] = (offset, len(payload), encoding, dtype, value)
+
+    def close(self):
+        if self._file is None:
+            return
+        for index in sorted(self._pending):
+            self._write_tile(index, self._pending[index][0])
+        self._pending = {}
+        n = self.grid.rows * self.grid.cols
+        tiles = [self._index.get(index, (0, 0, CONSTANT, None, self.nodata)) for index in range(n)]
+        index = {'info': self.info.replace(nodata=self.nodata).to_dict(), 'tile_shape': list(self.grid.tile_shape),
+                 'offsets': [t[0] for t in tiles], 'lengths': [t[1] for t in tiles],
+                 'encodings': [t[2] for t in tiles], 'dtypes': [t[3] for t in tiles], 'values': [t[4] for t in tiles]}
+        data = json.dumps(index, separators=(',', ':')).encode('utf-8')
+        self._file.write(data)
+        self._file.write(struct.pack('<Q', len(data)) + MAGIC)
+        self._file.close()
+        self._file = None
+
+
+class ClassRasterSource(mcfrm_io.RasterSource):
+    """Memory-mapped reader of a .mcr file; read() decodes only the tiles overlapping the window.
+
+    read() returns class codes at CLASS_DTYPE with the raster's NoData code (info.nodata);
+    read_compact() returns them narrowed to dtype, with compact_nodata for NoData.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            self._f.close()
+            raise ValueError('Not a class raster (.mcr) file: ' + path)
+        size = len(self._mm)
+        tail = self._mm[size - 16:] if size >= 32 else b''
+        if self._mm[:8] != MAGIC or tail[8:] != MAGIC:
+            self.close()
+            raise ValueError('Not a class raster (.mcr) file: ' + path)
+        length = struct.unpack('<Q', tail[:8])[0]
+        index = json.loads(self._mm[size - 16 - length:size - 16].decode('utf-8'))
+        self.info = RasterInfo.from_dict(index['info'])
+        self.grid = _Grid(self.info.shape, index['tile_shape'])
+        self.tiles = list(zip(index['offsets'], index['lengths'], index['encodings'], index['dtypes'], index['values']))
+        widest = max([np.dtype(t[3]).itemsize for t in self.tiles if t[3]] or [1])
+        values = [t[4] for t in self.tiles if t[2] == CONSTANT and t[4] != self.info.nodata]
+        if values:
+            widest = max(widest, smallest_dtype(min(values), max(values))[0].itemsize)
+        self.dtype = np.dtype('i%d' % widest)
+        self.compact_nodata = int(np.iinfo(self.dtype).min)
+        self._decoded = collections.OrderedDict()
+
+    def tile(self, index):
+        """Decoded tile (CLASS_DTYPE) of a tile index, in row-major order."""
+        tile = self._decoded.get(index)
+        if tile is not None:
+            self._decoded.move_to_end(index)
+            return tile
+        offset, length, encoding, dtype, value = self.tiles[index]
+        tile = decode_tile(encoding, dtype, value, self._mm[offset:offset + length], self.grid.window(index).shape,
+                           self.info.nodata)
+        self._decoded[index] = tile
+        if len(self._decoded) > _TILE_CACHE:
+            self._decoded.popitem(last=False)
+        return tile
+
+    def read(self, window=None):
+        window = window or Window(0, 0, *self.shape)
+        out = np.empty(window.shape, dtype=CLASS_DTYPE)
+        for index in self.grid.overlapping(window):
+            tile_window = self.grid.window(index)
+            part = _intersection(window, tile_window)
+            out[_local(part, window)] = self.tile(index)[_local(part, tile_window)]
+        return out
+
+    def read_compact(self, window=None):
+        return narrow(self.read(window), self.info.nodata, self.dtype)[0]
+
+    def stored_bytes(self):
+        return len(self._mm) if self._mm is not None else 0
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        self._decoded = collections.OrderedDict()
+
+
+def write_class_raster(path, array, info, tile_shape=DEFAULT_TILE_SHAPE):
+    """Write a whole class raster to a .mcr file."""
+    with ClassRasterSink(path, info.replace(shape=array.shape), tile_shape=tile_shape) as sink:
+        sink.write(Window(0, 0, *array.shape), array)
+
+
+def read_class_raster(path):
+    """Read a whole .mcr file. Returns (array, info), at CLASS_DTYPE with the raster's NoData code."""
+    with ClassRasterSource(path) as source:
+        return source.read(), source.info
+
+
+def convert(input_path, output_path, tile_shape=DEFAULT_TILE_SHAPE):
+    """Copy a class raster between file types (.npy, GeoTIFF, .mcr), one band of tiles at a time."""
+    with mcfrm_io.open_source(input_path) as source:
+        info = source.info
+        sink = mcfrm_io.open_sink(output_path, info, CLASS_DTYPE)
+        try:
+            for row in range(0, info.shape[0], tile_shape[0]):
+                band = Window(row, 0, min(tile_shape[0], info.shape[0] - row), info.shape[1])
+                sink.write(band, source.read(band).astype(CLASS_DTYPE, copy=False))
+        finally:
+            sink.close()
+    return info
+
+
+def describe(path):
+    """Summary of a .mcr file: sizes, types and encodings of its tiles."""
+    with ClassRasterSource(path) as source:
+        rows, cols = source.shape
+        return {'shape': [rows, cols], 'tile_shape': list(source.grid.tile_shape), 'tiles': len(source.tiles),
+                'dtype': source.dtype.name, 'nodata': source.info.nodata, 'compact_nodata': source.compact_nodata,
+                'stored_bytes': source.stored_bytes(),
+                'int16_bytes': rows * cols * np.dtype(CLASS_DTYPE).itemsize,
+                'encodings': dict(collections.Counter(t[2] for t in source.tiles))}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert class rasters to and from compact .mcr files.')
+    commands = parser.add_subparsers(dest='command')
+    convert_parser = commands.add_parser('convert', help='convert a class raster (.npy, .tif, .mcr)')
+    convert_parser.add_argument('input')
+    convert_parser.add_argument('output')
+    convert_parser.add_argument('--tile-size', type=int, nargs=2, default=DEFAULT_TILE_SHAPE, metavar=('ROWS', 'COLS'))
+    info_parser = commands.add_parser('info', help='describe a .mcr file')
+    info_parser.add_argument('input')
+    args = parser.parse_args(argv)
+    if args.command == 'convert':
+        convert(args.input, args.output, tuple(args.tile_size))
+        print('Wrote %s (%d bytes)' % (args.output, os.path.getsize(args.output)))
+    elif args.command == 'info':
+        d = describe(args.input)
+        print('%s: %d x %d cells in %d tiles of %d x %d, %s, NoData %s (stored as %d)' % (
+            args.input, d['shape'][0], d['shape'][1], d['tiles'], d['tile_shape'][0], d['tile_shape'][1],
+            d['dtype'], d['nodata'], d['compact_nodata']))
+        print('%d bytes stored, %d bytes as int16 (%.1fx)' % (d['stored_bytes'], d['int16_bytes'],
+                                                              d['int16_bytes'] / float(max(d['stored_bytes'], 1))))
+        print('Tiles: ' + ', '.join('%d %s' % (n, e) for e, n in sorted(d['encodings'].items())))
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,278 @@
+# mcfrm_exposure.py
+#
+# Exposure lookups of point and line assets (stations, track segments, roads) against a classification.
+#
+# Rather than spatially joining assets to the multipart polygons of the final feature class, whose
+# parts have thousands of vertices, the lookups go to the class raster itself, which is its own
+# spatial index: the cell of a point is found by arithmetic on its coordinates. The lookups are
+# vectorized over all the assets of a call, so millions of points take a second or two:
+#    * codes_at(x, y)  - the class code at each point,
+#    * along(lines)    - for each line, the highest class code it crosses and the length of line in
+#                        each class; lines are cut exactly at the cell boundaries they cross.
+# Points and lines outside the raster are NoData.
+#
+# The class raster may be any raster mcfrm_io reads (.npy and .mcr files are memory-mapped, so only
+# the cells looked up are read). Where only the polygons are at hand - a GeoJSON file or feature class
+# written by the pipeline - ExposureIndex.from_polygons() burns them into a class raster once, on a
+# grid of a given cell size, and queries that.
+#
+#    python mcfrm_exposure.py ctps_classes.mcr --points stations.csv --output station_scores.csv
+#    python mcfrm_exposure.py ctps_polygons.geojson --field score --cell-size 5 --lines tracks.geojson --output track_scores.csv
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+import mcfrm_io
+import mcfrm_tiles
+import mcfrm_zonal
+from mcfrm_io import RasterInfo, Window
+from mcfrm_reclassify import BACKGROUND, CLASS_DTYPE, NODATA
+
+# Line segments processed at a time by along(), bounding its working memory
+_SEGMENT_CHUNK = 100000
+
+# max_code of a line before any exposed piece is seen
+_NONE = np.int32(np.iinfo(np.int32).min)
+
+
+class LineExposure(object):
+    """Exposure of lines: max_code[i] is the highest class code line i crosses (NoData if none), and
+    lengths[code][i] the length of line i, in map units, in cells of that code."""
+
+    def __init__(self, max_code, lengths):
+        self.max_code = max_code
+        self.lengths = lengths
+
+
+class ExposureIndex(object):
+    """Point and line lookups against a class raster (an mcfrm_io.RasterSource).
+
+    skip - class codes that are not exposure (background and NoData), ignored by along()'s max_code
+    """
+
+    def __init__(self, source, skip=(BACKGROUND, NODATA)):
+        self.source = source
+        self.info = source.info
+        self.skip = tuple(skip)
+        self.nodata = self.info.nodata if self.info.nodata is not None else NODATA
+        self._array = getattr(source, 'array', None)
+        tile_shape = getattr(getattr(source, 'grid', None), 'tile_shape', None)
+        self.block_shape = tile_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE
+
+    @classmethod
+    def open(cls, path, skip=(BACKGROUND, NODATA)):
+        """Index over a class raster file (.npy, .mcr, GeoTIFF or ArcGIS raster dataset)."""
+        return cls(mcfrm_io.open_source(path), skip)
+
+    @classmethod
+    def from_polygons(cls, path, field, cell_size, crs=None, skip=(BACKGROUND, NODATA)):
+        """Index over the class polygons of a GeoJSON file or feature class, burned into a class raster.
+
+        field     - field holding the class code (e.g. "score" or "gridcode")
+        cell_size - cell size of the raster, in map units; the grid is anchored at the polygons'
+                    lower-left corner (use the class raster's cell size so cells match its cells)
+        """
+        polygons = [(int(code), rings) for code, rings in mcfrm_zonal.read_zone_polygons(path, field, crs) if rings]
+        if not polygons:
+            raise ValueError('No polygons in ' + path)
+        xy = np.vstack([ring for code, rings in polygons for ring in rings])
+        x_min, y_min = xy.min(axis=0)
+        x_max, y_max = xy.max(axis=0)
+        shape = (max(int(np.ceil(round((y_max - y_min) / cell_size, 6))), 1),
+                 max(int(np.ceil(round((x_max - x_min) / cell_size, 6))), 1))
+        info = RasterInfo(x_min, y_min + shape[0] * cell_size, cell_size, shape, NODATA, crs)
+        classes = np.full(shape, NODATA, dtype=CLASS_DTYPE)
+        for code, rings in polygons:
+            polygon = mcfrm_zonal.ZonePolygon(code, rings, info)
+            if polygon.window is None:
+                continue
+            for window in mcfrm_tiles.iter_windows(polygon.window.shape):
+                window = Window(polygon.window.row + window.row, polygon.window.col + window.col,
+                                window.nrows, window.ncols)
+                inside = mcfrm_zonal.rasterize(polygon.edges, info, window)
+                classes[window.slices()][inside] = code
+        return cls(mcfrm_io.ArraySource(classes, info), skip)
+
+    def close(self):
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cells(self, x, y):
+        info = self.info
+        cols = np.floor((np.asarray(x, dtype=np.float64) - info.x_min) / info.cell_size[0]).astype(np.int64)
+        rows = np.floor((info.y_max - np.asarray(y, dtype=np.float64)) / info.cell_size[1]).astype(np.int64)
+        return rows, cols
+
+    def codes_at_cells(self, rows, cols):
+        """Class codes of cells (row, column arrays); NoData outside the raster."""
+        rows, cols = np.asarray(rows), np.asarray(cols)
+        out = np.full(rows.shape, self.nodata, dtype=CLASS_DTYPE)
+        inside = (rows >= 0) & (rows < self.info.shape[0]) & (cols >= 0) & (cols < self.info.shape[1])
+        rows, cols = rows[inside], cols[inside]
+        if self._array is not None:
+            out[inside] = self._array[rows, cols]
+            return out
+        # Read each block holding points once
+        br, bc = self.block_shape
+        n_block_cols = -(-self.info.shape[1] // bc)
+        blocks = (rows // br) * n_block_cols + cols // bc
+        order = np.argsort(blocks, kind='stable')
+        blocks = blocks[order]
+        starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+        values = np.empty(len(order), dtype=CLASS_DTYPE)
+        for start, end in zip(starts, np.r_[starts[1:], len(order)]):
+            block_row, block_col = divmod(int(blocks[start]), n_block_cols)
+            row, col = block_row * br, block_col * bc
+            window = Window(row, col, min(br, self.info.shape[0] - row), min(bc, self.info.shape[1] - col))
+            idx = order[start:end]
+            values[idx] = self.source.read(window)[rows[idx] - row, cols[idx] - col]
+        out[inside] = values
+        return out
+
+    def codes_at(self, x, y):
+        """Class codes at points (x, y arrays in the raster's coordinate system)."""
+        return self.codes_at_cells(*self._cells(x, y))
+
+    def along(self, lines):
+        """Exposure of lines, each an (n, 2) array of x, y vertices. Returns a LineExposure."""
+        lines = [np.asarray(line, dtype=np.float64).reshape(-1, 2) for line in lines]
+        counts = np.array([max(len(line) - 1, 0) for line in lines], dtype=np.int64)
+        segments = np.vstack([np.hstack([line[:-1], line[1:]]) for line in lines if len(line) > 1] or
+                             [np.empty((0, 4))])
+        owner = np.repeat(np.arange(len(lines)), counts)
+        max_code = np.full(len(lines), _NONE, dtype=np.int32)
+        lengths = {}
+        for start in range(0, len(segments), _SEGMENT_CHUNK):
+            line, codes, length = self._pieces(segments[start:start + _SEGMENT_CHUNK],
+                                               owner[start:start + _SEGMENT_CHUNK])
+            if not len(line):
+                continue
+            # Pieces come in line order: reduce each line's run of pieces
+            exposed = np.where(~np.isin(codes, self.skip) & (length > 0), codes.astype(np.int32), _NONE)
+            starts = np.flatnonzero(np.r_[True, line[1:] != line[:-1]])
+            max_code[line[starts]] = np.maximum(max_code[line[starts]], np.maximum.reduceat(exposed, starts))
+            for code in np.unique(codes).tolist():
+                mask = codes == code
+                total = np.bincount(line[mask], weights=length[mask], minlength=len(lines))
+                lengths[code] = lengths[code] + total if code in lengths else total
+        max_code[max_code == _NONE] = self.nodata
+        return LineExposure(max_code.astype(CLASS_DTYPE), lengths)
+
+    def _pieces(self, segments, owner):
+        # Cut segments at the cell boundaries they cross: returns the line, class code and length of
+        # each piece
+        info = self.info
+        u0 = (segments[:, 0] - info.x_min) / info.cell_size[0]
+        v0 = (info.y_max - segments[:, 1]) / info.cell_size[1]
+        u1 = (segments[:, 2] - info.x_min) / info.cell_size[0]
+        v1 = (info.y_max - segments[:, 3]) / info.cell_size[1]
+        seg = np.arange(len(segments))
+        ts, ids = [np.zeros(len(seg)), np.ones(len(seg))], [seg, seg]
+        for a, b in ((u0, u1), (v0, v1)):
+            # Parameters t in (0, 1) at which the segment crosses the integer grid lines of this axis
+            low, high = np.minimum(a, b), np.maximum(a, b)
+            first = np.floor(low).astype(np.int64) + 1
+            n = np.maximum(np.ceil(high).astype(np.int64) - first, 0)
+            which = np.repeat(seg, n)
+            k = first[which] + np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n, n)
+            ts.append((k - a[which]) / (b[which] - a[which]))
+            ids.append(which)
+        t, which = np.concatenate(ts), np.concatenate(ids)
+        order = np.argsort(which * 2.0 + t)
+        t, which = t[order], which[order]
+        same = which[1:] == which[:-1]
+        t0, t1, piece = t[:-1][same], t[1:][same], which[:-1][same]
+        mid = (t0 + t1) / 2
+        rows = np.floor(v0[piece] + mid * (v1[piece] - v0[piece])).astype(np.int64)
+        cols = np.floor(u0[piece] + mid * (u1[piece] - u0[piece])).astype(np.int64)
+        seg_length = np.hypot(segments[:, 2] - segments[:, 0], segments[:, 3] - segments[:, 1])
+        return owner[piece], self.codes_at_cells(rows, cols), (t1 - t0) * seg_length[piece]
+
+
+#####################
+# Reading assets
+
+def read_points(path, x_field='x', y_field='y'):
+    """Read points from a CSV file (x_field, y_field columns) or GeoJSON file. Returns (records, x, y)."""
+    if os.path.splitext(path)[1].lower() in ('.geojson', '.json'):
+        with open(path) as f:
+            features = [f for f in json.load(f)['features'] if (f.get('geometry') or {}).get('type') == 'Point']
+        records = [dict(f.get('properties') or {}, id=f.get('id', n)) for n, f in enumerate(features)]
+        xy = np.array([f['geometry']['coordinates'][:2] for f in features], dtype=np.float64).reshape(-1, 2)
+        return records, xy[:, 0], xy[:, 1]
+    with open(path, newline='') as f:
+        records = list(csv.DictReader(f))
+    x = np.array([float(r[x_field]) for r in records])
+    y = np.array([float(r[y_field]) for r in records])
+    return records, x, y
+
+
+def read_lines(path):
+    """Read lines from a GeoJSON file (LineString or MultiLineString). Returns (records, lines);
+    a MultiLineString gives one record per part."""
+    with open(path) as f:
+        features = json.load(f)['features']
+    records, lines = [], []
+    for n, feature in enumerate(features):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'LineString':
+            parts = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiLineString':
+            parts = geometry['coordinates']
+        else:
+            continue
+        for part in parts:
+            records.append(dict(feature.get('properties') or {}, id=feature.get('id', n)))
+            lines.append(np.asarray(part, dtype=np.float64)[:, :2])
+    return records, lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Look up the class of point and line assets.')
+    parser.add_argument('classes', help='class raster, or class polygons (GeoJSON or feature class, with --field)')
+    parser.add_argument('--field', help='field holding the class code of the polygons, e.g. score or gridcode')
+    parser.add_argument('--cell-size', type=float, help='cell size to burn the polygons in at (default: 5)')
+    parser.add_argument('--points', help='CSV (x, y columns) or GeoJSON file of points')
+    parser.add_argument('--x-field', default='x')
+    parser.add_argument('--y-field', default='y')
+    parser.add_argument('--lines', help='GeoJSON file of lines')
+    parser.add_argument('--output', required=True, help='CSV file: the assets with their class codes')
+    args = parser.parse_args(argv)
+    if bool(args.points) == bool(args.lines):
+        parser.error('give one of --points and --lines')
+    if args.field:
+        index = ExposureIndex.from_polygons(args.classes, args.field, args.cell_size or 5.0)
+    else:
+        index = ExposureIndex.open(args.classes)
+    with index:
+        if args.points:
+            records, x, y = read_points(args.points, args.x_field, args.y_field)
+            columns = {'code': index.codes_at(x, y)}
+        else:
+            records, lines = read_lines(args.lines)
+            exposure = index.along(lines)
+            columns = {'max_code': exposure.max_code}
+            for code in sorted(exposure.lengths):
+                columns['length_%d' % code] = np.round(exposure.lengths[code], 3)
+    fields = list(records[0]) if records else []
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields + list(columns))
+        for n, record in enumerate(records):
+            writer.writerow([record.get(k) for k in fields] + [values[n] for values in columns.values()])
+    print('Wrote %d assets to %s' % (len(records), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
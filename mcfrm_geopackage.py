@@ -0,0 +1,298 @@
+# mcfrm_geopackage.py
+#
+# Reading and writing multipart polygon features (mcfrm_vectorize.Feature) as GeoPackage layers.
+#
+# A GeoPackage (OGC 12-128r18) is an SQLite database; this module writes it with the standard
+# library's sqlite3 alone, so the polygons can be produced on machines with neither arcpy nor GDAL
+# and opened directly in ArcGIS Pro, QGIS or anything built on GDAL. Each layer is a table with an
+# integer primary key "fid", a MULTIPOLYGON geometry column "geom" (GeoPackage binary: a short header
+# with the envelope, then little-endian WKB), and a single INTEGER field holding the class code.
+#
+# A layer is named like a feature class in a file geodatabase: "<file>.gpkg/<layer>", or just
+# "<file>.gpkg" for a layer named after the file. Exterior rings are written counter-clockwise and
+# holes clockwise, as in GeoJSON, and reversed on reading, so Features round-trip exactly.
+#
+# The coordinate system is taken from the CRS string: "EPSG:<code>", or WKT (whose last EPSG
+# AUTHORITY, if any, gives the srs_id); other CRSs are stored under a custom srs_id.
+
+import os
+import re
+import sqlite3
+import struct
+
+import numpy as np
+
+import mcfrm_vectorize
+
+# "GPKG" in ASCII, and GeoPackage version 1.3.0
+APPLICATION_ID = 0x47504B47
+USER_VERSION = 10300
+
+# srs_id of a CRS without an EPSG code
+_CUSTOM_SRS_ID = 100000
+
+_WKB_POLYGON = 3
+_WKB_MULTIPOLYGON = 6
+
+# Bytes of the envelope of a GeoPackage geometry header, by envelope indicator
+_ENVELOPE_BYTES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS gpkg_spatial_ref_sys (
+    srs_name TEXT NOT NULL, srs_id INTEGER PRIMARY KEY, organization TEXT NOT NULL,
+    organization_coordsys_id INTEGER NOT NULL, definition TEXT NOT NULL, description TEXT);
+CREATE TABLE IF NOT EXISTS gpkg_contents (
+    table_name TEXT NOT NULL PRIMARY KEY, data_type TEXT NOT NULL, identifier TEXT UNIQUE,
+    description TEXT DEFAULT '', last_change DATETIME NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now')),
+    min_x DOUBLE, min_y DOUBLE, max_x DOUBLE, max_y DOUBLE, srs_id INTEGER,
+    CONSTRAINT fk_gc_r_srs_id FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys(srs_id));
+CREATE TABLE IF NOT EXISTS gpkg_geometry_columns (
+    table_name TEXT NOT NULL, column_name TEXT NOT NULL, geometry_type_name TEXT NOT NULL,
+    srs_id INTEGER NOT NULL, z TINYINT NOT NULL, m TINYINT NOT NULL,
+    CONSTRAINT pk_geom_cols PRIMARY KEY (table_name, column_name),
+    CONSTRAINT fk_gc_tn FOREIGN KEY (table_name) REFERENCES gpkg_contents(table_name),
+    CONSTRAINT fk_gc_srs FOREIGN KEY (srs_id) REFERENCES gpkg_spatial_ref_sys (srs_id));
+"""
+
+# Spatial reference systems every GeoPackage must define
+_REQUIRED_SRS = [
+    ('Undefined cartesian SRS', -1, 'NONE', -1, 'undefined', 'undefined cartesian coordinate reference system'),
+    ('Undefined geographic SRS', 0, 'NONE', 0, 'undefined', 'undefined geographic coordinate reference system'),
+    ('WGS 84 geodetic', 4326, 'EPSG', 4326,
+     'GEOGCS["WGS 84",DATUM["WGS_1984",SPHEROID["WGS 84",6378137,298.257223563,AUTHORITY["EPSG","7030"]],'
+     'AUTHORITY["EPSG","6326"]],PRIMEM["Greenwich",0,AUTHORITY["EPSG","8901"]],'
+     'UNIT["degree",0.0174532925199433,AUTHORITY["EPSG","9122"]],AXIS["Latitude",NORTH],AXIS["Longitude",EAST],'
+     'AUTHORITY["EPSG","4326"]]', 'longitude/latitude coordinates in decimal degrees on the WGS 84 spheroid'),
+]
+
+
+def is_geopackage(path):
+    """Whether a path names a GeoPackage layer ("<file>.gpkg" or "<file>.gpkg/<layer>")."""
+    return re.search(r'\.gpkg($|[/\\])', path, re.IGNORECASE) is not None
+
+
+def split_path(path):
+    """Split a layer path into (GeoPackage file, layer name)."""
+    match = re.search(r'\.gpkg($|[/\\])', path, re.IGNORECASE)
+    if match is None:
+        raise ValueError('Not a GeoPackage path: %s' % path)
+    filename = path[:match.start() + 5]
+    layer = path[match.end():].strip('/\\')
+    if not layer:
+        layer = os.path.splitext(os.path.basename(filename))[0]
+    return filename, layer
+
+
+def _quote(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _connect(filename):
+    db = sqlite3.connect(filename)
+    db.execute('PRAGMA application_id = %d' % APPLICATION_ID)
+    db.execute('PRAGMA user_version = %d' % USER_VERSION)
+    db.executescript(_SCHEMA)
+    db.executemany('INSERT OR IGNORE INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)', _REQUIRED_SRS)
+    return db
+
+
+def _srs(crs):
+    # (srs_id, organization, definition) of a CRS string
+    if not crs:
+        return -1, 'NONE', 'undefined'
+    match = re.match(r'^\s*EPSG:(\d+)\s*$', crs, re.IGNORECASE)
+    if match:
+        return int(match.group(1)), 'EPSG', 'undefined'
+    codes = re.findall(r'AUTHORITY\["EPSG",\s*"?(\d+)"?\]', crs)
+    if codes and crs.rstrip().endswith(']]'):
+        return int(codes[-1]), 'EPSG', crs
+    return _CUSTOM_SRS_ID, 'NONE', crs
+
+
+def _add_srs(db, crs):
+    srs_id, organization, definition = _srs(crs)
+    row = db.execute('SELECT definition FROM gpkg_spatial_ref_sys WHERE srs_id = ?', (srs_id,)).fetchone()
+    if row is None:
+        name = crs.split('"')[1] if crs and '"' in crs else (crs or 'undefined')
+        db.execute('INSERT INTO gpkg_spatial_ref_sys VALUES (?, ?, ?, ?, ?, ?)',
+                   (name, srs_id, organization, srs_id, definition, ''))
+    elif srs_id == _CUSTOM_SRS_ID and row[0] != definition:
+        raise ValueError('The GeoPackage already holds another custom coordinate system')
+    elif row[0] == 'undefined' and definition != 'undefined':
+        db.execute('UPDATE gpkg_spatial_ref_sys SET definition = ? WHERE srs_id = ?', (definition, srs_id))
+    return srs_id
+
+
+#####################
+# Geometry encoding
+
+def encode_geometry(feature, srs_id):
+    """GeoPackage binary geometry of a Feature: header, envelope and little-endian WKB MultiPolygon."""
+    rings = [ring for part in feature.parts for ring in part]
+    xy = np.concatenate(rings) if rings else np.zeros((0, 2))
+    empty = len(xy) == 0
+    flags = 0x01 | (0x10 if empty else 0x02)        # little-endian; empty, or with an x/y envelope
+    chunks = [struct.pack('<2sBBi', b'GP', 0, flags, srs_id)]
+    if not empty:
+        chunks.append(struct.pack('<4d', xy[:, 0].min(), xy[:, 0].max(), xy[:, 1].min(), xy[:, 1].max()))
+    chunks.append(struct.pack('<BII', 1, _WKB_MULTIPOLYGON, len(feature.parts)))
+    for part in feature.parts:
+        chunks.append(struct.pack('<BII', 1, _WKB_POLYGON, len(part)))
+        for ring in part:
+            chunks.append(struct.pack('<I', len(ring)))
+            chunks.append(np.ascontiguousarray(ring[::-1], dtype='<f8').tobytes())
+    return b''.join(chunks)
+
+
+def decode_geometry(blob):
+    """Parts of a GeoPackage binary Polygon or MultiPolygon, as lists of (n, 2) rings (see encode_geometry)."""
+    blob = bytes(blob)
+    if blob[:2] != b'GP':
+        raise ValueError('Not a GeoPackage geometry')
+    flags = blob[3]
+    if flags & 0x10:
+        return []
+    offset = 8 + _ENVELOPE_BYTES[(flags >> 1) & 0x07]
+    parts, offset = _read_wkb(blob, offset)
+    return parts
+
+
+def _read_wkb(blob, offset):
+    # Parts of the WKB Polygon or MultiPolygon at offset, and the offset past it
+    order = '<' if blob[offset] == 1 else '>'
+    kind, = struct.unpack_from(order + 'I', blob, offset + 1)
+    offset += 5
+    if kind == _WKB_MULTIPOLYGON:
+        count, = struct.unpack_from(order + 'I', blob, offset)
+        offset += 4
+        parts = []
+        for _ in range(count):
+            polygon, offset = _read_wkb(blob, offset)
+            parts.extend(polygon)
+        return parts, offset
+    if kind != _WKB_POLYGON:
+        raise ValueError('Expected a 2D polygon geometry, got WKB type %d' % kind)
+    count, = struct.unpack_from(order + 'I', blob, offset)
+    offset += 4
+    rings = []
+    for _ in range(count):
+        n, = struct.unpack_from(order + 'I', blob, offset)
+        offset += 4
+        ring = np.frombuffer(blob, dtype=order + 'f8', count=2 * n, offset=offset).reshape(n, 2)
+        rings.append(ring[::-1].astype(np.float64))
+        offset += 16 * n
+    return [rings], offset
+
+
+#####################
+# Layers
+
+def exists(path):
+    """Whether a GeoPackage layer exists."""
+    filename, layer = split_path(path)
+    if not os.path.exists(filename):
+        return False
+    db = sqlite3.connect(filename)
+    try:
+        row = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (layer,)).fetchone()
+    finally:
+        db.close()
+    return row is not None
+
+
+def delete_layer(path):
+    """Delete a GeoPackage layer, if it exists."""
+    filename, layer = split_path(path)
+    if not os.path.exists(filename):
+        return
+    db = _connect(filename)
+    try:
+        with db:
+            db.execute('DROP TABLE IF EXISTS %s' % _quote(layer))
+            db.execute('DELETE FROM gpkg_geometry_columns WHERE table_name = ?', (layer,))
+            db.execute('DELETE FROM gpkg_contents WHERE table_name = ?', (layer,))
+    finally:
+        db.close()
+
+
+def _insert(db, layer, features, field, srs_id):
+    db.executemany('INSERT INTO %s (geom, %s) VALUES (?, ?)' % (_quote(layer), _quote(field)),
+                   [(encode_geometry(f, srs_id), int(f.gridcode)) for f in features])
+
+
+def _update_extent(db, layer):
+    # Extent of the layer, from the envelopes in the geometry headers
+    envelopes = [struct.unpack_from('<4d' if blob[3] & 0x01 else '>4d', blob, 8)
+                 for blob, in db.execute('SELECT geom FROM %s' % _quote(layer)) if (blob[3] >> 1) & 0x07]
+    extent = [None] * 4
+    if envelopes:
+        e = np.array(envelopes)
+        extent = [float(e[:, 0].min()), float(e[:, 2].min()), float(e[:, 1].max()), float(e[:, 3].max())]
+    db.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ?, "
+               "last_change = strftime('%Y-%m-%dT%H:%M:%fZ','now') WHERE table_name = ?", extent + [layer])
+
+
+def write_features(path, features, field='gridcode', crs=None):
+    """Write Features to a GeoPackage layer, replacing the layer if it exists (other layers are kept).
+
+    crs - coordinate reference system: "EPSG:<code>" or WKT
+    """
+    filename, layer = split_path(path)
+    db = _connect(filename)
+    try:
+        with db:
+            srs_id = _add_srs(db, crs)
+            db.execute('DROP TABLE IF EXISTS %s' % _quote(layer))
+            db.execute('DELETE FROM gpkg_geometry_columns WHERE table_name = ?', (layer,))
+            db.execute('DELETE FROM gpkg_contents WHERE table_name = ?', (layer,))
+            db.execute('CREATE TABLE %s (fid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, geom MULTIPOLYGON, %s INTEGER)'
+                       % (_quote(layer), _quote(field)))
+            db.execute("INSERT INTO gpkg_contents (table_name, data_type, identifier, srs_id) VALUES (?, 'features', ?, ?)",
+                       (layer, layer, srs_id))
+            db.execute("INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', 'MULTIPOLYGON', ?, 0, 0)", (layer, srs_id))
+            _insert(db, layer, features, field, srs_id)
+            _update_extent(db, layer)
+    finally:
+        db.close()
+
+
+def update_features(path, features, codes, field='gridcode'):
+    """Replace the features of the given class codes in an existing GeoPackage layer by those in features.
+
+    Features of other codes are left untouched; a code absent from features has its feature deleted.
+    """
+    filename, layer = split_path(path)
+    codes = set(int(c) for c in codes)
+    db = _connect(filename)
+    try:
+        with db:
+            srs_id, = db.execute('SELECT srs_id FROM gpkg_geometry_columns WHERE table_name = ?', (layer,)).fetchone()
+            db.executemany('DELETE FROM %s WHERE %s = ?' % (_quote(layer), _quote(field)), [(c,) for c in sorted(codes)])
+            _insert(db, layer, sorted((f for f in features if f.gridcode in codes), key=lambda f: f.gridcode),
+                    field, srs_id)
+            _update_extent(db, layer)
+    finally:
+        db.close()
+
+
+def read_features(path, field='gridcode'):
+    """Read the Features of a GeoPackage layer, in fid order. Returns (list of Features, CRS string or None)."""
+    filename, layer = split_path(path)
+    if not os.path.exists(filename):
+        raise ValueError('GeoPackage not found: %s' % filename)
+    db = sqlite3.connect(filename)
+    try:
+        column, srs_id = db.execute('SELECT column_name, srs_id FROM gpkg_geometry_columns WHERE table_name = ?',
+                                    (layer,)).fetchone()
+        features = [mcfrm_vectorize.Feature(code, decode_geometry(blob)) for blob, code in
+                    db.execute('SELECT %s, %s FROM %s ORDER BY fid' % (_quote(column), _quote(field), _quote(layer)))]
+        row = db.execute('SELECT organization, definition FROM gpkg_spatial_ref_sys WHERE srs_id = ?',
+                         (srs_id,)).fetchone()
+    finally:
+        db.close()
+    crs = None
+    if row is not None and row[1] != 'undefined':
+        crs = row[1]
+    elif row is not None and row[0].upper() == 'EPSG':
+        crs = 'EPSG:%d' % srs_id
+    return features, crs
@@ -0,0 +1,296 @@
+# mcfrm_horizons.py
+#
+# Multi-horizon classification: the Present, 2030, 2050 and 2070 probability rasters of a region,
+# classified together as one band stack.
+#
+# Rather than classifying each horizon separately and overlaying the four polygon feature classes
+# to see where the score changes, the horizon rasters (which must share one grid) are read block by
+# block, each block of every horizon at once, and the stacked bands are classified in a single
+# vectorized pass (mcfrm_schemes.classify searches the probabilities of all the bands together).
+# Each scheme yields
+#    * the score by horizon: an array of shape (horizons, rows, columns) holding the class code of
+#      each cell at each horizon, written to "<scheme>_scores.npy" with the georeferencing and the
+#      horizon names in its .npy.json sidecar, and
+#    * a change-code raster: for each cell, the first horizon at which its score reaches a threshold
+#      (0 for the first horizon given, 1 for the second, ...), BACKGROUND if it never does, and
+#      NODATA if the cell is NoData at every horizon. Written through mcfrm_io.open_sink, by default as
+#      a compact .mcr file, and optionally vectorized to one multipart polygon per horizon.
+# NoData is taken per horizon, so the horizon rasters may have different NoData values.
+#
+#    python mcfrm_horizons.py --horizon Present=p0.tif --horizon 2030=p30.tif --horizon 2050=p50.tif \
+#        --horizon 2070=p70.tif --scheme CTPS --threshold 5 --output-dir horizons
+
+import argparse
+import collections
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import mcfrm_io
+import mcfrm_tiles
+import mcfrm_vectorize
+from mcfrm_instrument import NULL_RECORDER, Recorder
+from mcfrm_reclassify import BACKGROUND, CLASS_DTYPE, NODATA
+from mcfrm_schemes import classify, get_scheme, scheme_names
+
+# Most horizons first_reaching() handles (one bit of a 16-bit mask each)
+MAX_HORIZONS = 16
+
+
+def classify_stack(stack, schemes, nodata=None):
+    """Classify a band stack of probabilities, shape (horizons, rows, columns), in one pass.
+
+    Returns {scheme name: class array of the stack's shape}, the score of each cell at each horizon.
+    """
+    return classify(stack, schemes, nodata=nodata)
+
+
+def first_reaching(scores, threshold):
+    """Change codes of a score stack: the index of the first horizon at which each cell's score is >= threshold.
+
+    scores    - class array of shape (horizons, rows, columns), as returned by classify_stack()
+    threshold - a class code (NoData and background codes are below every class code)
+    Cells that never reach the threshold are BACKGROUND; cells that are NoData at every horizon are NODATA.
+    """
+    n = len(scores)
+    if n > MAX_HORIZONS:
+        raise ValueError('At most %d horizons can be stacked, got %d' % (MAX_HORIZONS, n))
+    # Bit k of reached is set where the score reaches the threshold at horizon k; the change code is
+    # the lowest bit set, looked up in a table of every pattern of bits
+    reached = np.zeros(scores.shape[1:], dtype=np.uint16)
+    missing = np.ones(scores.shape[1:], dtype=bool)
+    for k in range(n):
+        reached |= (scores[k] >= threshold).astype(np.uint16) << k
+        missing &= scores[k] == NODATA
+    patterns = np.arange(1 << n)
+    table = np.full(1 << n, BACKGROUND, dtype=CLASS_DTYPE)
+    for k in range(n - 1, -1, -1):
+        table[(patterns >> k) & 1 == 1] = k
+    codes = table[reached]
+    codes[missing] = NODATA
+    return codes
+
+
+def _check_threshold(scheme, threshold):
+    codes = [c.code for c in scheme.classes]
+    if not min(codes) <= threshold <= max(codes):
+        raise ValueError('Threshold %d is not a %s class code (%d to %d)' % (threshold, scheme.name, min(codes), max(codes)))
+
+
+def _open_horizons(paths, envelope):
+    # Open the horizon rasters, checking that they share the grid of the first
+    sources = []
+    try:
+        for path in paths:
+            source = mcfrm_io.open_source(path, envelope)
+            sources.append(source)
+            first, info = sources[0].info, source.info
+            if info.shape != first.shape or not np.allclose((info.x_min, info.y_max) + info.cell_size,
+                                                            (first.x_min, first.y_max) + first.cell_size):
+                raise ValueError('Horizon raster %s is not on the grid of %s' % (path, paths[0]))
+    except Exception:
+        for source in sources:
+            source.close()
+        raise
+    return sources
+
+
+def read_stack(sources, window=None):
+    """Read a window of every source into one floating-point band stack, with each source's NoData set to NaN."""
+    blocks = [source.read(window) for source in sources]
+    stack = np.empty((len(blocks),) + blocks[0].shape, dtype=np.result_type(np.float32, *blocks))
+    for band, (block, source) in enumerate(zip(blocks, sources)):
+        stack[band] = block
+        if source.info.nodata is not None:
+            stack[band][block == source.info.nodata] = np.nan
+    return stack
+
+
+class ScoreSink(object):
+    """Sink into a memory-mapped .npy score stack of shape (horizons, rows, columns).
+
+    The .npy.json sidecar holds the RasterInfo of a band plus the horizon names.
+    """
+
+    def __init__(self, path, info, horizons, dtype=CLASS_DTYPE):
+        self.path = path
+        self.array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(len(horizons),) + info.shape)
+        with open(path + '.json', 'w') as f:
+            json.dump(dict(info.to_dict(), horizons=list(horizons)), f, indent=1)
+
+    def write(self, window, array):
+        rows, cols = window.slices()
+        self.array[:, rows, cols] = array
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+def read_scores(path):
+    """Read a score stack written by classify_horizons(): returns (memory-mapped array, RasterInfo, horizon names)."""
+    with open(path + '.json') as f:
+        attrs = json.load(f)
+    horizons = attrs.pop('horizons')
+    return np.load(path, mmap_mode='r'), mcfrm_io.RasterInfo.from_dict(attrs), horizons
+
+
+def default_block_shape(n_horizons):
+    """Block shape holding, over all the horizons, as many cells as a default block of one raster."""
+    rows, cols = mcfrm_tiles.DEFAULT_BLOCK_SHAPE
+    return max(rows // max(n_horizons, 1), 1), cols
+
+
+def classify_horizons(horizons, schemes, threshold, scores=None, changes=None, envelope=None,
+                      block_shape=None, recorder=None):
+    """Classify aligned horizon rasters as one band stack, block by block.
+
+    horizons    - list of (horizon name, probability raster path), in time order
+    threshold   - class code whose first reaching is recorded in the change codes
+    scores      - optional {scheme name: .npy path} for the score stacks
+    changes     - optional {scheme name: raster path} for the change-code rasters
+    block_shape - shape of the blocks read from each horizon (default: default_block_shape())
+    Returns (RasterInfo of the horizons, {scheme name: {change code: number of cells}}).
+    """
+    recorder = recorder or NULL_RECORDER
+    block_shape = block_shape or default_block_shape(len(horizons))
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    names = [get_scheme(s).name for s in schemes]
+    if not 0 < len(horizons) <= MAX_HORIZONS:
+        raise ValueError('Expected 1 to %d horizons, got %d' % (MAX_HORIZONS, len(horizons)))
+    for name in names:
+        _check_threshold(get_scheme(name), threshold)
+    scores = dict((get_scheme(s).name, path) for s, path in (scores or {}).items())
+    changes = dict((get_scheme(s).name, path) for s, path in (changes or {}).items())
+    labels = [label for label, _ in horizons]
+    counts = dict((name, collections.Counter()) for name in names)
+    with recorder.stage('horizons', schemes=','.join(names), horizons=len(horizons)) as stage:
+        sources = _open_horizons([path for _, path in horizons], envelope)
+        sinks = []
+        try:
+            info = sources[0].info
+            score_sinks, change_sinks = {}, {}
+            for name in names:
+                scheme = get_scheme(name)
+                if name in scores:
+                    score_sinks[name] = ScoreSink(scores[name], info.replace(nodata=scheme.nodata), labels)
+                    sinks.append(score_sinks[name])
+                if name in changes:
+                    change_sinks[name] = mcfrm_io.open_sink(changes[name], info.replace(nodata=NODATA), CLASS_DTYPE)
+                    sinks.append(change_sinks[name])
+            for window in mcfrm_tiles.iter_windows(info.shape, block_shape):
+                classes = classify_stack(read_stack(sources, window), names)
+                stage.add(cells=len(sources) * window.nrows * window.ncols)
+                for name in names:
+                    codes = first_reaching(classes[name], threshold)
+                    values, n = np.unique(codes, return_counts=True)
+                    for value, count in zip(values.tolist(), n.tolist()):
+                        counts[name][value] += count
+                    if name in score_sinks:
+                        score_sinks[name].write(window, classes[name])
+                    if name in change_sinks:
+                        change_sinks[name].write(window, codes)
+        finally:
+            for sink in sinks:
+                sink.close()
+            for source in sources:
+                source.close()
+    return info, counts
+
+
+def describe_changes(counts, horizons, threshold, cell_area=1.0):
+    """Lines describing the change counts of classify_horizons(), one per change code."""
+    lines = []
+    for name, counter in sorted(counts.items()):
+        lines.append('%s: score >= %d' % (name, threshold))
+        for code, cells in sorted(counter.items()):
+            if code == NODATA:
+                label = 'NoData at every horizon'
+            elif code == BACKGROUND:
+                label = 'never reached'
+            else:
+                label = 'first reached at %s' % horizons[code]
+            lines.append('  %-30s %12d cells %16.1f area' % (label, cells, cells * cell_area))
+    return lines
+
+
+def _horizon_arg(text):
+    if '=' not in text:
+        raise argparse.ArgumentTypeError('expected NAME=PATH, got %r' % text)
+    return tuple(text.split('=', 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify aligned MC-FRM horizon rasters as one band stack.')
+    parser.add_argument('--horizon', type=_horizon_arg, action='append', required=True, metavar='NAME=PATH',
+                        help='horizon name and probability raster, in time order (repeat for each horizon)')
+    parser.add_argument('--scheme', action='append', choices=scheme_names(),
+                        help='classification scheme (may be repeated; default: all schemes)')
+    parser.add_argument('--threshold', type=int, required=True,
+                        help='class code: the change code of a cell is the first horizon its score reaches this')
+    parser.add_argument('--output-dir', default='.', help='directory for the score stacks and change-code rasters')
+    parser.add_argument('--format', choices=['npy', 'tif', 'mcr'], default='mcr',
+                        help='file type of the change-code rasters (default: mcr, the compact format of mcfrm_compact.py)')
+    parser.add_argument('--no-scores', action='store_true', help='write only the change-code rasters')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        help='read the horizons in blocks of this shape (default: %d x %d cells over all the horizons)'
+                             % mcfrm_tiles.DEFAULT_BLOCK_SHAPE)
+    parser.add_argument('--polygons', action='store_true',
+                        help='also vectorize each change-code raster to a GeoJSON file of one multipart polygon per horizon')
+    parser.add_argument('--profile', metavar='REPORT', help='write per-stage timing, memory and counts to this JSON file')
+    args = parser.parse_args(argv)
+    if args.scheme:
+        schemes = [get_scheme(s).name for s in args.scheme]
+        try:
+            for name in schemes:
+                _check_threshold(get_scheme(name), args.threshold)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        # By default, every scheme the threshold is a class code of
+        schemes = []
+        for name in scheme_names():
+            try:
+                _check_threshold(get_scheme(name), args.threshold)
+                schemes.append(name)
+            except ValueError as e:
+                print('Skipping %s: %s' % (name, e))
+        if not schemes:
+            parser.error('Threshold %d is not a class code of any scheme' % args.threshold)
+    labels = [label for label, _ in args.horizon]
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    scores = {} if args.no_scores else dict(
+        (name, os.path.join(args.output_dir, name.lower() + '_scores.npy')) for name in schemes)
+    changes = dict((name, os.path.join(args.output_dir, '%s_first_ge%d.%s' % (name.lower(), args.threshold, args.format)))
+                   for name in schemes)
+    recorder = Recorder() if args.profile else None
+    start = time.time()
+    info, counts = classify_horizons(args.horizon, schemes, args.threshold, scores, changes,
+                                     block_shape=tuple(args.block_size) if args.block_size else None,
+                                     recorder=recorder)
+    print('Classified %d horizons (%s) of %d x %d cells in %.2f s'
+          % (len(labels), ', '.join(labels), info.shape[0], info.shape[1], time.time() - start))
+    for line in describe_changes(counts, labels, args.threshold, info.cell_size[0] * info.cell_size[1]):
+        print(line)
+    for name in schemes:
+        print('Wrote %s' % ', '.join(p for p in (scores.get(name), changes[name]) if p))
+        if args.polygons:
+            codes, change_info = mcfrm_io.read_raster(changes[name], mmap=True)
+            features = mcfrm_vectorize.vectorize(np.asarray(codes), change_info)
+            geojson = os.path.splitext(changes[name])[0] + '.geojson'
+            mcfrm_vectorize.write_geojson(geojson, features, 'first_horizon', change_info.crs)
+            print('Wrote %s' % geojson)
+    if recorder is not None:
+        print(recorder.summary())
+        recorder.write_report(args.profile)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+# mcfrm_incremental.py
+#
+# Incremental re-classification and re-vectorization of a revised MC-FRM probability raster.
+#
+# MC-FRM rasters are revised in patches (a few towns re-modeled at a time). update() keeps, in a
+# state directory per (input, scheme), everything needed to bring the polygons up to date after such
+# a revision without starting from scratch:
+#    * a checksum of the input values of every tile (block of mcfrm_tiles.iter_windows),
+#    * the class raster,
+#    * the boundary segments of every tile (mcfrm_vectorize.extract_edges with a window), and the
+#      ring each segment was linked into,
+#    * the features.
+# On a re-run, only the tiles whose checksums changed are reclassified. Their segments, and those of
+# the tiles below and to the right of them (whose top and left edges border the changed cells), are
+# extracted again. The rings running through those tiles are re-linked from their remaining segments
+# plus the new ones; all other rings are kept as they are. Finally only the classes whose rings
+# changed are re-assembled into features.
+#
+# Rings are linked by a rule local to each vertex, and every ring is brought to a canonical form, so
+# the result is identical to a full rebuild; verify() checks this against the stored class raster.
+# The state is rebuilt from scratch whenever the scheme, the tool version, the block shape or the
+# georeferencing of the input changes.
+#
+# Each update writes its segments, rings and features to a new generation directory, and commits
+# them by rewriting state.json, so an interrupted update leaves the previous state usable.
+#
+#    python mcfrm_incremental.py input.tif --scheme CTPS --state-dir state/ctps --output ctps.geojson
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+import mcfrm_backends
+import mcfrm_io
+import mcfrm_tiles
+import mcfrm_vectorize
+from mcfrm_cache import scheme_definition, tool_version
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import classify, get_scheme
+from mcfrm_vectorize import EdgeSet
+
+
+def _checksum(values):
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()
+
+
+def _load_state(state_dir):
+    path = os.path.join(state_dir, 'state.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(state_dir, state):
+    path = os.path.join(state_dir, 'state.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def _load_topology(path):
+    with np.load(path) as data:
+        edges = EdgeSet(data['codes'], data['r0'], data['c0'], data['r1'], data['c1'])
+        tiles, segment_rings = data['tiles'], data['segment_rings']
+        lengths, vertices = data['ring_lengths'], data['ring_vertices']
+        ring_codes, areas = data['ring_codes'].tolist(), data['ring_areas'].tolist()
+    starts = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    vertices = [tuple(v) for v in vertices.tolist()]
+    rings = [vertices[a:b] for a, b in zip(starts[:-1], starts[1:])]
+    return edges, tiles, segment_rings, ring_codes, rings, areas
+
+
+def _save_topology(path, edges, tiles, segment_rings, ring_codes, rings, areas):
+    vertices = [v for ring in rings for v in ring]
+    np.savez(path, codes=edges.codes, r0=edges.r0, c0=edges.c0, r1=edges.r1, c1=edges.c1,
+             tiles=tiles, segment_rings=segment_rings,
+             ring_codes=np.array(ring_codes, dtype=np.int64), ring_areas=np.array(areas, dtype=np.float64),
+             ring_lengths=np.array([len(ring) for ring in rings], dtype=np.int64),
+             ring_vertices=np.array(vertices, dtype=np.int64).reshape(len(vertices), 2))
+
+
+def _extract(classes, windows, tiles, skip):
+    # Segments owned by the given tiles, and the tile of each segment
+    sets = [mcfrm_vectorize.extract_edges(classes, skip, windows[k]) for k in tiles]
+    edges = EdgeSet.concatenate(sets)
+    return edges, np.repeat(np.asarray(tiles, dtype=np.int64), [len(e) for e in sets])
+
+
+def _neighbours(dirty, windows):
+    # The changed tiles, plus the tiles just below and just to the right of them
+    origins = dict(((w.row, w.col), k) for k, w in enumerate(windows))
+    tiles = set(dirty)
+    for k in dirty:
+        w = windows[k]
+        for key in ((w.row + w.nrows, w.col), (w.row, w.col + w.ncols)):
+            if key in origins:
+                tiles.add(origins[key])
+    return sorted(tiles)
+
+
+def update(input_path, scheme, state_dir, block_shape=mcfrm_tiles.DEFAULT_BLOCK_SHAPE, envelope=None,
+           rebuild=False, log=print, open_source=None):
+    """Bring the polygons of a scheme in state_dir up to date with an input raster.
+
+    input_path  - .npy, GeoTIFF or ArcGIS raster dataset
+    rebuild     - if true, ignore any existing state and rebuild from scratch
+    open_source - callable(path, envelope) opening the input (default: mcfrm_io.open_source)
+
+    Returns (features, changed, info): every Feature, ordered by gridcode; the class codes whose
+    feature changed since the previous update (all of them after a full build); and the RasterInfo
+    of the class raster.
+    """
+    scheme = get_scheme(scheme)
+    skip = (scheme.background, scheme.nodata)
+    os.makedirs(state_dir, exist_ok=True)
+    state = _load_state(state_dir)
+    start = time.time()
+    classes_path = os.path.join(state_dir, 'classes.npy')
+    with (open_source or mcfrm_io.open_source)(input_path, envelope) as source:
+        info = source.info.replace(nodata=scheme.nodata)
+        windows = list(mcfrm_tiles.iter_windows(source.shape, block_shape))
+        header = {'scheme': scheme_definition(scheme), 'tool': tool_version(), 'block_shape': list(block_shape),
+                  'info': info.to_dict()}
+        full = rebuild or state is None or any(state.get(k) != v for k, v in header.items())
+        if full:
+            old_checksums = [None] * len(windows)
+            sink = mcfrm_io.NpySink(classes_path, info, CLASS_DTYPE)
+            classes = sink.array
+        else:
+            old_checksums = state['checksums']
+            classes = np.load(classes_path, mmap_mode='r+')
+        checksums, dirty = [], []
+        for k, window in enumerate(windows):
+            values = source.read(window)
+            checksums.append(_checksum(values))
+            if checksums[k] != old_checksums[k]:
+                classes[window.slices()] = classify(values, scheme, nodata=source.info.nodata)[scheme.name]
+                dirty.append(k)
+        if full:
+            sink.close()
+        else:
+            classes.flush()
+    log('%d of %d tiles changed (%.2f s).' % (len(dirty), len(windows), time.time() - start))
+
+    generation = 0 if full else state['generation']
+    old_dir = os.path.join(state_dir, 'gen-%d' % generation)
+    if not dirty and not full:
+        features = mcfrm_vectorize.load_features(os.path.join(old_dir, 'features.npz'))
+        return features, [], info
+
+    start = time.time()
+    classes = np.load(classes_path, mmap_mode='r')
+    if full:
+        edges, tiles = _extract(classes, windows, range(len(windows)), skip)
+        ring_codes, rings, areas, segment_rings = mcfrm_vectorize.link_rings(edges)
+        changed = sorted(set(ring_codes))
+        old_features = {}
+    else:
+        edges, tiles, segment_rings, ring_codes, rings, areas = _load_topology(os.path.join(old_dir, 'topology.npz'))
+        old_features = dict((f.gridcode, f) for f in
+                            mcfrm_vectorize.load_features(os.path.join(old_dir, 'features.npz')))
+        redo = _neighbours(dirty, windows)
+        stale = np.isin(tiles, redo)
+        affected = np.unique(segment_rings[stale])
+        new_edges, new_tiles = _extract(classes, windows, redo, skip)
+
+        # Re-link the rings running through the re-extracted tiles from their other segments and the
+        # new ones; the other rings are kept, renumbered
+        kept = ~stale
+        relink = kept & np.isin(segment_rings, affected)
+        subset = EdgeSet.concatenate([edges.select(relink), new_edges])
+        sub_codes, sub_rings, sub_areas, sub_segment_rings = mcfrm_vectorize.link_rings(subset)
+        survives = np.ones(len(rings), dtype=bool)
+        survives[affected] = False
+        renumber = np.cumsum(survives) - 1
+        n_kept = int(survives.sum())
+        changed = sorted(set(np.asarray(ring_codes, dtype=np.int64)[affected].tolist()) | set(sub_codes))
+        keep = survives.nonzero()[0].tolist()
+        ring_codes = [ring_codes[k] for k in keep] + sub_codes
+        rings = [rings[k] for k in keep] + sub_rings
+        areas = [areas[k] for k in keep] + sub_areas
+        kept_rings = renumber[segment_rings[kept]]
+        kept_rings[relink[kept]] = sub_segment_rings[:int(relink.sum())] + n_kept
+        segment_rings = np.concatenate([kept_rings, sub_segment_rings[int(relink.sum()):] + n_kept])
+        edges = EdgeSet.concatenate([edges.select(kept), new_edges])
+        tiles = np.concatenate([tiles[kept], new_tiles])
+    log('Re-linked rings of %d class(es) (%.2f s).' % (len(changed), time.time() - start))
+
+    start = time.time()
+    traced = mcfrm_vectorize.group_rings(edges, ring_codes, rings, areas, segment_rings)
+    new_features = mcfrm_vectorize.assemble_features(dict((c, traced[c]) for c in changed if c in traced),
+                                                     classes, info)
+    features = dict((c, f) for c, f in old_features.items() if c not in changed)
+    features.update((f.gridcode, f) for f in new_features)
+    features = [features[c] for c in sorted(features)]
+    del classes
+    log('Assembled %d feature(s) (%.2f s).' % (len(new_features), time.time() - start))
+
+    # Commit: write the new generation, then point state.json at it
+    new_dir = os.path.join(state_dir, 'gen-%d' % (generation + 1))
+    shutil.rmtree(new_dir, ignore_errors=True)
+    os.makedirs(new_dir)
+    _save_topology(os.path.join(new_dir, 'topology.npz'), edges, tiles, segment_rings, ring_codes, rings, areas)
+    mcfrm_vectorize.save_features(os.path.join(new_dir, 'features.npz'), features)
+    header.update({'checksums': checksums, 'generation': generation + 1})
+    _save_state(state_dir, header)
+    if not full:
+        shutil.rmtree(old_dir, ignore_errors=True)
+    return features, changed, info
+
+
+def verify(state_dir):
+    """Check the stored features against a full rebuild from the stored class raster.
+
+    Returns the list of class codes whose features differ; empty when the results are identical.
+    """
+    state = _load_state(state_dir)
+    scheme = get_scheme(state['scheme']['name'])
+    classes, info = mcfrm_io.read_raster(os.path.join(state_dir, 'classes.npy'), mmap=True)
+    full = dict((f.gridcode, f) for f in mcfrm_vectorize.vectorize(classes, info, (scheme.background, scheme.nodata)))
+    stored = dict((f.gridcode, f) for f in mcfrm_vectorize.load_features(
+        os.path.join(state_dir, 'gen-%d' % state['generation'], 'features.npz')))
+    return sorted(c for c in set(full) | set(stored)
+                  if c not in full or c not in stored or not _same_feature(full[c], stored[c]))
+
+
+def _same_feature(a, b):
+    return (len(a.parts) == len(b.parts) and
+            all(len(p) == len(q) and all(np.array_equal(r, s) for r, s in zip(p, q)) for p, q in zip(a.parts, b.parts)))
+
+
+def write_output(output, features, changed, field='gridcode', crs=None):
+    """Write features to a GeoJSON file, a GeoPackage layer or an ArcGIS feature class.
+
+    An existing output is updated in place: only the features of the changed codes are replaced.
+    """
+    mcfrm_backends.backend_for(output).update_features(output, features, changed, field, crs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Incrementally classify and vectorize a revised MC-FRM raster.')
+    parser.add_argument('input', help='input probability raster (.npy or GeoTIFF)')
+    parser.add_argument('--scheme', required=True, help='classification scheme')
+    parser.add_argument('--state-dir', required=True, help='directory holding the state of previous runs')
+    parser.add_argument('--output', help='GeoJSON file, GeoPackage layer (or ArcGIS feature class) to write the polygons to')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        default=mcfrm_tiles.DEFAULT_BLOCK_SHAPE, help='tile shape used for the checksums')
+    parser.add_argument('--rebuild', action='store_true', help='ignore the existing state and rebuild from scratch')
+    parser.add_argument('--verify', action='store_true', help='check the result against a full rebuild')
+    args = parser.parse_args(argv)
+    scheme = get_scheme(args.scheme)
+    features, changed, info = update(args.input, scheme, args.state_dir, tuple(args.block_size), rebuild=args.rebuild)
+    print('Changed classes: %s' % (', '.join(str(c) for c in changed) or 'none'))
+    if args.output and (changed or not mcfrm_backends.backend_for(args.output).features_exist(args.output)):
+        write_output(args.output, features, changed, scheme.score_field or 'gridcode', info.crs)
+    if args.verify:
+        differ = verify(args.state_dir)
+        print('Full rebuild: %s' % ('identical' if not differ else 'classes %s differ' % differ))
+        return 1 if differ else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,277 @@
+# mcfrm_instrument.py
+#
+# Per-stage timing and memory instrumentation of the classification pipeline.
+#
+# A Recorder times the stages of a run (load, classify, vectorize, write, ...), which may be nested:
+#
+#    recorder = Recorder()
+#    with recorder.stage('classify', scheme='CTPS') as stage:
+#        ...
+#        stage.add(cells=array.size)
+#
+# For each stage it records
+#    * wall time and CPU time (of this process, and of the worker processes it waited for),
+#    * peak resident set size: the high-water mark during the stage where the OS lets it be reset
+#      (Linux), otherwise the high-water mark of the process so far ("peak_rss_scope": "process"),
+#    * bytes read and written by the process, where the OS reports them,
+#    * counts supplied by the code: cells, features, vertices, bytes of rasters read or written, ...
+#
+# The records are written as a JSON report (write_report), and as a trace in the Chrome trace event
+# format (write_trace), which chrome://tracing, Perfetto and speedscope show as a flame graph, or as
+# folded stacks for flamegraph.pl (write_folded).
+#
+# psutil is used if it is installed; without it, peak memory and I/O are read from the resource
+# module and /proc where available, and left out otherwise.
+
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def _psutil_process():
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process()
+
+
+_process = _psutil_process()
+
+
+def _peak_rss():
+    # High-water mark of the resident set size of this process, in bytes, or None
+    if _process is not None:
+        mem = _process.memory_info()
+        if hasattr(mem, 'peak_wset'):
+            return mem.peak_wset
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+def _reset_peak_rss():
+    # Reset the high-water mark of the resident set size (Linux only). Returns whether it worked.
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _linux_hwm():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _io_bytes():
+    # (bytes read, bytes written) by this process so far, or (None, None)
+    if _process is not None:
+        try:
+            io = _process.io_counters()
+        except (AttributeError, NotImplementedError):
+            pass
+        else:
+            # On Linux, read_chars/write_chars also count I/O served from the page cache
+            return getattr(io, 'read_chars', io.read_bytes), getattr(io, 'write_chars', io.write_bytes)
+    try:
+        counters = {}
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                counters[key] = int(value)
+        return counters['rchar'], counters['wchar']
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+
+
+def _cpu_times():
+    t = os.times()
+    return t.user + t.system, t.children_user + t.children_system
+
+
+class Stage(object):
+    """Measurements of one stage; code running in the stage adds counts with add()."""
+
+    def __init__(self, name, path, depth, attributes):
+        self.name = name
+        self.path = path
+        self.depth = depth
+        self.attributes = attributes
+        self.counts = {}
+        self.start = self.wall = self.cpu = self.child_cpu = None
+        self.peak_rss = self.peak_rss_scope = None
+        self.read_bytes = self.written_bytes = None
+        self.error = None
+        self._inner_peak = 0      # peak RSS seen by stages nested in this one
+
+    def add(self, **counts):
+        """Add to the stage's counts, e.g. add(cells=n, features=k)."""
+        for key, value in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + int(value)
+
+    def to_dict(self):
+        record = {'name': self.name, 'path': self.path, 'depth': self.depth, 'start_s': round(self.start, 6),
+                  'wall_s': round(self.wall, 6), 'cpu_s': round(self.cpu, 6), 'child_cpu_s': round(self.child_cpu, 6),
+                  'peak_rss_bytes': self.peak_rss, 'peak_rss_scope': self.peak_rss_scope,
+                  'io_read_bytes': self.read_bytes, 'io_write_bytes': self.written_bytes, 'counts': self.counts}
+        if self.attributes:
+            record['attributes'] = self.attributes
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+class _StageContext(object):
+
+    def __init__(self, recorder, name, attributes):
+        self.recorder = recorder
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        rec = self.recorder
+        path = '/'.join([s.name for s in rec._stack] + [self.name])
+        self.stage = Stage(self.name, path, len(rec._stack), self.attributes)
+        # Resetting the high-water mark would lose the enclosing stages' peaks so far: hand them on
+        self._note_peak(rec._stack, _linux_hwm())
+        rec._stack.append(self.stage)
+        self.reset = _reset_peak_rss()
+        self.io = _io_bytes()
+        self.cpu = _cpu_times()
+        self.stage.start = time.perf_counter() - rec._t0
+        return self.stage
+
+    def __exit__(self, kind, value, tb):
+        rec = self.recorder
+        stage = self.stage
+        stage.wall = time.perf_counter() - rec._t0 - stage.start
+        cpu, child_cpu = _cpu_times()
+        stage.cpu, stage.child_cpu = cpu - self.cpu[0], child_cpu - self.cpu[1]
+        if self.reset:
+            stage.peak_rss, stage.peak_rss_scope = _linux_hwm(), 'stage'
+        else:
+            stage.peak_rss, stage.peak_rss_scope = _peak_rss(), 'process'
+        if stage.peak_rss is not None:
+            stage.peak_rss = max(stage.peak_rss, stage._inner_peak)
+        self._note_peak(rec._stack[:-1], stage.peak_rss)
+        read, written = _io_bytes()
+        if read is not None and self.io[0] is not None:
+            stage.read_bytes, stage.written_bytes = read - self.io[0], written - self.io[1]
+        if kind is not None:
+            stage.error = '%s: %s' % (kind.__name__, value)
+        rec._stack.pop()
+        rec.stages.append(stage)
+        return False
+
+    @staticmethod
+    def _note_peak(stages, peak):
+        for stage in stages:
+            stage._inner_peak = max(stage._inner_peak, peak or 0)
+
+
+class Recorder(object):
+    """Records the stages of a run. A disabled recorder records nothing and costs next to nothing."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+        self._started = time.time()
+
+    def stage(self, name, **attributes):
+        """Context manager timing a stage; yields its Stage. Attributes (e.g. scheme='CTPS') are reported."""
+        if not self.enabled:
+            return _NullContext()
+        return _StageContext(self, name, attributes)
+
+    def report(self):
+        """The run's records as a JSON-serializable dict; stages are listed in the order they started."""
+        stages = sorted(self.stages, key=lambda s: (s.start, s.depth))
+        top = [s for s in stages if s.depth == 0]
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started)),
+                'argv': sys.argv, 'python': sys.version.split()[0], 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'total': {'wall_s': round(sum(s.wall for s in top), 6), 'cpu_s': round(sum(s.cpu for s in top), 6),
+                          'child_cpu_s': round(sum(s.child_cpu for s in top), 6),
+                          'peak_rss_bytes': max([s.peak_rss for s in top if s.peak_rss is not None] or [None])},
+                'stages': [s.to_dict() for s in stages]}
+
+    def write_report(self, path):
+        """Write the JSON report."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+    def write_trace(self, path):
+        """Write the stages in the Chrome trace event format (chrome://tracing, Perfetto, speedscope)."""
+        events = []
+        for s in sorted(self.stages, key=lambda s: (s.start, s.depth)):
+            args = dict(s.counts)
+            args.update(s.attributes)
+            args.update({'cpu_s': round(s.cpu, 6), 'peak_rss_bytes': s.peak_rss})
+            events.append({'name': s.name, 'cat': 'mcfrm', 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                           'ts': round(s.start * 1e6, 1), 'dur': round(s.wall * 1e6, 1), 'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def write_folded(self, path):
+        """Write folded stacks ("a;b;c <microseconds>" of self time) for flamegraph.pl."""
+        inner = {}
+        for s in self.stages:
+            parent = s.path.rsplit('/', 1)[0] if '/' in s.path else None
+            if parent is not None:
+                inner[parent] = inner.get(parent, 0) + s.wall
+        totals = {}
+        for s in self.stages:
+            totals[s.path] = totals.get(s.path, 0) + s.wall
+        with open(path, 'w') as f:
+            for path_, wall in sorted(totals.items()):
+                self_time = max(wall - inner.get(path_, 0), 0)
+                f.write('%s %d\n' % (path_.replace('/', ';'), round(self_time * 1e6)))
+
+    def summary(self):
+        """One line per stage: indented name and attributes, wall and CPU seconds, peak RSS and counts."""
+        lines = []
+        for s in sorted(self.stages, key=lambda s: (s.start, s.depth)):
+            peak = '%.0f MB' % (s.peak_rss / 2.0 ** 20) if s.peak_rss is not None else '-'
+            counts = ', '.join('%s=%d' % kv for kv in sorted(s.counts.items()))
+            name = '  ' * s.depth + s.name
+            if s.attributes:
+                name += ' [%s]' % ', '.join(str(v) for k, v in sorted(s.attributes.items()))
+            lines.append('%-40s %9.3f s %9.3f s cpu %9s  %s' % (name, s.wall, s.cpu + s.child_cpu, peak, counts))
+        return '\n'.join(lines)
+
+
+class _NullStage(object):
+
+    def add(self, **counts):
+        pass
+
+
+class _NullContext(object):
+
+    def __enter__(self):
+        return _NullStage()
+
+    def __exit__(self, *exc):
+        return False
+
+
+# Recorder used when none is given: records nothing
+NULL_RECORDER = Recorder(enabled=False)
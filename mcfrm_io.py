@@ -0,0 +1,537 @@
+# mcfrm_io.py
+#
+# Plain-array reading and writing of rasters for the MC-FRM classification tools.
+#
+# Rasters are exchanged as a NumPy array plus a RasterInfo record describing where the array sits
+# on the ground. Four kinds of storage are supported:
+#    * NumPy .npy files, with the georeferencing kept in a "<name>.npy.json" sidecar file
+#    * GeoTIFF files, read and written with rasterio if it is installed, otherwise with GDAL
+#    * ArcGIS raster datasets, read and written with arcpy (ArcGIS installations only)
+#    * compact class raster (.mcr) files, for class rasters only (see mcfrm_compact.py)
+#
+# Neither arcpy, rasterio nor GDAL is imported at module level, so the module (and everything
+# built on it) can be used on machines that have none of them, e.g. Linux workers running
+# the classification engine on .npy inputs.
+
+import json
+import os
+
+import numpy as np
+
+
+class RasterInfo(object):
+    """Georeferencing of a north-up raster.
+
+    x_min, y_max - map coordinates of the upper-left corner of the raster
+    cell_size    - (x, y) size of a cell in map units
+    shape        - (rows, columns)
+    nodata       - NoData value of the raster, or None
+    crs          - coordinate reference system as WKT (or any string understood by the writer), or None
+    """
+
+    def __init__(self, x_min, y_max, cell_size, shape, nodata=None, crs=None):
+        self.x_min = float(x_min)
+        self.y_max = float(y_max)
+        if np.isscalar(cell_size):
+            cell_size = (cell_size, cell_size)
+        self.cell_size = (float(cell_size[0]), float(cell_size[1]))
+        self.shape = (int(shape[0]), int(shape[1]))
+        self.nodata = nodata
+        self.crs = crs
+
+    @property
+    def x_max(self):
+        return self.x_min + self.shape[1] * self.cell_size[0]
+
+    @property
+    def y_min(self):
+        return self.y_max - self.shape[0] * self.cell_size[1]
+
+    def replace(self, **kwargs):
+        """Return a copy of this RasterInfo with the given attributes replaced."""
+        attrs = {'x_min': self.x_min, 'y_max': self.y_max, 'cell_size': self.cell_size,
+                 'shape': self.shape, 'nodata': self.nodata, 'crs': self.crs}
+        attrs.update(kwargs)
+        return RasterInfo(**attrs)
+
+    def to_dict(self):
+        nodata = self.nodata
+        if isinstance(nodata, (float, np.floating)):
+            nodata = 'nan' if np.isnan(nodata) else float(nodata)
+        elif nodata is not None:
+            nodata = int(nodata)
+        return {'x_min': self.x_min, 'y_max': self.y_max, 'cell_size': list(self.cell_size),
+                'shape': list(self.shape), 'nodata': nodata, 'crs': self.crs}
+
+    @classmethod
+    def from_dict(cls, attrs):
+        attrs = dict(attrs)
+        if attrs.get('nodata') == 'nan':
+            attrs['nodata'] = float('nan')
+        return cls(**attrs)
+
+    def __repr__(self):
+        return 'RasterInfo(%s)' % ', '.join('%s=%r' % kv for kv in sorted(self.to_dict().items()))
+
+
+def _is_geotiff(path):
+    return os.path.splitext(path)[1].lower() in ('.tif', '.tiff')
+
+
+def _is_npy(path):
+    return os.path.splitext(path)[1].lower() == '.npy'
+
+
+def _is_mcr(path):
+    return os.path.splitext(path)[1].lower() == '.mcr'
+
+
+def read_raster(path, mmap=False):
+    """Read a single-band raster from a .npy, GeoTIFF or .mcr file.
+
+    Returns (array, info). For .npy inputs without a sidecar file, info is a unit-cell RasterInfo
+    anchored at the origin. With mmap=True a .npy file is memory-mapped rather than read.
+    """
+    if _is_npy(path):
+        array = np.load(path, mmap_mode='r' if mmap else None)
+        sidecar = path + '.json'
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                info = RasterInfo.from_dict(json.load(f))
+        else:
+            info = RasterInfo(0.0, float(array.shape[0]), 1.0, array.shape)
+        return array, info
+    if _is_geotiff(path):
+        return _read_geotiff(path)
+    if _is_mcr(path):
+        import mcfrm_compact
+        return mcfrm_compact.read_class_raster(path)
+    raise ValueError('Unsupported raster file type: ' + path)
+
+
+def write_raster(path, array, info):
+    """Write a single-band raster to a .npy, GeoTIFF or .mcr file."""
+    info = info.replace(shape=array.shape)
+    if _is_npy(path):
+        np.save(path, array)
+        with open(path + '.json', 'w') as f:
+            json.dump(info.to_dict(), f, indent=1)
+        return
+    if _is_geotiff(path):
+        _write_geotiff(path, array, info)
+        return
+    if _is_mcr(path):
+        import mcfrm_compact
+        mcfrm_compact.write_class_raster(path, array, info)
+        return
+    raise ValueError('Unsupported raster file type: ' + path)
+
+
+def _read_geotiff(path):
+    try:
+        import rasterio
+    except ImportError:
+        rasterio = None
+    if rasterio is not None:
+        with rasterio.open(path) as ds:
+            array = ds.read(1)
+            t = ds.transform
+            crs = ds.crs.to_wkt() if ds.crs is not None else None
+            return array, RasterInfo(t.c, t.f, (t.a, -t.e), array.shape, ds.nodata, crs)
+    gdal = _import_gdal()
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    array = band.ReadAsArray()
+    t = ds.GetGeoTransform()
+    crs = ds.GetProjection() or None
+    return array, RasterInfo(t[0], t[3], (t[1], -t[5]), array.shape, band.GetNoDataValue(), crs)
+
+
+def _write_geotiff(path, array, info):
+    try:
+        import rasterio
+    except ImportError:
+        rasterio = None
+    if rasterio is not None:
+        from rasterio.transform import from_origin
+        transform = from_origin(info.x_min, info.y_max, info.cell_size[0], info.cell_size[1])
+        with rasterio.open(path, 'w', driver='GTiff', height=array.shape[0], width=array.shape[1],
+                           count=1, dtype=array.dtype.name, crs=info.crs, transform=transform,
+                           nodata=info.nodata, compress='deflate') as ds:
+            ds.write(array, 1)
+        return
+    gdal = _import_gdal()
+    from osgeo import gdal_array
+    gdal_type = gdal_array.NumericTypeCodeToGDALTypeCode(array.dtype)
+    ds = gdal.GetDriverByName('GTiff').Create(path, array.shape[1], array.shape[0], 1, gdal_type,
+                                               options=['COMPRESS=DEFLATE'])
+    ds.SetGeoTransform((info.x_min, info.cell_size[0], 0.0, info.y_max, 0.0, -info.cell_size[1]))
+    if info.crs:
+        ds.SetProjection(info.crs)
+    band = ds.GetRasterBand(1)
+    if info.nodata is not None:
+        band.SetNoDataValue(float(info.nodata))
+    band.WriteArray(array)
+    ds.FlushCache()
+    ds = None
+
+
+def _import_gdal():
+    try:
+        from osgeo import gdal
+    except ImportError:
+        raise ImportError('Reading or writing GeoTIFF files requires rasterio or GDAL (osgeo) to be installed')
+    gdal.UseExceptions()
+    return gdal
+
+
+#####################
+# ArcGIS raster datasets
+
+def read_arcpy_raster(path, envelope=None):
+    """Read a single-band ArcGIS raster dataset (or raster layer) into a float64 array.
+
+    envelope - optional "x_min y_min x_max y_max" string (as accepted by MakeRasterLayer_management)
+               limiting the area read
+    NoData cells are returned as NaN.
+    """
+    source = ArcpySource(path, envelope)
+    return source.read(), source.info
+
+
+def write_arcpy_raster(path, array, info):
+    """Write an array to an ArcGIS raster dataset with the georeferencing given by info.
+
+    Integer (class) rasters are stored in the smallest integer pixel type holding their values.
+    """
+    import arcpy
+    if np.issubdtype(array.dtype, np.integer):
+        import mcfrm_compact
+        array, nodata = mcfrm_compact.narrow(array, info.nodata)
+        info = info.replace(nodata=nodata)
+    lower_left = arcpy.Point(info.x_min, info.y_max - array.shape[0] * info.cell_size[1])
+    kwargs = {}
+    if info.nodata is not None:
+        kwargs['value_to_nodata'] = info.nodata
+    raster = arcpy.NumPyArrayToRaster(array, lower_left, info.cell_size[0], info.cell_size[1], **kwargs)
+    raster.save(path)
+    if info.crs:
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(info.crs)
+        arcpy.DefineProjection_management(path, sr)
+
+
+#####################
+# Windowed access
+#
+# For rasters too large to hold in memory, a RasterSource reads rectangular windows of a raster on
+# demand, and a RasterSink writes them; see mcfrm_tiles.py. Windows are given in cell (row, column)
+# coordinates relative to the raster's upper-left corner.
+
+class Window(object):
+    """Rectangular block of cells: rows [row, row + nrows), columns [col, col + ncols)."""
+
+    __slots__ = ('row', 'col', 'nrows', 'ncols')
+
+    def __init__(self, row, col, nrows, ncols):
+        self.row, self.col, self.nrows, self.ncols = int(row), int(col), int(nrows), int(ncols)
+
+    @property
+    def shape(self):
+        return (self.nrows, self.ncols)
+
+    def slices(self):
+        return (slice(self.row, self.row + self.nrows), slice(self.col, self.col + self.ncols))
+
+    def __eq__(self, other):
+        return isinstance(other, Window) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        return (self.row, self.col, self.nrows, self.ncols)
+
+    def __repr__(self):
+        return 'Window(%d, %d, %d, %d)' % self.key()
+
+
+class RasterSource(object):
+    """Base class of windowed raster readers; subclasses set self.info and implement read()."""
+
+    info = None
+
+    @property
+    def shape(self):
+        return self.info.shape
+
+    def read(self, window=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RasterSink(object):
+    """Base class of windowed raster writers; subclasses implement write() and, if needed, close()."""
+
+    def write(self, window, array):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArraySource(RasterSource):
+    """Source over an in-memory or memory-mapped array."""
+
+    def __init__(self, array, info=None):
+        self.array = array
+        self.info = info if info is not None else RasterInfo(0.0, float(array.shape[0]), 1.0, array.shape)
+
+    def read(self, window=None):
+        if window is None:
+            return np.asarray(self.array)
+        return np.asarray(self.array[window.slices()])
+
+
+class ArraySink(RasterSink):
+    """Sink into an in-memory array (allocated if not given)."""
+
+    def __init__(self, shape, dtype, array=None):
+        self.array = array if array is not None else np.empty(shape, dtype=dtype)
+
+    def write(self, window, array):
+        self.array[window.slices()] = array
+
+
+class NpySink(ArraySink):
+    """Sink into a memory-mapped .npy file (with a .npy.json georeferencing sidecar)."""
+
+    def __init__(self, path, info, dtype):
+        self.path = path
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=info.shape)
+        ArraySink.__init__(self, info.shape, dtype, array)
+        with open(path + '.json', 'w') as f:
+            json.dump(info.to_dict(), f, indent=1)
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+            self.array = None
+
+
+class GeoTIFFSource(RasterSource):
+    """Windowed reader of a GeoTIFF file (rasterio, or GDAL)."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            import rasterio
+        except ImportError:
+            rasterio = None
+        if rasterio is not None:
+            self._rio = rasterio.open(path)
+            t = self._rio.transform
+            crs = self._rio.crs.to_wkt() if self._rio.crs is not None else None
+            self.info = RasterInfo(t.c, t.f, (t.a, -t.e), self._rio.shape, self._rio.nodata, crs)
+            self._gdal = None
+        else:
+            self._rio = None
+            self._gdal = _import_gdal().Open(path)
+            t = self._gdal.GetGeoTransform()
+            band = self._gdal.GetRasterBand(1)
+            self.info = RasterInfo(t[0], t[3], (t[1], -t[5]), (self._gdal.RasterYSize, self._gdal.RasterXSize),
+                                   band.GetNoDataValue(), self._gdal.GetProjection() or None)
+
+    def read(self, window=None):
+        window = window or Window(0, 0, *self.shape)
+        if self._rio is not None:
+            from rasterio.windows import Window as RioWindow
+            return self._rio.read(1, window=RioWindow(window.col, window.row, window.ncols, window.nrows))
+        return self._gdal.GetRasterBand(1).ReadAsArray(window.col, window.row, window.ncols, window.nrows)
+
+    def close(self):
+        if self._rio is not None:
+            self._rio.close()
+        self._rio = self._gdal = None
+
+
+class GeoTIFFSink(RasterSink):
+    """Windowed writer of a (deflate-compressed) GeoTIFF file (rasterio, or GDAL)."""
+
+    def __init__(self, path, info, dtype):
+        self.path = path
+        dtype = np.dtype(dtype)
+        try:
+            import rasterio
+        except ImportError:
+            rasterio = None
+        if rasterio is not None:
+            from rasterio.transform import from_origin
+            transform = from_origin(info.x_min, info.y_max, info.cell_size[0], info.cell_size[1])
+            self._rio = rasterio.open(path, 'w', driver='GTiff', height=info.shape[0], width=info.shape[1],
+                                      count=1, dtype=dtype.name, crs=info.crs, transform=transform,
+                                      nodata=info.nodata, compress='deflate', tiled=True)
+            self._gdal = None
+        else:
+            gdal = _import_gdal()
+            from osgeo import gdal_array
+            self._rio = None
+            self._gdal = gdal.GetDriverByName('GTiff').Create(
+                path, info.shape[1], info.shape[0], 1, gdal_array.NumericTypeCodeToGDALTypeCode(dtype),
+                options=['COMPRESS=DEFLATE', 'TILED=YES'])
+            self._gdal.SetGeoTransform((info.x_min, info.cell_size[0], 0.0, info.y_max, 0.0, -info.cell_size[1]))
+            if info.crs:
+                self._gdal.SetProjection(info.crs)
+            if info.nodata is not None:
+                self._gdal.GetRasterBand(1).SetNoDataValue(float(info.nodata))
+
+    def write(self, window, array):
+        if self._rio is not None:
+            from rasterio.windows import Window as RioWindow
+            self._rio.write(array, 1, window=RioWindow(window.col, window.row, window.ncols, window.nrows))
+        else:
+            self._gdal.GetRasterBand(1).WriteArray(array, window.col, window.row)
+
+    def close(self):
+        if self._rio is not None:
+            self._rio.close()
+        if self._gdal is not None:
+            self._gdal.FlushCache()
+        self._rio = self._gdal = None
+
+
+class ArcpySource(RasterSource):
+    """Windowed reader of an ArcGIS raster dataset; NoData cells are returned as NaN."""
+
+    def __init__(self, path, envelope=None):
+        import arcpy
+        self.path = path
+        desc = arcpy.Describe(path)
+        cell_w, cell_h = float(desc.meanCellWidth), float(desc.meanCellHeight)
+        extent = desc.extent
+        x_min, y_min, x_max, y_max = extent.XMin, extent.YMin, extent.XMax, extent.YMax
+        if envelope:
+            ex_min, ey_min, ex_max, ey_max = [float(v) for v in envelope.split()]
+            # Snap the envelope outward to the raster's cell grid, and clip it to the raster's extent
+            ox, oy = extent.XMin, extent.YMin
+            x_min = max(ox, ox + np.floor((ex_min - ox) / cell_w) * cell_w)
+            y_min = max(oy, oy + np.floor((ey_min - oy) / cell_h) * cell_h)
+            x_max = min(x_max, ox + np.ceil((ex_max - ox) / cell_w) * cell_w)
+            y_max = min(y_max, oy + np.ceil((ey_max - oy) / cell_h) * cell_h)
+        shape = (int(round((y_max - y_min) / cell_h)), int(round((x_max - x_min) / cell_w)))
+        crs = desc.spatialReference.exportToString() if desc.spatialReference is not None else None
+        self.info = RasterInfo(x_min, y_max, (cell_w, cell_h), shape, float('nan'), crs)
+
+    def read(self, window=None):
+        import arcpy
+        window = window or Window(0, 0, *self.shape)
+        info = self.info
+        lower_left = arcpy.Point(info.x_min + window.col * info.cell_size[0],
+                                 info.y_max - (window.row + window.nrows) * info.cell_size[1])
+        array = arcpy.RasterToNumPyArray(self.path, lower_left, window.ncols, window.nrows, nodata_to_value=np.nan)
+        return array.astype(np.float64, copy=False)
+
+
+class ArcpySink(RasterSink):
+    """Windowed writer of an ArcGIS raster dataset.
+
+    Each window is saved as a small raster in scratch_workspace; on close() the tiles are mosaicked
+    into the output raster dataset and deleted. Integer rasters are mosaicked to the smallest
+    pixel type holding the values written.
+    """
+
+    def __init__(self, path, info, dtype, scratch_workspace='in_memory'):
+        self.path = path
+        self.info = info
+        self.dtype = np.dtype(dtype)
+        self.scratch_workspace = scratch_workspace
+        self._tiles = []
+        self._range = None
+
+    def write(self, window, array):
+        import arcpy
+        info = self.info
+        if np.issubdtype(self.dtype, np.integer):
+            valid = array[array != info.nodata] if info.nodata is not None else array
+            if valid.size:
+                low, high = int(valid.min()), int(valid.max())
+                if self._range is not None:
+                    low, high = min(low, self._range[0]), max(high, self._range[1])
+                self._range = (low, high)
+        lower_left = arcpy.Point(info.x_min + window.col * info.cell_size[0],
+                                 info.y_max - (window.row + window.nrows) * info.cell_size[1])
+        raster = arcpy.NumPyArrayToRaster(array.astype(self.dtype, copy=False), lower_left,
+                                          info.cell_size[0], info.cell_size[1], info.nodata)
+        tile = '%s/tile_%d_%d' % (self.scratch_workspace, window.row, window.col)
+        raster.save(tile)
+        self._tiles.append(tile)
+
+    def close(self):
+        import arcpy
+        if not self._tiles:
+            return
+        out_dir, out_name = os.path.split(self.path.replace('\\', '/'))
+        itemsize = self.dtype.itemsize
+        if self._range is not None:
+            import mcfrm_compact
+            itemsize = min(itemsize, mcfrm_compact.smallest_dtype(*self._range)[0].itemsize)
+        pixel_type = {1: '8_BIT_SIGNED', 2: '16_BIT_SIGNED', 4: '32_BIT_SIGNED'}[itemsize]
+        sr = None
+        if self.info.crs:
+            sr = arcpy.SpatialReference()
+            sr.loadFromString(self.info.crs)
+        arcpy.MosaicToNewRaster_management(self._tiles, out_dir, out_name, sr, pixel_type,
+                                           self.info.cell_size[0], 1, 'FIRST')
+        for tile in self._tiles:
+            arcpy.Delete_management(tile)
+        self._tiles = []
+
+
+def open_source(path, envelope=None):
+    """Open a RasterSource on a .npy file (memory-mapped), a GeoTIFF file, a .mcr file or an ArcGIS raster dataset."""
+    if _is_mcr(path):
+        if envelope:
+            raise ValueError('An envelope can only be given for ArcGIS raster datasets')
+        import mcfrm_compact
+        return mcfrm_compact.ClassRasterSource(path)
+    if _is_npy(path):
+        if envelope:
+            raise ValueError('An envelope can only be given for ArcGIS raster datasets')
+        array, info = read_raster(path, mmap=True)
+        return ArraySource(array, info)
+    if _is_geotiff(path):
+        if envelope:
+            raise ValueError('An envelope can only be given for ArcGIS raster datasets')
+        return GeoTIFFSource(path)
+    return ArcpySource(path, envelope)
+
+
+def open_sink(path, info, dtype):
+    """Open a RasterSink writing a .npy file, a GeoTIFF file, a .mcr file or an ArcGIS raster dataset.
+
+    path may also be an already open RasterSink (e.g. an ArraySink), which is returned as is.
+    """
+    if isinstance(path, RasterSink):
+        return path
+    if _is_npy(path):
+        return NpySink(path, info, dtype)
+    if _is_geotiff(path):
+        return GeoTIFFSink(path, info, dtype)
+    if _is_mcr(path):
+        import mcfrm_compact
+        return mcfrm_compact.ClassRasterSink(path, info, dtype)
+    return ArcpySink(path, info, dtype)
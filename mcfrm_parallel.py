@@ -0,0 +1,91 @@
+# mcfrm_parallel.py
+#
+# Parallel tiled classification across CPU cores.
+#
+# The input raster is split into blocks (see mcfrm_tiles.py) that are classified in a pool of worker
+# processes. Each worker opens the input raster itself, so only the block's window - not its data -
+# is sent to a worker, and only the block's class codes come back. The parent process writes the
+# results to the output sinks in the same row-major block order as the serial path. Classification
+# is deterministic and per-cell, so the output is byte-identical to the serial output.
+#
+# At most 2 x workers blocks are in flight at any time, which bounds memory use of the parent.
+
+import collections
+import concurrent.futures
+import os
+
+import mcfrm_io
+import mcfrm_tiles
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import classify, get_scheme
+
+# Per-process state of a worker: the open input raster and the schemes to apply
+_worker = {}
+
+
+def _init_worker(input_path, envelope, schemes, open_source):
+    _worker['source'] = open_source(input_path, envelope)
+    _worker['schemes'] = schemes
+
+
+def _classify_window(window):
+    source = _worker['source']
+    return classify(source.read(window), _worker['schemes'], nodata=source.info.nodata)
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def classify_parallel(input_path, schemes, outputs, block_shape=mcfrm_tiles.DEFAULT_BLOCK_SHAPE,
+                      workers=None, envelope=None, progress=None, open_source=None):
+    """Classify a raster block by block in a pool of worker processes.
+
+    input_path - .npy, GeoTIFF or ArcGIS raster dataset
+    outputs    - {scheme name: output raster path}, written through mcfrm_io.open_sink
+    workers    - number of worker processes (default: number of CPUs); 1 runs the serial path
+    progress   - optional callable(window, n_done, n_total) called as each block is written
+    open_source - callable(path, envelope) opening the input, in the parent and in every worker
+                 (default: mcfrm_io.open_source); e.g. the open_source method of a storage backend
+
+    Returns the RasterInfo of the input.
+    """
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    workers = workers or default_workers()
+    if workers <= 1:
+        return mcfrm_tiles.classify_file_tiled(input_path, schemes, outputs, block_shape, envelope, progress,
+                                               open_source)
+    open_source = open_source or mcfrm_io.open_source
+    names = [get_scheme(s).name for s in schemes]
+    with open_source(input_path, envelope) as source:
+        info = source.info
+        windows = list(mcfrm_tiles.iter_windows(source.shape, block_shape))
+    sinks = {}
+    try:
+        for name, scheme in zip(schemes, names):
+            sinks[scheme] = mcfrm_io.open_sink(outputs[name], info.replace(nodata=get_scheme(scheme).nodata), CLASS_DTYPE)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(input_path, envelope, names, open_source)) as executor:
+            pending = collections.deque()
+            todo = iter(windows)
+            done = 0
+            for window in todo:
+                pending.append((window, executor.submit(_classify_window, window)))
+                if len(pending) >= 2 * workers:
+                    break
+            while pending:
+                window, future = pending.popleft()
+                classes = future.result()
+                for name, sink in sinks.items():
+                    sink.write(window, classes[name])
+                done += 1
+                if progress is not None:
+                    progress(window, done, len(windows))
+                for window in todo:
+                    pending.append((window, executor.submit(_classify_window, window)))
+                    break
+    finally:
+        for sink in sinks.values():
+            sink.close()
+    return info
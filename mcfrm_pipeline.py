@@ -0,0 +1,544 @@
+# mcfrm_pipeline.py
+#
+# Classification pipeline shared by the CTPS, MBTA and BOS scripts.
+#
+# The input probability raster is read and decoded once, and classified with every requested scheme
+# (see mcfrm_schemes.py) from that single in-memory array. Then, for each scheme, the class raster is
+# written out, and can be polygonized in a single sweep over all classes (see mcfrm_vectorize.py),
+# skipping the background (-1) and NoData cells. In the ArcGIS pipeline the polygons are written to
+# the final feature class, with the "gridcode" field named as the scheme calls for.
+#
+# run() is the full pipeline, reading the input and writing the class rasters and feature classes
+# through a storage backend (see mcfrm_backends.py), whole or block by block: arcpy, or files (.mcr,
+# GeoTIFF, GeoPackage, ...) on machines without ArcGIS. Only the working files of a checkpoint are
+# always local .npy files. run_arcpy() is run() with the arcpy backend, as used by the toolbox scripts. classify_file()
+# is the arcpy-free pipeline (.npy, GeoTIFF or .mcr in, class rasters out), which can also be run from the
+# command line:
+#
+#    python mcfrm_pipeline.py input.tif --scheme CTPS --scheme MBTA --output-dir classified
+#
+# Both take an optional block_shape; when given, the raster is streamed block by block (see
+# mcfrm_tiles.py) instead of being read into memory whole. With workers > 1 the blocks are
+# classified in parallel in a pool of worker processes (see mcfrm_parallel.py). run() can also
+# update its outputs incrementally, redoing only the blocks of a revised input that changed (see
+# mcfrm_incremental.py), or record its progress in a checkpoint, so that a run that failed part way
+# resumes from the first block or stage it had not completed (see mcfrm_checkpoint.py).
+
+import argparse
+import os
+import sys
+import time
+
+import mcfrm_backends
+import mcfrm_cache
+import mcfrm_checkpoint
+import mcfrm_incremental
+import mcfrm_io
+import mcfrm_parallel
+import mcfrm_tiles
+import mcfrm_vectorize
+import mcfrm_zonal
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_instrument import NULL_RECORDER, Recorder
+from mcfrm_schemes import classify, get_scheme, scheme_names
+
+
+def _log_summary(recorder, log):
+    if recorder.enabled:
+        for line in recorder.summary().splitlines():
+            log(line)
+
+
+def _vectorize(scheme, load_classes, cache=None, key=None, log=print, recorder=NULL_RECORDER, tolerance=None,
+               max_vertices=None):
+    # Features of a scheme's class raster, taken from the cache if present; load_classes() returns
+    # the (class raster, RasterInfo) otherwise. key is the cache key of the features, with their
+    # simplification options (see _feature_keys).
+    if cache is not None:
+        with recorder.stage('cache_lookup', scheme=scheme.name):
+            hit = cache.get_features(key)
+        if hit is not None:
+            log('Loaded %s polygons from the cache.' % scheme.name)
+            return hit
+    classes, info = load_classes()
+    with recorder.stage('vectorize', scheme=scheme.name) as stage:
+        with recorder.stage('extract_edges') as sub:
+            edges = mcfrm_vectorize.extract_edges(classes, skip=(scheme.background, scheme.nodata))
+            sub.add(cells=classes.size, segments=len(edges))
+        with recorder.stage('trace_rings') as sub:
+            traced = mcfrm_vectorize.trace_rings(edges)
+            sub.add(rings=sum(len(t.rings) for t in traced.values()))
+        del edges
+        with recorder.stage('assemble') as sub:
+            features = mcfrm_vectorize.assemble_features(traced, classes, info)
+            sub.add(features=len(features), vertices=sum(f.vertex_count() for f in features))
+        if tolerance or max_vertices:
+            start = time.time()
+            with recorder.stage('simplify', tolerance=tolerance or 0, max_vertices=max_vertices or 0) as sub:
+                counts = {}
+                features = mcfrm_vectorize.generalize(features, classes, info, tolerance or 0, max_vertices, counts)
+                sub.add(features=len(features), **counts)
+            log('Simplified %s polygons from %d to %d vertices (%d feature(s)) in %.2f s'
+                % (scheme.name, counts['vertices_in'], counts['vertices'], len(features), time.time() - start))
+        stage.add(cells=classes.size, features=len(features))
+    del classes, traced
+    if cache is not None:
+        with recorder.stage('cache_store', scheme=scheme.name):
+            cache.put_features(key, features, info, scheme.name)
+    return features, info
+
+
+def _feature_keys(cache, keys, tolerance, max_vertices):
+    # Cache keys of the features of each scheme, which depend on their simplification too
+    return dict((name, cache.variant(key, tolerance=tolerance, max_vertices=max_vertices))
+                for name, key in keys.items())
+
+
+def _cached_classes(cache, keys, name, log):
+    classes, info = cache.get_classes(keys[name])
+    log('Loaded %s class raster from the cache.' % name)
+    return classes, info
+
+
+def _uncached(cache, keys, feature_keys, names):
+    # Schemes that must be classified: those with neither class raster nor features in the cache
+    if cache is None:
+        return list(names)
+    return [name for name in names
+            if not (cache.has(feature_keys[name], mcfrm_cache.FEATURES) or cache.has(keys[name], mcfrm_cache.CLASSES))]
+
+
+def _validated(journal, unit, inputs, current):
+    # Whether a unit is recorded as completed from these inputs, and its artifact still has the
+    # recorded checksum; current() returns the checksum of the artifact, and fails if it is missing
+    recorded = journal.get(unit, inputs) if inputs is not None else None
+    if recorded is not None:
+        try:
+            if current() == recorded:
+                return True
+        except Exception:
+            pass
+    journal.forget(unit)
+    return False
+
+
+def _run_checkpointed(input_raster, outputs, backend, workspace, checkpoint_dir, force, envelope, block_shape,
+                      keep_intermediates, tolerance, max_vertices, recorder, log):
+    # run() as units of work recorded in a checkpoint journal, so that an interrupted run resumes
+    # where it stopped (see mcfrm_checkpoint.py)
+    checksum_features = mcfrm_checkpoint.checksum_features
+    block_shape = tuple(block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE)
+    names = sorted(outputs)
+    with backend.open_source(input_raster, envelope) as source:
+        info = source.info
+        header = {'input': input_raster, 'input_key': mcfrm_cache.input_key(input_raster, envelope, by='metadata'),
+                  'schemes': [mcfrm_cache.scheme_definition(name) for name in names],
+                  'tool_version': mcfrm_cache.tool_version(), 'block_shape': block_shape, 'info': info.to_dict(),
+                  'tolerance': tolerance, 'max_vertices': max_vertices}
+        journal = mcfrm_checkpoint.Journal(checkpoint_dir, header, force, log)
+        windows = list(mcfrm_tiles.iter_windows(info.shape, block_shape))
+        tiles = [mcfrm_checkpoint.tile_unit(w) for w in windows]
+        class_info = dict((name, info.replace(nodata=get_scheme(name).nodata)) for name in names)
+        fields = dict((name, get_scheme(name).score_field or 'gridcode') for name in names)
+        features_paths = dict((name, journal.artifact(name.lower() + '_features.npz')) for name in names)
+        class_rasters = {}
+        if keep_intermediates:
+            backend.make_workspace(workspace)
+            class_rasters = dict((name, backend.class_raster_path(workspace, name.lower() + '_classes'))
+                                 for name in names)
+
+        def class_checksums():
+            # Checksum of each class raster, from those of its tiles; None until every tile is classified
+            recorded = [journal.get(unit) for unit in tiles]
+            if any(r is None for r in recorded):
+                return dict((name, None) for name in names)
+            return dict((name, mcfrm_checkpoint.combine(r[name] for r in recorded)) for name in names)
+
+        def load_features(name):
+            return mcfrm_vectorize.load_features(features_paths[name])
+
+        # Validate the completed units, from the outputs back to the tiles they need
+        with recorder.stage('checkpoint_validate'):
+            classes_sums = class_checksums()
+            features_sums = dict((name, journal.get('vectorize ' + name, classes_sums[name])) for name in names)
+            to_write = [name for name in names if not _validated(
+                journal, 'write ' + name, [features_sums[name], outputs[name]],
+                lambda: checksum_features(backend.read_features(outputs[name], fields[name])))]
+            to_save = [name for name in class_rasters if not _validated(
+                journal, 'save ' + name, [classes_sums[name], class_rasters[name]],
+                lambda: mcfrm_checkpoint.checksum_array(backend.read_class_raster(class_rasters[name])[0]))]
+            to_vectorize = [name for name in to_write if not _validated(
+                journal, 'vectorize ' + name, classes_sums[name], lambda: checksum_features(load_features(name)))]
+        if not (to_write or to_save):
+            log('All outputs are complete and valid according to checkpoint %s.' % journal.path)
+        elif journal.units:
+            log('Resuming from checkpoint %s.' % journal.path)
+
+        classes = {}
+        if to_save or to_vectorize:
+            classes = dict((name, mcfrm_checkpoint.open_array(journal.artifact(name.lower() + '_classes.npy'),
+                                                              info.shape, CLASS_DTYPE)) for name in names)
+            with recorder.stage('classify_tiled', schemes=','.join(names), workers=1) as stage:
+                done = 0
+                for n, (window, unit) in enumerate(zip(windows, tiles)):
+                    recorded = journal.get(unit)
+                    if recorded is not None and all(
+                            recorded[name] == mcfrm_checkpoint.checksum_array(classes[name][window.slices()])
+                            for name in names):
+                        done += 1
+                        continue
+                    codes = classify(source.read(window), names, nodata=info.nodata)
+                    for name in names:
+                        classes[name][window.slices()] = codes[name]
+                    journal.record(unit, dict((name, mcfrm_checkpoint.checksum_array(codes[name])) for name in names),
+                                   save=False)
+                    log('Classified block %d of %d.' % (n + 1, len(windows)))
+                for array in classes.values():
+                    array.flush()
+                journal.save()
+                stage.add(cells=sum(w.nrows * w.ncols for w in windows), blocks=len(windows) - done)
+            if done:
+                log('%d of %d block(s) were already classified.' % (done, len(windows)))
+            log('Classified raster with scheme(s): ' + ', '.join(names))
+            classes_sums = class_checksums()
+
+    for name in to_save:
+        with recorder.stage('save_class_raster', scheme=name) as stage:
+            backend.delete(class_rasters[name])
+            backend.write_raster(class_rasters[name], classes[name], class_info[name])
+            stage.add(bytes=classes[name].nbytes)
+        journal.record('save ' + name,
+                       mcfrm_checkpoint.checksum_array(backend.read_class_raster(class_rasters[name])[0]),
+                       [classes_sums[name], class_rasters[name]])
+        log('Saved class raster ' + class_rasters[name] + '.')
+
+    for name in to_write:
+        scheme = get_scheme(name)
+        if name in to_vectorize:
+            features, _ = _vectorize(scheme, lambda: (classes[name], class_info[name]), log=log, recorder=recorder,
+                                     tolerance=tolerance, max_vertices=max_vertices)
+            mcfrm_vectorize.save_features(features_paths[name], features)
+            journal.record('vectorize ' + name, checksum_features(features), classes_sums[name])
+            log('Vectorized %d class(es) for %s.' % (len(features), name))
+        else:
+            features = load_features(name)
+            log('Loaded %s polygons from the checkpoint.' % name)
+        with recorder.stage('write_features', scheme=name) as stage:
+            backend.delete(outputs[name])
+            backend.write_features(outputs[name], features, fields[name], info.crs)
+            stage.add(features=len(features), vertices=sum(f.vertex_count() for f in features))
+        journal.record('write ' + name, checksum_features(backend.read_features(outputs[name], fields[name])),
+                       [checksum_features(features), outputs[name]])
+        log('Generated final output feature class ' + outputs[name] + '.')
+    del classes
+    journal.finish()
+    _log_summary(recorder, log)
+    log('Processing complete.')
+
+
+def run(input_raster, outputs, backend=None, workspace=None, envelope=None, block_shape=None, workers=1,
+        keep_intermediates=False, cache=None, state_dir=None, tolerance=None, max_vertices=None, recorder=None,
+        log=None, checkpoint_dir=None, force=False):
+    """Classify a probability raster and produce one multipart polygon feature class per scheme.
+
+    input_raster - path of the input probability raster (a raster dataset for arcpy; .npy, GeoTIFF or .mcr otherwise)
+    outputs      - {scheme name: final output feature class (a GeoPackage layer or GeoJSON file for the open backend)}
+    backend      - mcfrm_backends.Backend reading the input and writing the outputs (default: ArcpyBackend)
+    workspace    - geodatabase (arcpy) or directory (open backend) for the class rasters, if they are kept
+    envelope     - optional "x_min y_min x_max y_max" string limiting the area processed
+    block_shape  - optional (rows, columns); if given, the raster is classified block by block
+    workers      - number of worker processes classifying blocks in parallel (implies block_shape)
+    keep_intermediates - if true, also save each class raster as "<scheme>_classes" in workspace,
+                   for debugging; otherwise the class rasters are only held in memory, and the final
+                   feature classes are the only datasets written
+    cache        - optional mcfrm_cache.Cache; schemes whose class raster or polygons are cached for
+                   this input are not classified (or vectorized) again
+    state_dir    - optional directory for incremental updates (see mcfrm_incremental.py): only the
+                   blocks of the input that changed since the previous run are reclassified, and only
+                   the features of the classes they affect are replaced in existing feature classes.
+                   The polygons are not simplified, and the blocks are classified serially, so it
+                   cannot be combined with tolerance, max_vertices, cache, workers or keep_intermediates.
+    tolerance    - optional simplification tolerance of the polygons, in map units; neighbouring
+                   polygons keep sharing their boundaries (see mcfrm_vectorize.generalize)
+    max_vertices - optional cap on the vertices of a feature; larger features are split into pieces
+    recorder     - optional mcfrm_instrument.Recorder timing the stages of the run
+    log          - callable logging progress messages (default: the backend's)
+    checkpoint_dir - optional local directory recording the blocks and stages completed, with checksums
+                   of their outputs (see mcfrm_checkpoint.py); a re-run after a failure validates them
+                   and resumes from the first one not completed. Blocks are classified serially, and
+                   cannot be combined with cache or state_dir. It must not contain the outputs or the
+                   workspace; only its "artifacts" subdirectory is ever deleted.
+    force        - with checkpoint_dir, discard the checkpoint and rebuild everything
+    """
+    backend = backend or mcfrm_backends.ArcpyBackend()
+    log = log or backend.log
+    recorder = recorder or NULL_RECORDER
+    if checkpoint_dir is not None:
+        if cache is not None or state_dir is not None or workers != 1:
+            raise ValueError('checkpoint_dir cannot be combined with cache, state_dir or workers')
+        outputs = dict((get_scheme(name).name, fc) for name, fc in outputs.items())
+        mcfrm_checkpoint.check_separate(checkpoint_dir, list(outputs.values()) + [workspace])
+        _run_checkpointed(input_raster, outputs, backend, workspace, checkpoint_dir, force, envelope, block_shape,
+                          keep_intermediates, tolerance, max_vertices, recorder, log)
+        return
+    if state_dir is not None:
+        if tolerance or max_vertices or cache is not None or workers != 1 or keep_intermediates:
+            raise ValueError('state_dir cannot be combined with tolerance, max_vertices, cache, workers or '
+                             'keep_intermediates')
+        for name, final_output_fc in outputs.items():
+            scheme = get_scheme(name)
+            with recorder.stage('incremental_update', scheme=scheme.name) as stage:
+                features, changed, info = mcfrm_incremental.update(
+                    input_raster, scheme, os.path.join(state_dir, scheme.name.lower()),
+                    block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE, envelope, log=log,
+                    open_source=backend.open_source)
+                stage.add(cells=info.shape[0] * info.shape[1], features=len(features), changed_classes=len(changed))
+            if changed:
+                with recorder.stage('write_features', scheme=scheme.name) as stage:
+                    backend.update_features(final_output_fc, features, changed, scheme.score_field or 'gridcode',
+                                            info.crs)
+                    stage.add(features=len(changed))
+            log('Updated %d class(es) of final output feature class %s.' % (len(changed), final_output_fc))
+        _log_summary(recorder, log)
+        log('Processing complete.')
+        return
+    outputs = dict((get_scheme(name).name, fc) for name, fc in outputs.items())
+    keys = dict((name, cache.key(input_raster, name, envelope)) for name in outputs) if cache is not None else {}
+    feature_keys = _feature_keys(cache, keys, tolerance, max_vertices) if cache is not None else {}
+    todo = _uncached(cache, keys, feature_keys, outputs)
+    classes = {}
+    if keep_intermediates and todo:
+        backend.make_workspace(workspace)
+        class_rasters = dict((name, backend.class_raster_path(workspace, name.lower() + '_classes')) for name in todo)
+    if not todo:
+        log('All schemes found in the cache.')
+    elif block_shape is not None or workers != 1:
+        with backend.open_source(input_raster, envelope) as source:
+            info = source.info
+        if keep_intermediates:
+            sinks = dict((name, backend.open_sink(class_rasters[name], info.replace(nodata=get_scheme(name).nodata),
+                                                  CLASS_DTYPE)) for name in todo)
+        else:
+            sinks = dict((name, mcfrm_io.ArraySink(info.shape, CLASS_DTYPE)) for name in todo)
+        with recorder.stage('classify_tiled', schemes=','.join(todo), workers=workers) as stage:
+            info = mcfrm_parallel.classify_parallel(input_raster, todo, sinks,
+                                                    block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE, workers, envelope,
+                                                    progress=lambda w, n, total: log('Classified block %d of %d.'
+                                                                                     % (n, total)),
+                                                    open_source=backend.open_source)
+            stage.add(cells=info.shape[0] * info.shape[1])
+        log('Classified raster with scheme(s): ' + ', '.join(todo))
+        if not keep_intermediates:
+            classes = dict((name, sink.array) for name, sink in sinks.items())
+        del sinks
+    else:
+        with recorder.stage('load') as stage:
+            probability, info = backend.read_raster(input_raster, envelope)
+            stage.add(cells=probability.size, bytes=probability.nbytes)
+        log('Loaded raster.')
+        with recorder.stage('classify', schemes=','.join(todo)) as stage:
+            classes = classify(probability, todo, nodata=info.nodata)
+            stage.add(cells=probability.size)
+        del probability
+        log('Classified raster with scheme(s): ' + ', '.join(todo))
+        if keep_intermediates:
+            for name in todo:
+                with recorder.stage('save_class_raster', scheme=name) as stage:
+                    backend.write_raster(class_rasters[name], classes[name], info.replace(nodata=get_scheme(name).nodata))
+                    stage.add(bytes=classes[name].nbytes)
+                log('Saved class raster ' + class_rasters[name] + '.')
+
+    for name, final_output_fc in outputs.items():
+        scheme = get_scheme(name)
+
+        def load_classes():
+            if name not in todo:
+                with recorder.stage('cache_load_classes', scheme=name):
+                    return _cached_classes(cache, keys, name, log)
+            if name in classes:
+                array = classes.pop(name)
+                class_info = info.replace(nodata=scheme.nodata)
+            else:
+                with recorder.stage('load_class_raster', scheme=name) as stage:
+                    array, class_info = backend.read_class_raster(class_rasters[name])
+                    stage.add(cells=array.size)
+            if cache is not None:
+                with recorder.stage('cache_store', scheme=name):
+                    cache.put_classes(keys[name], array, class_info, name)
+            return array, class_info
+
+        # Multipart polygon feature class: one feature per class, background and NoData skipped
+        features, class_info = _vectorize(scheme, load_classes, cache, feature_keys.get(name), log, recorder,
+                                          tolerance, max_vertices)
+        log('Vectorized %d class(es) for %s.' % (len(features), name))
+        with recorder.stage('write_features', scheme=name) as stage:
+            backend.write_features(final_output_fc, features, scheme.score_field or 'gridcode', class_info.crs)
+            stage.add(features=len(features), vertices=sum(f.vertex_count() for f in features))
+        log('Generated final output feature class ' + final_output_fc + '.')
+    _log_summary(recorder, log)
+    log('Processing complete.')
+
+
+def run_arcpy(input_raster, working_gdb, outputs, envelope=None, block_shape=None, workers=1,
+              keep_intermediates=False, cache=None, state_dir=None, tolerance=None, max_vertices=None, recorder=None,
+              log=None, checkpoint_dir=None, force=False):
+    """Classify an ArcGIS raster dataset and produce one multipart polygon feature class per scheme.
+
+    run() with the arcpy backend, keeping class raster intermediates (if any) in working_gdb.
+    """
+    run(input_raster, outputs, mcfrm_backends.ArcpyBackend(), working_gdb, envelope, block_shape, workers,
+        keep_intermediates, cache, state_dir, tolerance, max_vertices, recorder, log, checkpoint_dir, force)
+
+
+def classify_file(input_path, schemes, output_dir, extension=None, block_shape=None, workers=1, polygons=False,
+                  cache=None, tolerance=None, max_vertices=None, recorder=None, log=print):
+    """Classify a .npy, GeoTIFF or .mcr probability raster with one or more schemes.
+
+    The input is read once, and one class raster per scheme is written to output_dir as
+    "<scheme>_classes<extension>". Returns {scheme name: class raster path}.
+
+    extension    - file type of the class rasters (default: that of the input)
+    block_shape  - optional (rows, columns); if given, the input is streamed block by block
+    workers      - number of worker processes classifying blocks in parallel (None: one per CPU)
+    polygons     - if true, also vectorize each class raster to "<scheme>_polygons.geojson", or to
+                   a GeoPackage, "<scheme>_polygons.gpkg", if polygons is '.gpkg'
+    cache        - optional mcfrm_cache.Cache; class rasters and polygons already computed for this
+                   input are taken from it
+    tolerance    - optional simplification tolerance of the polygons, in map units
+    max_vertices - optional cap on the vertices of a feature (see mcfrm_vectorize.generalize)
+    recorder     - optional mcfrm_instrument.Recorder timing the stages of the run
+    """
+    recorder = recorder or NULL_RECORDER
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    schemes = [get_scheme(s).name for s in schemes]
+    extension = extension or os.path.splitext(input_path)[1]
+    os.makedirs(output_dir, exist_ok=True)
+    paths = dict((name, os.path.join(output_dir, name.lower() + '_classes' + extension)) for name in schemes)
+    keys = dict((name, cache.key(input_path, name)) for name in schemes) if cache is not None else {}
+    feature_keys = _feature_keys(cache, keys, tolerance, max_vertices) if cache is not None else {}
+    start = time.time()
+    todo = schemes
+    if cache is not None:
+        todo = [name for name in schemes if not cache.has(keys[name], mcfrm_cache.CLASSES)]
+        for name in schemes:
+            if name not in todo:
+                with recorder.stage('cache_load_classes', scheme=name):
+                    mcfrm_io.write_raster(paths[name], *_cached_classes(cache, keys, name, log))
+    if todo and (block_shape is not None or workers != 1):
+        with recorder.stage('classify_tiled', schemes=','.join(todo), workers=workers or 0) as stage:
+            info = mcfrm_parallel.classify_parallel(input_path, todo, paths,
+                                                    block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE, workers)
+            stage.add(cells=info.shape[0] * info.shape[1])
+        if cache is not None:
+            for name in todo:
+                with recorder.stage('cache_store', scheme=name):
+                    cache.put_classes(keys[name], *mcfrm_io.read_raster(paths[name], mmap=True), description=name)
+    elif todo:
+        with recorder.stage('load') as stage:
+            probability, info = mcfrm_io.read_raster(input_path)
+            stage.add(cells=probability.size, bytes=probability.nbytes)
+        with recorder.stage('classify', schemes=','.join(todo)) as stage:
+            classes = classify(probability, todo, nodata=info.nodata)
+            stage.add(cells=probability.size)
+        del probability
+        for name, array in classes.items():
+            class_info = info.replace(nodata=get_scheme(name).nodata)
+            with recorder.stage('write_class_raster', scheme=name) as stage:
+                mcfrm_io.write_raster(paths[name], array, class_info)
+                stage.add(bytes=array.nbytes)
+            if cache is not None:
+                with recorder.stage('cache_store', scheme=name):
+                    cache.put_classes(keys[name], array, class_info, name)
+    log('Classified %s with scheme(s) %s in %.2f s' % (input_path, ', '.join(schemes), time.time() - start))
+    if polygons:
+        backend = mcfrm_backends.OpenBackend(feature_extension=polygons if polygons is not True else '.geojson')
+        for name in schemes:
+            start = time.time()
+            scheme = get_scheme(name)
+
+            def load_classes():
+                with recorder.stage('load_class_raster', scheme=name) as stage:
+                    array, info = mcfrm_io.read_raster(paths[name])
+                    stage.add(cells=array.size, bytes=array.nbytes)
+                return array, info
+
+            features, info = _vectorize(scheme, load_classes, cache, feature_keys.get(name), log, recorder,
+                                        tolerance, max_vertices)
+            output = backend.feature_class_path(output_dir, name.lower() + '_polygons')
+            with recorder.stage('write_features', scheme=name) as stage:
+                backend.write_features(output, features, scheme.score_field or 'gridcode', info.crs)
+                stage.add(features=len(features), vertices=sum(f.vertex_count() for f in features),
+                          bytes=os.path.getsize(output))
+            log('Vectorized %s to %s in %.2f s' % (name, output, time.time() - start))
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify an MC-FRM probability raster (.npy, GeoTIFF or .mcr).')
+    parser.add_argument('input', help='input probability raster')
+    parser.add_argument('--scheme', action='append', choices=scheme_names(),
+                        help='classification scheme (may be repeated; default: all schemes)')
+    parser.add_argument('--output-dir', default='.', help='directory for the class rasters')
+    parser.add_argument('--format', choices=['npy', 'tif', 'mcr'],
+                        help='file type of the class rasters (default: that of the input); mcr is the compact '
+                             'tiled format of mcfrm_compact.py')
+    parser.add_argument('--block-size', type=int, nargs=2, metavar=('ROWS', 'COLS'),
+                        help='stream the raster in blocks of this shape instead of reading it whole')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes classifying blocks in parallel (0: one per CPU)')
+    parser.add_argument('--polygons', nargs='?', const='geojson', choices=['geojson', 'gpkg'],
+                        help='also vectorize each class raster to a GeoJSON file (or GeoPackage) of multipart polygons')
+    parser.add_argument('--simplify', type=float, metavar='TOLERANCE',
+                        help='simplify the polygons with this tolerance in map units, keeping shared boundaries')
+    parser.add_argument('--max-vertices', type=int, metavar='N',
+                        help='split polygon features with more than N vertices into several features')
+    parser.add_argument('--cache', nargs='?', const=mcfrm_cache.DEFAULT_DIRECTORY, metavar='DIR',
+                        help='reuse class rasters and polygons cached for this input (default directory: %s)'
+                             % mcfrm_cache.DEFAULT_DIRECTORY)
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='write per-stage timing, memory and counts to this JSON file')
+    parser.add_argument('--trace', metavar='TRACE',
+                        help='write the stages to this file as a flame-graph trace: Chrome trace event format, '
+                             'or folded stacks for flamegraph.pl if the name ends in .folded')
+    parser.add_argument('--zonal', metavar='TABLE',
+                        help='instead of writing class rasters, write the cell count and area of each class to this '
+                             'CSV (or .json) table, per zone if --zone-raster or --zone-polygons is given')
+    parser.add_argument('--zone-raster', help='raster of zone values on the grid of the input')
+    parser.add_argument('--zone-polygons', help='GeoJSON file or feature class of zone polygons')
+    parser.add_argument('--zone-field', help='field of the zone polygons holding the zone (default: feature id)')
+    parser.add_argument('--verify', action='store_true',
+                        help='check that tiled classification matches whole-raster classification, and exit')
+    args = parser.parse_args(argv)
+    schemes = args.scheme or scheme_names()
+    block_shape = tuple(args.block_size) if args.block_size else None
+    if args.verify:
+        with mcfrm_io.open_source(args.input) as source:
+            mismatches = mcfrm_tiles.verify_tiled(source, schemes, block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE)
+        for name, count in sorted(mismatches.items()):
+            print('%s: %s' % (name, 'identical' if count == 0 else '%d cells differ' % count))
+        return 1 if any(mismatches.values()) else 0
+    recorder = Recorder() if args.profile or args.trace else None
+    if args.zonal:
+        rows = mcfrm_zonal.zonal_summary(args.input, schemes, args.zone_raster, args.zone_polygons, args.zone_field,
+                                         block_shape=block_shape or mcfrm_tiles.DEFAULT_BLOCK_SHAPE, recorder=recorder)
+        mcfrm_zonal.write_table(args.zonal, rows)
+        print('Wrote %d rows to %s' % (len(rows), args.zonal))
+    else:
+        classify_file(args.input, schemes, args.output_dir, '.' + args.format if args.format else None,
+                      block_shape=block_shape, workers=args.workers or None,
+                      polygons='.' + args.polygons if args.polygons else False, cache=mcfrm_cache.Cache(args.cache) if args.cache else None,
+                      tolerance=args.simplify, max_vertices=args.max_vertices, recorder=recorder)
+    if recorder is not None:
+        print(recorder.summary())
+        if args.profile:
+            recorder.write_report(args.profile)
+        if args.trace and args.trace.endswith('.folded'):
+            recorder.write_folded(args.trace)
+        elif args.trace:
+            recorder.write_trace(args.trace)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# mcfrm_reclassify.py
+#
+# Single-pass reclassification engine for MC-FRM probability rasters.
+#
+# The original scripts produced one Con() raster per classification level, each of which read the
+# whole probability raster and wrote out a full-size raster that was mostly -1. Here a classification
+# is described by a breakpoint table and every input cell is mapped to its class code in one pass
+# with numpy.searchsorted, producing a single integer class raster.
+#
+# A breakpoint table consists of:
+#    * breaks   - strictly increasing probability breakpoints b[0] < b[1] < ... < b[n-1]
+#    * codes    - n+1 class codes, one for each open interval:
+#                 (-inf, b[0]), (b[0], b[1]), ..., (b[n-1], +inf)
+#    * at_codes - n class codes, one for cells whose value is exactly equal to a breakpoint
+#
+# Keeping a separate code for values that fall exactly on a breakpoint lets the table reproduce
+# any mix of inclusive and exclusive bounds, including the "gaps" of the original Con() expressions
+# (e.g. "> 0.10" for one level but "< 0.10" for the next), without resorting to nextafter() tricks.
+#
+# Nothing in this module depends on arcpy.
+
+import numpy as np
+
+# Class code of cells that fall in none of the classes of a scheme; this is the "-1" of the
+# original Con(<condition>, <level>, -1) expressions.
+BACKGROUND = -1
+
+# Class code of cells that are NoData (or NaN) in the input probability raster.
+NODATA = -9999
+
+# Pixel type of the class raster
+CLASS_DTYPE = np.int16
+
+
+class BreakpointTable(object):
+    """Breakpoints and class codes describing a classification of probability values."""
+
+    def __init__(self, breaks, codes, at_codes=None, background=BACKGROUND, nodata=NODATA):
+        self.breaks = np.asarray(breaks, dtype=np.float64)
+        if self.breaks.ndim != 1:
+            raise ValueError('breaks must be one-dimensional')
+        if self.breaks.size > 1 and not np.all(np.diff(self.breaks) > 0):
+            raise ValueError('breaks must be strictly increasing')
+        self.codes = np.asarray(codes, dtype=CLASS_DTYPE)
+        if self.codes.shape != (self.breaks.size + 1,):
+            raise ValueError('expected %d class codes, got %d' % (self.breaks.size + 1, self.codes.size))
+        if at_codes is None:
+            # Default: lower bounds inclusive, upper bounds exclusive, i.e. [b[i], b[i+1])
+            at_codes = self.codes[1:]
+        self.at_codes = np.asarray(at_codes, dtype=CLASS_DTYPE)
+        if self.at_codes.shape != self.breaks.shape:
+            raise ValueError('expected %d breakpoint codes, got %d' % (self.breaks.size, self.at_codes.size))
+        self.background = background
+        self.nodata = nodata
+
+    def class_codes(self):
+        """Return the sorted distinct class codes produced by this table, excluding background."""
+        all_codes = np.union1d(self.codes, self.at_codes)
+        return [int(c) for c in all_codes if c != self.background]
+
+    def __repr__(self):
+        return 'BreakpointTable(breaks=%s, codes=%s, at_codes=%s)' % (
+            self.breaks.tolist(), self.codes.tolist(), self.at_codes.tolist())
+
+
+def reclassify(values, table, nodata=None, out=None):
+    """Map an array of probability values to class codes according to a BreakpointTable.
+
+    values - array of probabilities (any shape); NaN cells are treated as NoData
+    table  - BreakpointTable
+    nodata - optional input NoData value; cells equal to it are also treated as NoData
+    out    - optional pre-allocated output array of the same shape as values
+
+    Returns an integer array of class codes (CLASS_DTYPE) with table.nodata in NoData cells.
+    """
+    values = np.asarray(values)
+    if out is None:
+        out = np.empty(values.shape, dtype=CLASS_DTYPE)
+    breaks = table.breaks
+    if breaks.size == 0:
+        out[...] = table.codes[0]
+    else:
+        idx = np.searchsorted(breaks, values, side='left')
+        # searchsorted(side='left') places a value equal to b[i] at index i, i.e. in the interval
+        # below b[i]; pick out those cells and give them the breakpoint's own code.
+        on_break = breaks[np.minimum(idx, breaks.size - 1)] == values
+        out[...] = table.codes[idx]
+        out[on_break] = table.at_codes[idx[on_break]]
+    missing = np.isnan(values) if np.issubdtype(values.dtype, np.floating) else None
+    if nodata is not None and not (isinstance(nodata, float) and np.isnan(nodata)):
+        missing = (values == nodata) if missing is None else (missing | (values == nodata))
+    if missing is not None:
+        out[missing] = table.nodata
+    return out
@@ -0,0 +1,332 @@
+# mcfrm_schemes.py
+#
+# Registry of MC-FRM probability classification schemes.
+#
+# Each scheme is described as data: an ordered list of classes, each with a class code, an output
+# name (the name the original scripts gave the class's raster) and the probability bounds of the
+# class, written exactly as in the Con() expression that implemented it, e.g. ">= 0.05 and < 0.10".
+# Where README.md documents different bounds than the scripts implemented, the documented bounds
+# are recorded alongside.
+#
+# A scheme is compiled into a mcfrm_reclassify.BreakpointTable. Compilation also detects the
+# places where the bounds of a scheme do not tile the probability axis: gaps (values that fall in
+# no class and end up as background) and overlaps (values that satisfy more than one class; the
+# class listed first wins). These are reported by boundary_issues(), so the inconsistencies of the
+# original schemes are explicit and can be checked, e.g.:
+#
+#    >>> [str(i) for i in boundary_issues(get_scheme('CTPS'))]
+#    ['gap at 0.1', ...]
+
+import re
+
+import numpy as np
+
+from mcfrm_reclassify import BACKGROUND, NODATA, BreakpointTable, reclassify
+
+_BOUND_RE = re.compile(r'^\s*(>=|<=|>|<)\s*([-+0-9.eE]+)\s*$')
+
+
+class Bounds(object):
+    """Probability interval, lower/upper = None meaning unbounded."""
+
+    def __init__(self, lower=None, lower_inclusive=True, upper=None, upper_inclusive=False):
+        self.lower = lower
+        self.lower_inclusive = lower_inclusive
+        self.upper = upper
+        self.upper_inclusive = upper_inclusive
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a condition such as "> 0.10" or ">= 0.05 and < 0.10"."""
+        bounds = cls()
+        for term in re.split(r'\band\b|&', text):
+            m = _BOUND_RE.match(term)
+            if m is None:
+                raise ValueError('Cannot parse bound %r in %r' % (term, text))
+            op, value = m.group(1), float(m.group(2))
+            if op.startswith('>'):
+                bounds.lower, bounds.lower_inclusive = value, op == '>='
+            else:
+                bounds.upper, bounds.upper_inclusive = value, op == '<='
+        return bounds
+
+    def contains(self, value):
+        if self.lower is not None:
+            if value < self.lower or (value == self.lower and not self.lower_inclusive):
+                return False
+        if self.upper is not None:
+            if value > self.upper or (value == self.upper and not self.upper_inclusive):
+                return False
+        return True
+
+    def endpoints(self):
+        return [v for v in (self.lower, self.upper) if v is not None]
+
+    def __eq__(self, other):
+        return isinstance(other, Bounds) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __str__(self):
+        terms = []
+        if self.lower is not None:
+            terms.append('%s %g' % ('>=' if self.lower_inclusive else '>', self.lower))
+        if self.upper is not None:
+            terms.append('%s %g' % ('<=' if self.upper_inclusive else '<', self.upper))
+        return ' and '.join(terms) or 'any'
+
+
+class ClassDef(object):
+    """One class of a scheme.
+
+    code       - class code (cell value / gridcode)
+    name       - output name for the class, as used by the original scripts
+    bounds     - implemented bounds, as a Bounds or a condition string such as ">= 0.05 and < 0.10"
+    documented - bounds documented in README.md, if they differ from the implemented ones
+    """
+
+    def __init__(self, code, name, bounds, documented=None):
+        self.code = int(code)
+        self.name = name
+        self.bounds = Bounds.parse(bounds) if isinstance(bounds, str) else bounds
+        if isinstance(documented, str):
+            documented = Bounds.parse(documented)
+        self.documented = documented
+
+    def __repr__(self):
+        return 'ClassDef(%d, %r, %r)' % (self.code, self.name, str(self.bounds))
+
+
+class BoundaryIssue(object):
+    """A place where a scheme's class bounds do not tile the probability axis.
+
+    kind   - 'gap' (no class contains the values), 'overlap' (several classes do),
+             or 'documentation' (implemented bounds differ from those in README.md)
+    lower, upper - the affected probability range; lower == upper for a single value
+    codes  - class codes involved
+    """
+
+    def __init__(self, kind, lower, upper, codes):
+        self.kind = kind
+        self.lower = lower
+        self.upper = upper
+        self.codes = tuple(codes)
+
+    def __eq__(self, other):
+        return isinstance(other, BoundaryIssue) and \
+            (self.kind, self.lower, self.upper, self.codes) == (other.kind, other.lower, other.upper, other.codes)
+
+    def __hash__(self):
+        return hash((self.kind, self.lower, self.upper, self.codes))
+
+    def __repr__(self):
+        return 'BoundaryIssue(%r, %r, %r, %r)' % (self.kind, self.lower, self.upper, self.codes)
+
+    def __str__(self):
+        if self.lower == self.upper:
+            where = 'at %g' % self.lower
+        else:
+            where = 'in (%s, %s)' % ('-inf' if self.lower is None else '%g' % self.lower,
+                                     'inf' if self.upper is None else '%g' % self.upper)
+        if self.kind == 'documentation':
+            return 'class %d documented differently from its implementation' % self.codes[0]
+        if self.codes:
+            return '%s %s (classes %s)' % (self.kind, where, ', '.join(str(c) for c in self.codes))
+        return '%s %s' % (self.kind, where)
+
+
+class Scheme(object):
+    """A classification scheme.
+
+    name        - registry key, e.g. 'CTPS'
+    classes     - ClassDefs in priority order: where classes overlap, the first one listed wins
+    description - one-line description
+    score_field - name to give the "gridcode" field in the final output, or None to keep "gridcode"
+    """
+
+    def __init__(self, name, classes, description='', score_field=None,
+                 background=BACKGROUND, nodata=NODATA):
+        self.name = name
+        self.classes = list(classes)
+        self.description = description
+        self.score_field = score_field
+        self.background = background
+        self.nodata = nodata
+        codes = [c.code for c in self.classes]
+        if len(set(codes)) != len(codes):
+            raise ValueError('Scheme %s has duplicate class codes' % name)
+        if background in codes or nodata in codes:
+            raise ValueError('Scheme %s uses the background or NoData code as a class code' % name)
+        self._table = None
+
+    def class_codes(self):
+        return [c.code for c in self.classes]
+
+    def class_by_code(self, code):
+        for c in self.classes:
+            if c.code == code:
+                return c
+        raise KeyError(code)
+
+    def classify_value(self, value):
+        """Reference (scalar) classification of one probability value."""
+        for c in self.classes:
+            if c.bounds.contains(value):
+                return c.code
+        return self.background
+
+    def compile(self):
+        """Compile the scheme into a BreakpointTable (cached)."""
+        if self._table is None:
+            breaks, test_points = _sample_points(self)
+            codes = [self.classify_value(v) for v in test_points]
+            at_codes = [self.classify_value(v) for v in breaks]
+            self._table = BreakpointTable(breaks, codes, at_codes, background=self.background, nodata=self.nodata)
+        return self._table
+
+    def __repr__(self):
+        return 'Scheme(%r, %r)' % (self.name, self.classes)
+
+
+def _sample_points(scheme):
+    # Breakpoints of the scheme, and one representative value inside each open interval between them
+    breaks = sorted(set(v for c in scheme.classes for v in c.bounds.endpoints()))
+    return breaks, _interval_points(breaks)
+
+
+def _interval_points(breaks):
+    # One representative value inside each of the intervals (-inf, b[0]), (b[0], b[1]), ..., (b[n-1], inf)
+    if not breaks:
+        return [0.0]
+    return [breaks[0] - 1.0] + [(lo + hi) / 2.0 for lo, hi in zip(breaks[:-1], breaks[1:])] + [breaks[-1] + 1.0]
+
+
+def boundary_issues(scheme):
+    """Return the gaps, overlaps and documentation discrepancies of a scheme's class bounds."""
+    issues = []
+    breaks, points = _sample_points(scheme)
+    ranges = [(None, breaks[0] if breaks else None)]
+    ranges += list(zip(breaks[:-1], breaks[1:]))
+    if breaks:
+        ranges.append((breaks[-1], None))
+    # Walk the axis in increasing order: interval, breakpoint, interval, ..., interval
+    for i, (lo, hi) in enumerate(ranges):
+        issues.extend(_issues_at(scheme, points[i], lo, hi))
+        if i < len(breaks):
+            issues.extend(_issues_at(scheme, breaks[i], breaks[i], breaks[i]))
+    for c in scheme.classes:
+        if c.documented is not None and c.documented != c.bounds:
+            issues.append(BoundaryIssue('documentation', c.bounds.lower, c.bounds.upper, [c.code]))
+    return issues
+
+
+def _issues_at(scheme, value, lo, hi):
+    codes = [c.code for c in scheme.classes if c.bounds.contains(value)]
+    if not codes:
+        return [BoundaryIssue('gap', lo, hi, [])]
+    if len(codes) > 1:
+        return [BoundaryIssue('overlap', lo, hi, codes)]
+    return []
+
+
+#####################
+# Registry
+
+SCHEMES = {}
+
+
+def register_scheme(scheme, replace=False):
+    """Add a Scheme to the registry."""
+    if scheme.name in SCHEMES and not replace:
+        raise ValueError('A scheme named %s is already registered' % scheme.name)
+    SCHEMES[scheme.name] = scheme
+    return scheme
+
+
+def get_scheme(name):
+    """Look up a registered scheme by (case-insensitive) name."""
+    if isinstance(name, Scheme):
+        return name
+    for key, scheme in SCHEMES.items():
+        if key.upper() == name.upper():
+            return scheme
+    raise KeyError('Unknown classification scheme %r; known schemes are %s' % (name, ', '.join(sorted(SCHEMES))))
+
+
+def scheme_names():
+    return sorted(SCHEMES)
+
+
+# CTPS 7-level classification for the LRTP Needs Assessment (CTPS_classification.py)
+register_scheme(Scheme('CTPS', [
+    ClassDef(7, 'p_gt_10_pct',     '> 0.10'),
+    ClassDef(6, 'p_5_10_pct',      '>= 0.05 and < 0.10'),
+    ClassDef(5, 'p_2_5_pct',       '>= 0.02 and < 0.05'),
+    ClassDef(4, 'p_1_2_pct',       '>= 0.01 and < 0.02'),
+    ClassDef(3, 'p_0d2_1_pct',     '>= 0.002 and < 0.01'),
+    ClassDef(2, 'p_0d1_0d2_pct',   '>= 0.001 and < 0.002'),
+    ClassDef(1, 'p_lt_0d1_pct',    '< 0.001'),
+], description='7-level classification for the LRTP Needs Assessment', score_field='score'))
+
+# MBTA classification (MBTA_classification.py)
+register_scheme(Scheme('MBTA', [
+    ClassDef(4, 'p_ge_10_pct',     '> 0.10', documented='>= 0.10'),
+    ClassDef(3, 'p_1_10_pct',      '>= 0.01 and < 0.10'),
+    ClassDef(2, 'p_0d2_1_pct',     '>= 0.002 and < 0.01'),
+    ClassDef(1, 'p_0d1_0d2_pct',   '>= 0.001 and < 0.002'),
+    ClassDef(0, 'p_le_0d1_pct',    '<= 0.001'),
+], description='Classification used by the MBTA'))
+
+# City of Boston classification (BOS_classification.py)
+register_scheme(Scheme('BOS', [
+    ClassDef(4, 'p_ge_5_pct',      '> 0.05', documented='>= 0.05'),
+    ClassDef(3, 'p_2_5_pct',       '>= 0.02 and < 0.05'),
+    ClassDef(2, 'p_1_2_pct',       '>= 0.01 and < 0.02'),
+    ClassDef(1, 'p_0d2_1_pct',     '>= 0.002 and < 0.01'),
+    ClassDef(0, 'p_0d1_0d2_pct',   '>= 0.001 and < 0.002', documented='>= 0.001 and < 0.001'),
+], description='Classification used by the City of Boston'))
+
+
+#####################
+# Classifying with several schemes at once
+
+def classify(values, schemes, nodata=None):
+    """Classify an array of probabilities with one or more schemes in a single pass.
+
+    values  - array of probabilities
+    schemes - scheme name or Scheme, or a list of them
+    nodata  - optional input NoData value (NaN cells are always treated as NoData)
+
+    The breakpoints of all the schemes are merged, so the probabilities are searched only once;
+    each scheme's class array is then a table lookup. Returns {scheme name: class array}.
+    """
+    if isinstance(schemes, (str, Scheme)):
+        schemes = [schemes]
+    schemes = [get_scheme(s) for s in schemes]
+    values = np.asarray(values)
+    breaks = sorted(set(float(b) for s in schemes for b in s.compile().breaks))
+    idx = np.searchsorted(breaks, values, side='left') if breaks else np.zeros(values.shape, dtype=np.intp)
+    on_break = None
+    if breaks:
+        on_break = np.asarray(breaks)[np.minimum(idx, len(breaks) - 1)] == values
+        on_break_idx = idx[on_break]
+    missing = np.isnan(values) if np.issubdtype(values.dtype, np.floating) else np.zeros(values.shape, dtype=bool)
+    if nodata is not None and not (isinstance(nodata, float) and np.isnan(nodata)):
+        missing |= values == nodata
+    results = {}
+    for s in schemes:
+        table = s.compile()
+        # Re-express the scheme's table on the merged breakpoints
+        codes = reclassify(np.array(_interval_points(breaks)), table)
+        at_codes = reclassify(np.array(breaks, dtype=np.float64), table)
+        out = codes[idx]
+        if on_break is not None:
+            out[on_break] = at_codes[on_break_idx]
+        out[missing] = table.nodata
+        results[s.name] = out
+    return results
+
@@ -0,0 +1,95 @@
+# mcfrm_tiles.py
+#
+# Tiled, streaming classification of rasters larger than memory.
+#
+# The input raster is walked in fixed-size blocks ("tiles"); each block is read from a
+# mcfrm_io.RasterSource, classified with every requested scheme, and written straight to one
+# mcfrm_io.RasterSink per scheme. Peak memory is therefore bounded by the block shape, not by
+# the extent of the raster: roughly one block of input values plus one block of class codes per
+# scheme.
+#
+# Classification is purely per-cell, so the tiled result is identical to classifying the whole
+# raster at once; verify_tiled() checks this on a given input.
+
+import numpy as np
+
+import mcfrm_io
+from mcfrm_io import Window
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import classify, get_scheme
+
+# Default block shape (rows, columns): 8 MB of float64 input per block
+DEFAULT_BLOCK_SHAPE = (1024, 1024)
+
+
+def iter_windows(shape, block_shape=DEFAULT_BLOCK_SHAPE):
+    """Yield the Windows tiling a raster of the given shape, in row-major order.
+
+    Blocks along the bottom and right edges are truncated to the raster.
+    """
+    rows, cols = shape
+    block_rows, block_cols = block_shape
+    if block_rows <= 0 or block_cols <= 0:
+        raise ValueError('Block shape must be positive, got %r' % (block_shape,))
+    for row in range(0, rows, block_rows):
+        for col in range(0, cols, block_cols):
+            yield Window(row, col, min(block_rows, rows - row), min(block_cols, cols - col))
+
+
+def classify_tiled(source, sinks, block_shape=DEFAULT_BLOCK_SHAPE, progress=None):
+    """Classify a RasterSource block by block into one RasterSink per scheme.
+
+    source   - mcfrm_io.RasterSource
+    sinks    - {scheme name: mcfrm_io.RasterSink}
+    progress - optional callable(window, n_done, n_total) called after each block
+
+    Returns the number of blocks processed.
+    """
+    windows = list(iter_windows(source.shape, block_shape))
+    nodata = source.info.nodata
+    for n, window in enumerate(windows):
+        classes = classify(source.read(window), list(sinks), nodata=nodata)
+        for name, sink in sinks.items():
+            sink.write(window, classes[get_scheme(name).name])
+        if progress is not None:
+            progress(window, n + 1, len(windows))
+    return len(windows)
+
+
+def classify_file_tiled(input_path, schemes, outputs, block_shape=DEFAULT_BLOCK_SHAPE, envelope=None, progress=None,
+                        open_source=None):
+    """Classify a raster (.npy, GeoTIFF or ArcGIS raster dataset) block by block.
+
+    outputs     - {scheme name: output raster path}; each output is written through mcfrm_io.open_sink
+    open_source - callable(path, envelope) opening the input (default: mcfrm_io.open_source)
+    Returns the RasterInfo of the input.
+    """
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    with (open_source or mcfrm_io.open_source)(input_path, envelope) as source:
+        sinks = {}
+        try:
+            for name in schemes:
+                scheme = get_scheme(name)
+                info = source.info.replace(nodata=scheme.nodata)
+                sinks[scheme.name] = mcfrm_io.open_sink(outputs[name], info, CLASS_DTYPE)
+            classify_tiled(source, sinks, block_shape, progress)
+        finally:
+            for sink in sinks.values():
+                sink.close()
+        return source.info
+
+
+def verify_tiled(source, schemes, block_shape=DEFAULT_BLOCK_SHAPE):
+    """Check that tiled classification of a source matches classifying the whole raster at once.
+
+    Reads the whole raster, so use it on inputs (or subsets) that fit in memory.
+    Returns {scheme name: number of differing cells}; all zero when the results are identical.
+    """
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    names = [get_scheme(s).name for s in schemes]
+    sinks = dict((name, mcfrm_io.ArraySink(source.shape, CLASS_DTYPE)) for name in names)
+    classify_tiled(source, sinks, block_shape)
+    whole = classify(source.read(), names, nodata=source.info.nodata)
+    return dict((name, int(np.count_nonzero(sinks[name].array != whole[name]))) for name in names)
@@ -0,0 +1,903 @@
+# mcfrm_vectorize.py
+#
+# Raster-to-polygon conversion of a class raster, producing every class in one sweep.
+#
+# The original scripts ran RasterToPolygon once per class on a raster that was mostly -1, so the
+# huge background polygon was traced 5 to 7 times and then thrown away by Select_analysis. Here the
+# class raster is vectorized once:
+#
+#    1. extract_edges() finds, with NumPy, every cell edge separating two different class codes
+#       and merges straight runs of such edges into segments. Each segment is recorded for the class
+#       on either side of it - except the background and NoData codes, which are skipped entirely.
+#       Segments are directed so that the class lies to their right.
+#    2. trace_rings() links each class's segments into closed rings. Exterior rings come out
+#       clockwise and holes counter-clockwise (the ArcGIS convention). Where two cells of a class
+#       touch only at a corner, the ring turns toward the class, so such cells become separate
+#       parts touching at a point.
+#    3. assemble_features() assigns each hole to the exterior ring of its region, and dissolves each
+#       class into a single multipart Feature whose gridcode is the class code, as RasterToPolygon
+#       does with create_multipart_features="MULTIPLE_OUTER_PART".
+#    4. Optionally, generalize() simplifies the features and caps their vertex counts.
+#
+# Rings are returned in a canonical form (starting at their lowest row/column vertex, with no
+# collinear vertices; parts and holes sorted), so equal rasters always give identical output.
+#
+# Cell-edge boundaries make staircase polygons with as many vertices as boundary cells, which slows
+# every later overlay, merge and map. Simplifying each polygon on its own (RasterToPolygon's
+# "SIMPLIFY") would open gaps and slivers between neighbouring classes, so generalize() simplifies
+# the boundaries once for both sides: they are cut into arcs at the nodes, the vertices where three
+# or more regions meet (background and NoData counting as one region), and each arc is simplified
+# with Douglas-Peucker, its end nodes fixed, and used by the polygons on both of its sides. The
+# result is then checked: where simplified arcs cross or touch, a ring collapses or flips, or a
+# simplified segment jumps over another ring, the arcs at fault are simplified again with half the
+# tolerance, until the topology of the original is kept. The vertex cap splits a feature with too
+# many vertices by halving the window of the raster it covers, recursively; the seams are boundaries
+# like any other, so the pieces of a feature still fit their neighbours exactly.
+#
+# Features can be written to GeoJSON (no dependencies) or to an ArcGIS feature class, and saved to
+# and reloaded from a NumPy .npz file.
+
+import json
+import os
+
+import numpy as np
+
+from mcfrm_io import Window
+from mcfrm_reclassify import BACKGROUND, NODATA
+
+# Value used for the cells just outside the raster
+_OUTSIDE = np.iinfo(np.int32).min
+
+
+class Feature(object):
+    """A multipart polygon feature.
+
+    gridcode - class code
+    parts    - list of polygons; each polygon is a list of rings (exterior first, then holes),
+               and each ring an (n, 2) float array of closed (x, y) map coordinates
+    """
+
+    def __init__(self, gridcode, parts):
+        self.gridcode = int(gridcode)
+        self.parts = parts
+
+    def vertex_count(self):
+        return sum(len(ring) for part in self.parts for ring in part)
+
+    def ring_count(self):
+        return sum(len(part) for part in self.parts)
+
+    def area(self):
+        # Exterior rings are clockwise (negative signed area), holes counter-clockwise
+        return -sum(_signed_area(ring) for part in self.parts for ring in part)
+
+    def __repr__(self):
+        return 'Feature(gridcode=%d, parts=%d, vertices=%d)' % (self.gridcode, len(self.parts), self.vertex_count())
+
+
+def _signed_area(ring):
+    # Shoelace formula; positive for counter-clockwise rings in map coordinates
+    x, y = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1]))
+
+
+#####################
+# 1. Edge extraction
+
+class EdgeSet(object):
+    """Directed boundary segments, in (row, column) vertex coordinates, with the class on their right.
+
+    codes          - class code of each segment
+    r0, c0, r1, c1 - start and end vertex of each segment
+    """
+
+    def __init__(self, codes, r0, c0, r1, c1):
+        self.codes = codes
+        self.r0, self.c0, self.r1, self.c1 = r0, c0, r1, c1
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def concatenate(cls, edge_sets):
+        edge_sets = list(edge_sets)
+        if not edge_sets:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(empty, empty, empty, empty, empty)
+        return cls(*[np.concatenate([getattr(e, a) for e in edge_sets]) for a in ('codes', 'r0', 'c0', 'r1', 'c1')])
+
+    def select(self, mask):
+        return EdgeSet(self.codes[mask], self.r0[mask], self.c0[mask], self.r1[mask], self.c1[mask])
+
+
+def _runs(a, b, keep):
+    # Start and (exclusive) end positions, along the last axis, of runs of consecutive True values
+    # of keep over which the pair (a, b) is constant. Returns flat (row, start, end) arrays.
+    linked = np.zeros(keep.shape, dtype=bool)   # position continues the run of the previous one
+    linked[:, 1:] = keep[:, :-1] & keep[:, 1:] & (a[:, 1:] == a[:, :-1]) & (b[:, 1:] == b[:, :-1])
+    linked_next = np.zeros(keep.shape, dtype=bool)
+    linked_next[:, :-1] = linked[:, 1:]
+    starts = np.nonzero(keep & ~linked)
+    ends = np.nonzero(keep & ~linked_next)
+    return starts[0], starts[1], ends[1] + 1
+
+
+def extract_edges(classes, skip=(BACKGROUND, NODATA), window=None):
+    """Find the boundary segments of every class in a class raster.
+
+    classes - 2-d integer array of class codes
+    skip    - codes that are not vectorized (background and NoData)
+    window  - optional mcfrm_io.Window; if given, only the edges owned by the window's cells are
+              found: the top and left edge of each cell, plus the bottom and right edges of cells on
+              the bottom and right border of the raster. The edges of a set of windows tiling the
+              raster are then exactly those of the whole raster, with segments split at the seams.
+
+    Returns an EdgeSet, in the vertex coordinates of the whole raster.
+    """
+    rows, cols = np.shape(classes)
+    if window is None:
+        r0, c0, r1, c1 = 0, 0, rows, cols
+    else:
+        r0, c0 = window.row, window.col
+        r1, c1 = r0 + window.nrows, c0 + window.ncols
+    # padded[i, j] is cell (r0 - 1 + i, c0 - 1 + j): the window plus a one-cell halo
+    padded = np.full((r1 - r0 + 2, c1 - c0 + 2), _OUTSIDE, dtype=np.int64)
+    hr0, hc0, hr1, hc1 = max(r0 - 1, 0), max(c0 - 1, 0), min(r1 + 1, rows), min(c1 + 1, cols)
+    padded[hr0 - r0 + 1:hr1 - r0 + 1, hc0 - c0 + 1:hc1 - c0 + 1] = classes[hr0:hr1, hc0:hc1]
+    skipped = list(skip) + [_OUTSIDE]
+    sets = []
+
+    # Horizontal boundaries along vertex row r, between cell row r-1 (above) and r (below)
+    n = r1 - r0 + (1 if r1 == rows else 0)
+    above, below = padded[:n, 1:-1], padded[1:n + 1, 1:-1]
+    differ = above != below
+    for cls, other, eastward in ((below, above, True), (above, below, False)):
+        keep = differ & ~np.isin(cls, skipped)
+        r, start, end = _runs(cls, other, keep)
+        code = cls[r, start]
+        r, start, end = r + r0, start + c0, end + c0
+        if eastward:
+            sets.append(EdgeSet(code, r, start, r, end))
+        else:
+            sets.append(EdgeSet(code, r, end, r, start))
+
+    # Vertical boundaries along vertex column c, between cell column c-1 (left) and c (right);
+    # runs are found along the transposed arrays
+    n = c1 - c0 + (1 if c1 == cols else 0)
+    left, right = padded[1:-1, :n].T, padded[1:-1, 1:n + 1].T
+    differ = left != right
+    for cls, other, southward in ((left, right, True), (right, left, False)):
+        keep = differ & ~np.isin(cls, skipped)
+        c, start, end = _runs(cls, other, keep)
+        code = cls[c, start]
+        c, start, end = c + c0, start + r0, end + r0
+        if southward:
+            sets.append(EdgeSet(code, start, c, end, c))
+        else:
+            sets.append(EdgeSet(code, end, c, start, c))
+    return EdgeSet.concatenate(sets)
+
+
+#####################
+# 2. Ring tracing
+
+class TracedClass(object):
+    """The rings of one class, as traced from its segments.
+
+    rings - list of rings, each a list of (row, column) vertex tuples (closed: first == last), with
+            collinear vertices removed and starting at its lowest (row, column) vertex
+    areas - signed area of each ring in cells; negative for exterior rings, positive for holes
+    tops  - (row, start column, end column, ring index) arrays of the eastward segments, i.e. those
+            with the class below them, sorted by row and start column; used to nest holes
+    """
+
+    def __init__(self, rings, areas, tops):
+        self.rings = rings
+        self.areas = areas
+        self.tops = tops
+
+
+def link_rings(edges):
+    """Link directed segments into closed rings.
+
+    Returns (codes, rings, areas, segment_rings): the class code, vertices and signed area of each
+    ring (see TracedClass), and an array giving the index of the ring of each segment.
+    """
+    codes, rings, areas = [], [], []
+    segment_rings = np.full(len(edges), -1, dtype=np.int64)
+    for code in np.unique(edges.codes).tolist():
+        index = np.nonzero(edges.codes == code)[0]
+        sel = edges.select(index)
+        class_rings, class_areas, seg_ring = _trace_class(sel.r0.tolist(), sel.c0.tolist(),
+                                                          sel.r1.tolist(), sel.c1.tolist())
+        segment_rings[index] = np.asarray(seg_ring, dtype=np.int64) + len(rings)
+        codes.extend([code] * len(class_rings))
+        rings.extend(class_rings)
+        areas.extend(class_areas)
+    return codes, rings, areas, segment_rings
+
+
+def group_rings(edges, codes, rings, areas, segment_rings):
+    """Group linked rings by class. Takes the segments and the output of link_rings() for them.
+
+    Returns {class code: TracedClass}.
+    """
+    traced = {}
+    codes = np.asarray(codes, dtype=np.int64)
+    local = np.zeros(len(rings), dtype=np.int64)   # index of each ring among those of its class
+    for code in np.unique(codes).tolist():
+        members = np.nonzero(codes == code)[0]
+        local[members] = np.arange(len(members))
+        east = (edges.codes == code) & (edges.r0 == edges.r1) & (edges.c1 > edges.c0)
+        r0, c0, c1 = edges.r0[east], edges.c0[east], edges.c1[east]
+        order = np.lexsort((c0, r0))
+        tops = (r0[order], c0[order], c1[order], local[segment_rings[east][order]])
+        traced[code] = TracedClass([rings[k] for k in members.tolist()], [areas[k] for k in members.tolist()], tops)
+    return traced
+
+
+def trace_rings(edges):
+    """Link directed segments into closed rings, per class. Returns {class code: TracedClass}."""
+    return group_rings(edges, *link_rings(edges))
+
+
+def _trace_class(r0, c0, r1, c1):
+    outgoing = {}
+    for i, start in enumerate(zip(r0, c0)):
+        outgoing.setdefault(start, []).append(i)
+    used = [False] * len(r0)
+    seg_ring = [-1] * len(r0)
+    rings, areas = [], []
+    for first in range(len(r0)):
+        if used[first]:
+            continue
+        start = (r0[first], c0[first])
+        ring = [start]
+        i = first
+        while True:
+            used[i] = True
+            seg_ring[i] = len(rings)
+            end = (r1[i], c1[i])
+            ring.append(end)
+            outs = outgoing[end]
+            if len(outs) == 1:
+                i = outs[0]
+            else:
+                candidates = [j for j in outs if not used[j] or j == first and end == start]
+                if len(candidates) > 1:
+                    # Two cells of the class touch at this vertex only diagonally: turn toward the
+                    # class (right), so that each becomes a separate ring
+                    dr, dc = _sign(r1[i] - r0[i]), _sign(c1[i] - c0[i])
+                    candidates.sort(key=lambda j: _turn(dr, dc, _sign(r1[j] - r0[j]), _sign(c1[j] - c0[j])))
+                i = candidates[0]
+            if i == first:
+                break
+        ring, area = _canonical_ring(ring)
+        rings.append(ring)
+        areas.append(area)
+    return rings, areas, seg_ring
+
+
+def _sign(v):
+    return (v > 0) - (v < 0)
+
+
+def _turn(dr, dc, dr2, dc2):
+    # z-component of the cross product of two directions in map coordinates (x = column, y = -row):
+    # negative for a right turn, zero straight on, positive for a left turn
+    return dc * -dr2 - (-dr) * dc2
+
+
+def _canonical_ring(ring):
+    # Drop collinear vertices, and rotate the (closed) ring to start at its lowest vertex.
+    # Also returns the ring's signed area in map orientation (x = column, y = -row), in cells.
+    pts = ring[:-1]
+    n = len(pts)
+    keep = []
+    for k in range(n):
+        (ar, ac), (br, bc), (cr, cc) = pts[k - 1], pts[k], pts[(k + 1) % n]
+        if (br - ar) * (cc - bc) - (bc - ac) * (cr - br) != 0:
+            keep.append(pts[k])
+    start = keep.index(min(keep))
+    keep = keep[start:] + keep[:start]
+    keep.append(keep[0])
+    area = 0
+    for (ar, ac), (br, bc) in zip(keep[:-1], keep[1:]):
+        area += bc * ar - ac * br
+    return keep, 0.5 * area
+
+
+#####################
+# 3. Assembly into multipart features
+
+def assemble_polygons(traced, classes, code):
+    """Group the rings of a class into polygons: [[exterior, hole, ...], ...], in vertex coordinates.
+
+    traced  - TracedClass of the class
+    classes - the class raster the rings were traced from
+    code    - class code
+
+    A hole's top-left vertex lies on its top edge, just below a cell of the class. Going up the
+    column from that cell to the last cell of the class, the edge above it belongs to a ring of the
+    same connected region: either the region's exterior ring or another of its holes, in which case
+    that hole's parent is looked up in turn. Because the ring found always starts on a higher row,
+    this terminates at the exterior ring.
+    """
+    rings = traced.rings
+    is_shell = [a < 0 for a in traced.areas]
+    top_rows, top_starts, top_ends, top_ring = traced.tops
+    width = classes.shape[1] + 1
+    top_keys = top_rows * width + top_starts
+    parent = [None] * len(rings)
+    for k, ring in enumerate(rings):
+        if is_shell[k]:
+            continue
+        row, col = ring[0]
+        column = np.asarray(classes[:row, col])[::-1] != code
+        run = int(np.argmax(column)) if column.any() else row
+        top = row - run
+        s = int(np.searchsorted(top_keys, top * width + col, side='right')) - 1
+        if s < 0 or top_rows[s] != top or not top_starts[s] <= col < top_ends[s]:
+            raise ValueError('No enclosing ring found for the hole at vertex (%d, %d)' % (row, col))
+        parent[k] = int(top_ring[s])
+    polygons = {}
+    for k in range(len(rings)):
+        if is_shell[k]:
+            polygons.setdefault(k, []).insert(0, rings[k])
+            continue
+        shell = parent[k]
+        while not is_shell[shell]:
+            shell = parent[shell]
+        polygons.setdefault(shell, []).append(rings[k])
+    polygons = list(polygons.values())
+    for polygon in polygons:
+        polygon[1:] = sorted(polygon[1:], key=lambda r: r[0])
+    polygons.sort(key=lambda p: p[0][0])
+    return polygons
+
+
+def to_map(rings, info):
+    """Convert rings from (row, column) vertex coordinates to (n, 2) arrays of (x, y) map coordinates."""
+    if not rings:
+        return []
+    vertices = np.array([v for ring in rings for v in ring], dtype=np.float64)
+    xy = np.empty(vertices.shape, dtype=np.float64)
+    xy[:, 0] = info.x_min + vertices[:, 1] * info.cell_size[0]
+    xy[:, 1] = info.y_max - vertices[:, 0] * info.cell_size[1]
+    return np.split(xy, np.cumsum([len(ring) for ring in rings])[:-1])
+
+
+def assemble_features(traced, classes, info):
+    """Build one multipart Feature per class from traced rings, in map coordinates, ordered by gridcode.
+
+    traced  - {class code: TracedClass}, from trace_rings()
+    classes - the class raster the rings were traced from
+    info    - mcfrm_io.RasterInfo of the class raster
+    """
+    features = []
+    for code in sorted(traced):
+        polygons = assemble_polygons(traced[code], classes, code)
+        xy = iter(to_map([ring for polygon in polygons for ring in polygon], info))
+        features.append(Feature(code, [[next(xy) for _ in polygon] for polygon in polygons]))
+    return features
+
+
+def vectorize(classes, info, skip=(BACKGROUND, NODATA), tolerance=0.0, max_vertices=None):
+    """Vectorize every class of a class raster in one sweep.
+
+    classes      - 2-d array of class codes
+    info         - mcfrm_io.RasterInfo of the class raster
+    skip         - codes not vectorized (background and NoData)
+    tolerance    - optional simplification tolerance in map units (see generalize())
+    max_vertices - optional cap on the vertices of a feature (see generalize())
+
+    Returns a list of Features, one (multipart) feature per class present, ordered by gridcode,
+    unless max_vertices splits some of them.
+    """
+    features = assemble_features(trace_rings(extract_edges(classes, skip)), classes, info)
+    if tolerance > 0 or max_vertices:
+        features = generalize(features, classes, info, tolerance, max_vertices)
+    return features
+
+
+#####################
+# 4. Simplification and vertex cap
+
+# Number of times the tolerance of an arc is halved, when its simplification breaks the topology,
+# before all its vertices are kept
+_MAX_REFINE = 6
+
+# Labels of the pieces of features split by the vertex cap start here, above any class code
+_FIRST_PIECE = 1 << 20
+
+
+def _nodes(labels):
+    # Vertices where three or more boundaries meet, as a boolean (rows + 1, cols + 1) array. The (up
+    # to) four cells around a vertex form four side-by-side pairs; each pair with different labels
+    # puts a boundary edge at the vertex.
+    rows, cols = labels.shape
+    padded = np.full((rows + 2, cols + 2), _OUTSIDE, dtype=labels.dtype)
+    padded[1:-1, 1:-1] = labels
+    nw, ne, sw, se = padded[:-1, :-1], padded[:-1, 1:], padded[1:, :-1], padded[1:, 1:]
+    degree = (nw != ne).astype(np.int8) + (sw != se) + (nw != sw) + (ne != se)
+    return degree >= 3
+
+
+def _ring_with_nodes(ring, nodes):
+    # The vertices of a closed ring (without its closing vertex), with the nodes lying on its straight
+    # runs inserted, and whether each vertex is a node
+    ring = np.asarray(ring, dtype=np.int64)
+    steps = np.diff(ring, axis=0)
+    lengths = np.abs(steps).sum(axis=1)
+    segment = np.repeat(np.arange(len(steps)), lengths)
+    k = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pts = ring[segment] + np.sign(steps)[segment] * k[:, None]
+    flags = nodes[pts[:, 0], pts[:, 1]]
+    keep = flags | (k == 0)
+    return pts[keep], flags[keep]
+
+
+def _ring_area(ring):
+    # Signed area of a closed (n, 2) array of (row, column) vertices, in map orientation, as in _canonical_ring
+    r, c = ring[:, 0], ring[:, 1]
+    return 0.5 * float(np.dot(c[1:], r[:-1]) - np.dot(c[:-1], r[1:]))
+
+
+def _douglas_peucker(points, tolerance, split=False):
+    # Indices of the points of an open polyline kept by Douglas-Peucker simplification; with split,
+    # the point farthest from the chord is kept whatever its distance
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        chord = points[j] - points[i]
+        offsets = points[i + 1:j] - points[i]
+        length = np.hypot(chord[0], chord[1])
+        if length > 0:
+            distance = np.abs(chord[0] * offsets[:, 1] - chord[1] * offsets[:, 0]) / length
+        else:
+            distance = np.hypot(offsets[:, 0], offsets[:, 1])
+        k = int(np.argmax(distance))
+        if distance[k] > tolerance or split:
+            split = False
+            keep[i + 1 + k] = True
+            stack.extend([(i, i + 1 + k), (i + 1 + k, j)])
+    return np.flatnonzero(keep)
+
+
+def _simplify_arc(vertices, tolerance, scale):
+    # Indices of the vertices of an arc kept at a tolerance in map units. A closed arc is cut at its
+    # vertex farthest from its start, and keeps at least one vertex on each side, so that it
+    # cannot collapse.
+    if tolerance <= 0 or len(vertices) < 4:
+        return np.arange(len(vertices))
+    points = vertices * scale
+    if tuple(vertices[0]) != tuple(vertices[-1]):
+        return _douglas_peucker(points, tolerance)
+    far = int(np.argmax(np.hypot(points[:, 0] - points[0, 0], points[:, 1] - points[0, 1])))
+    first = _douglas_peucker(points[:far + 1], tolerance, split=True)
+    second = _douglas_peucker(points[far:], tolerance, split=True) + far
+    return np.concatenate([first, second[1:]])
+
+
+def _orientation(ar, ac, br, bc, pr, pc):
+    # Sign of the turn a -> b -> p
+    return np.sign((br - ar) * (pc - ac) - (bc - ac) * (pr - ar))
+
+
+def _grid_pairs(lo, hi, cell):
+    # Pairs (i < j) of boxes [lo, hi] (row, column arrays) that overlap, found in the cells of a
+    # grid. A pair is reported in the first grid cell of the overlap of its boxes only.
+    b0, b1 = lo // cell, hi // cell
+    nr, nc = b1[:, 0] - b0[:, 0] + 1, b1[:, 1] - b0[:, 1] + 1
+    counts = nr * nc
+    box = np.repeat(np.arange(len(lo)), counts)
+    k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+    rows, cols = b0[box, 0] + k // nc[box], b0[box, 1] + k % nc[box]
+    bucket = rows * (int(b1[:, 1].max()) + 1) + cols
+    order = np.lexsort((box, bucket))
+    bucket, box, rows, cols = bucket[order], box[order], rows[order], cols[order]
+    ends = np.searchsorted(bucket, bucket, side='right')
+    partners = ends - np.arange(len(bucket)) - 1
+    first = np.repeat(np.arange(len(bucket)), partners)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(partners) - partners, partners)
+    i, j = box[first], box[second]
+    keep = ((lo[i] <= hi[j]) & (lo[j] <= hi[i])).all(axis=1)
+    keep &= (rows[first] == np.maximum(b0[i, 0], b0[j, 0])) & (cols[first] == np.maximum(b0[i, 1], b0[j, 1]))
+    return i[keep], j[keep]
+
+
+class _Arcs(object):
+    # The boundaries of a set of polygons in vertex coordinates, as arcs: chains of vertices from
+    # node to node, or closed loops without any node. Each arc is stored once, in a canonical
+    # direction, and each ring is a list of (arc index, forward) references.
+
+    def __init__(self, polygons, nodes):
+        self.keys, self.vertices, self._index = [], [], {}
+        self.refs, self.areas = [], []
+        self.polygons = {}
+        for label in sorted(polygons):
+            self.polygons[label] = [[self._add_ring(ring, nodes) for ring in polygon] for polygon in polygons[label]]
+        lengths = np.array([len(v) for v in self.vertices], dtype=np.int64)
+        self.offsets = np.cumsum(lengths) - lengths
+        self.all_vertices = np.concatenate(self.vertices) if self.vertices else np.zeros((0, 2), dtype=np.int64)
+        # The references of all rings, flat
+        self.ref_ring = np.repeat(np.arange(len(self.refs)), [len(refs) for refs in self.refs])
+        self.ref_arc = np.array([a for refs in self.refs for a, _ in refs], dtype=np.int64)
+        self.ref_forward = np.array([forward for refs in self.refs for _, forward in refs], dtype=bool)
+        # (ring, arc) pairs, as ring * number of arcs + arc
+        self.members = np.unique(self.ref_ring * len(self.keys) + self.ref_arc)
+
+    def _add_ring(self, ring, nodes):
+        pts, flags = _ring_with_nodes(ring, nodes)
+        cuts = np.flatnonzero(flags)
+        if len(cuts):
+            pts = np.concatenate([pts[cuts[0]:], pts[:cuts[0]]])
+            cuts = cuts - cuts[0]
+        pts = np.concatenate([pts, pts[:1]])
+        bounds = cuts[1:].tolist() + [len(pts) - 1]
+        refs, start = [], 0
+        for end in bounds:
+            refs.append(self._add_arc(pts[start:end + 1]))
+            start = end
+        self.refs.append(refs)
+        self.areas.append(_ring_area(pts))
+        return len(self.refs) - 1
+
+    def _add_arc(self, seq):
+        # The same arc traversed the other way, by the polygon on its other side, gets the same key
+        head = (tuple(seq[0].tolist()), tuple(seq[1].tolist()))
+        tail = (tuple(seq[-1].tolist()), tuple(seq[-2].tolist()))
+        forward = head <= tail
+        key = head + tail + (len(seq),) if forward else tail + head + (len(seq),)
+        if key not in self._index:
+            self._index[key] = len(self.keys)
+            self.keys.append(key)
+            self.vertices.append(seq if forward else seq[::-1].copy())
+        return self._index[key], forward
+
+    def simplify(self, tolerance, scale, levels, memo):
+        """Indices of the vertices kept of each arc, refining the arcs whose simplification breaks the topology.
+
+        levels - {arc key: number of times its tolerance was halved}, updated
+        memo   - {(arc key, level): kept indices}, updated
+        """
+        while True:
+            kept = []
+            for key, vertices in zip(self.keys, self.vertices):
+                level = levels.get(key, 0)
+                if level >= _MAX_REFINE:
+                    kept.append(np.arange(len(vertices)))
+                    continue
+                if (key, level) not in memo:
+                    memo[key, level] = _simplify_arc(vertices, tolerance / 2.0 ** level, scale)
+                kept.append(memo[key, level])
+            bad = [a for a in self._broken(kept) if levels.get(self.keys[a], 0) < _MAX_REFINE]
+            if not bad:
+                return kept
+            for a in bad:
+                levels[self.keys[a]] = levels.get(self.keys[a], 0) + 1
+
+    def rings(self, kept):
+        """The rings, as the kept vertices of their arcs: ((n, 2) array of the vertices of all rings,
+        without closing vertices, start of each ring in it, number of vertices of each ring).
+        """
+        counts = np.array([len(k) for k in kept], dtype=np.int64)
+        starts = np.cumsum(counts) - counts
+        flat = np.concatenate([self.offsets[a] + k for a, k in enumerate(kept)])
+        # Each reference contributes the kept vertices of its arc but the last, in its direction
+        n = counts[self.ref_arc] - 1
+        step = np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n, n)
+        arc = np.repeat(self.ref_arc, n)
+        position = np.where(np.repeat(self.ref_forward, n), starts[arc] + step, starts[arc] + counts[arc] - 1 - step)
+        lengths = np.bincount(self.ref_ring, weights=n, minlength=len(self.refs)).astype(np.int64)
+        return self.all_vertices[flat[position]], np.cumsum(lengths) - lengths, lengths
+
+    def _broken(self, kept):
+        # Indices of the arcs involved in a topology error: boundaries that cross, touch or overlap;
+        # a ring whose area changes sign or vanishes; or a simplified segment that jumps over another
+        # ring, i.e. a ring lies between the segment and the stretch of arc it replaces
+        vertices, ring_starts, ring_lengths = self.rings(kept)
+        vertex_ring = np.repeat(np.arange(len(ring_lengths)), ring_lengths)
+        following = np.arange(1, len(vertices) + 1)
+        following[ring_starts + ring_lengths - 1] = ring_starts
+        r, c = vertices[:, 0], vertices[:, 1]
+        areas = np.bincount(vertex_ring, weights=c[following] * r - c * r[following], minlength=len(ring_lengths))
+        flipped = (areas == 0) | ((areas < 0) != (np.array(self.areas) < 0))
+        bad = set(self.ref_arc[flipped[self.ref_ring]].tolist())
+        g = np.concatenate([self.offsets[a] + kept[a] for a in range(len(kept))])
+        arc = np.repeat(np.arange(len(kept)), [len(k) for k in kept])
+        seg = np.flatnonzero(arc[1:] == arc[:-1])
+        g0, g1, seg_arc = g[seg], g[seg + 1], arc[seg]
+        if not len(seg):
+            return bad
+        v = self.all_vertices
+        p0, p1 = v[g0], v[g1]
+        lo, hi = np.minimum(p0, p1), np.maximum(p0, p1)
+        cell = max(8, 2 * int(np.median(np.max(hi - lo, axis=1))))
+
+        # Segments that cross, touch or overlap; segments sharing an end vertex may only meet there
+        i, j = _grid_pairs(lo, hi, cell)
+        ar, ac, br, bc = p0[i, 0], p0[i, 1], p1[i, 0], p1[i, 1]
+        cr, cc, dr, dc = p0[j, 0], p0[j, 1], p1[j, 0], p1[j, 1]
+        o1, o2 = _orientation(ar, ac, br, bc, cr, cc), _orientation(ar, ac, br, bc, dr, dc)
+        o3, o4 = _orientation(cr, cc, dr, dc, ar, ac), _orientation(cr, cc, dr, dc, br, bc)
+        collinear = (o1 == 0) & (o2 == 0)
+        common = np.minimum(hi[i], hi[j]) - np.maximum(lo[i], lo[j])
+        meet = np.where(collinear, (common >= 0).all(axis=1), (o1 * o2 <= 0) & (o3 * o4 <= 0))
+        shared = (((ar == cr) & (ac == cc)) | ((ar == dr) & (ac == dc)) |
+                  ((br == cr) & (bc == cc)) | ((br == dr) & (bc == dc)))
+        wrong = meet & (~shared | (collinear & (common > 0).any(axis=1)))
+        bad.update(seg_arc[i[wrong]].tolist())
+        bad.update(seg_arc[j[wrong]].tolist())
+
+        # Rings jumped over: a point of each ring, the midpoint of its first segment (doubled, to stay
+        # integral), must not lie between a segment and the stretch of arc it replaces
+        skips = np.flatnonzero(g1 - g0 >= 2)
+        if not len(skips):
+            return bad
+        lo = np.minimum(np.minimum.reduceat(v, g0, axis=0), v[g1])[skips]
+        hi = np.maximum(np.maximum.reduceat(v, g0, axis=0), v[g1])[skips]
+        points = vertices[ring_starts] + vertices[ring_starts + 1]
+        width = int(v[:, 1].max()) // cell + 2
+        point_keys = points[:, 0] // (2 * cell) * width + points[:, 1] // (2 * cell)
+        order = np.argsort(point_keys, kind='stable')
+        b0, b1 = lo // cell, hi // cell
+        nc = b1[:, 1] - b0[:, 1] + 1
+        counts = (b1[:, 0] - b0[:, 0] + 1) * nc
+        s = np.repeat(np.arange(len(skips)), counts)
+        k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        buckets = (b0[s, 0] + k // nc[s]) * width + b0[s, 1] + k % nc[s]
+        first = np.searchsorted(point_keys[order], buckets, side='left')
+        n = np.searchsorted(point_keys[order], buckets, side='right') - first
+        s = np.repeat(s, n)
+        ring = order[np.repeat(first, n) + np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n, n)]
+        near = ((points[ring] > 2 * lo[s]) & (points[ring] < 2 * hi[s])).all(axis=1)
+        # ... leaving out the rings the arc belongs to
+        near &= ~np.isin(ring * len(kept) + seg_arc[skips[s]], self.members)
+        s, ring = s[near], ring[near]
+        if not len(s):
+            return bad
+        # Ray casting along the point's row, over the edges of the stretch of arc and the segment
+        start, end = g0[skips[s]], g1[skips[s]]
+        edges = end - start + 1
+        pair = np.repeat(np.arange(len(s)), edges)
+        e0 = start[pair] + np.arange(int(edges.sum())) - np.repeat(np.cumsum(edges) - edges, edges)
+        e1 = e0 + 1
+        closing = e0 == end[pair]
+        e1[closing] = start[pair][closing]
+        pr, pc = points[ring[pair], 0] / 2.0, points[ring[pair], 1] / 2.0
+        ar, ac, br, bc = v[e0, 0], v[e0, 1], v[e1, 0], v[e1, 1]
+        spans = (ar > pr) != (br > pr)
+        cross = np.zeros(len(pair), dtype=bool)
+        ar, ac, br, bc, pr, pc = ar[spans], ac[spans], br[spans], bc[spans], pr[spans], pc[spans]
+        cross[spans] = pc < ac + (pr - ar) * (bc - ac) / (br - ar)
+        inside = np.bincount(pair, weights=cross, minlength=len(s)).astype(np.int64) % 2 == 1
+        bad.update(seg_arc[skips[s[inside]]].tolist())
+        return bad
+
+
+def _split(labels, label, window, next_label):
+    # Halve a window across its longer side, giving the cells of label in each half a new label.
+    # Returns [(new label, window of its cells), ...].
+    if window.nrows >= window.ncols:
+        half = window.nrows // 2
+        halves = [Window(window.row, window.col, half, window.ncols),
+                  Window(window.row + half, window.col, window.nrows - half, window.ncols)]
+    else:
+        half = window.ncols // 2
+        halves = [Window(window.row, window.col, window.nrows, half),
+                  Window(window.row, window.col + half, window.nrows, window.ncols - half)]
+    pieces = []
+    for part in halves:
+        cells = labels[part.slices()]
+        mask = cells == label
+        if not mask.any():
+            continue
+        cells[mask] = next_label
+        pieces.append((next_label, _bounds(mask, part.row, part.col)))
+        next_label += 1
+    return pieces
+
+
+def _bounds(mask, row=0, col=0):
+    rows, cols = np.nonzero(mask)
+    return Window(row + rows.min(), col + cols.min(), rows.max() - rows.min() + 1, cols.max() - cols.min() + 1)
+
+
+def _trace_pieces(labels, pieces, window):
+    # Polygons of new labels, all lying in a window, in the vertex coordinates of the whole raster
+    cells = labels[window.slices()]
+    cells = np.where(np.isin(cells, [label for label, _ in pieces]), cells, _OUTSIDE)
+    traced = trace_rings(extract_edges(cells, skip=()))
+    return dict((label, [[[(r + window.row, c + window.col) for r, c in ring] for ring in polygon]
+                         for polygon in assemble_polygons(traced[label], cells, label)])
+                for label, _ in pieces)
+
+
+def generalize(features, classes, info, tolerance=0.0, max_vertices=None, stats=None):
+    """Simplify the Features vectorized from a class raster, and split those with too many vertices.
+
+    features     - Features vectorized from classes (one per class, as returned by vectorize())
+    classes      - the class raster
+    info         - mcfrm_io.RasterInfo of the class raster
+    tolerance    - largest distance, in map units, between a simplified boundary and the original
+    max_vertices - if given, a feature with more vertices is split in two by halving the window of
+                   the raster it covers across its longer side, and so on until every piece has at
+                   most max_vertices; the pieces are features with the same gridcode
+    stats        - optional dict, updated with the counts vertices_in, vertices, arcs, refined_arcs
+                   (arcs whose tolerance was reduced to preserve the topology) and splits
+
+    Boundaries are simplified as arcs shared by the polygons on both sides (see the notes at
+    the top of this module), so the output is still a partition of the classes without gaps or slivers. Returns
+    the list of Features, ordered by gridcode, the pieces of a split feature from the top left.
+    """
+    if max_vertices is not None and max_vertices < 5:
+        raise ValueError('max_vertices must be at least 5, got %d' % max_vertices)
+    if not features:
+        # Nothing classified (all background or NoData): no boundaries to simplify or split
+        if stats is not None:
+            stats.update(vertices_in=0, vertices=0, arcs=0, refined_arcs=0, splits=0)
+        return []
+    cw, ch = info.cell_size
+    polygons = {}
+    for f in features:
+        polygons[f.gridcode] = [[list(map(tuple, _to_vertices(ring, info).tolist())) for ring in part]
+                                for part in f.parts]
+    labels = np.full(classes.shape, _OUTSIDE, dtype=np.int32)
+    vectorized = np.isin(classes, list(polygons))
+    labels[vectorized] = classes[vectorized]
+    del vectorized
+    gridcodes = dict((code, code) for code in polygons)
+    windows = {}
+    levels, memo = {}, {}
+    next_label = _FIRST_PIECE
+    splits = 0
+    while True:
+        arcs = _Arcs(polygons, _nodes(labels))
+        vertices, starts, lengths = arcs.rings(arcs.simplify(tolerance, np.array([ch, cw]), levels, memo))
+        output = dict((label, [[_drop_collinear(vertices[starts[k]:starts[k] + lengths[k]]) for k in polygon]
+                               for polygon in label_polygons])
+                      for label, label_polygons in arcs.polygons.items())
+        over = [label for label in sorted(output)
+                if max_vertices and sum(len(ring) for polygon in output[label] for ring in polygon) > max_vertices]
+        if not over:
+            break
+        for label in over:
+            window = windows.pop(label, None) or _bounds(labels == label)
+            pieces = _split(labels, label, window, next_label)
+            next_label += len(pieces)
+            polygons.update(_trace_pieces(labels, pieces, window))
+            for piece, piece_window in pieces:
+                gridcodes[piece] = gridcodes[label]
+                windows[piece] = piece_window
+            del polygons[label], gridcodes[label]
+            splits += 1
+
+    def order(label):
+        window = windows.get(label)
+        return (gridcodes[label],) + ((window.row, window.col) if window else (-1, -1))
+
+    result = []
+    for label in sorted(output, key=order):
+        xy = iter(to_map([ring for polygon in output[label] for ring in polygon], info))
+        result.append(Feature(gridcodes[label], [[next(xy) for _ in polygon] for polygon in output[label]]))
+    if stats is not None:
+        stats.update(vertices_in=sum(f.vertex_count() for f in features),
+                     vertices=sum(f.vertex_count() for f in result), arcs=len(arcs.keys),
+                     refined_arcs=sum(1 for key in arcs.keys if levels.get(key)), splits=splits)
+    return result
+
+
+def _to_vertices(ring, info):
+    # (row, column) vertex coordinates of a ring in map coordinates
+    cw, ch = info.cell_size
+    rows, cols = np.rint((info.y_max - ring[:, 1]) / ch), np.rint((ring[:, 0] - info.x_min) / cw)
+    return np.column_stack([rows, cols]).astype(np.int64)
+
+
+def _drop_collinear(pts):
+    # Drop the vertices of a ring (given without its closing vertex) that lie on a straight line
+    # through their neighbours, and close it, starting at its lowest vertex
+    before, after = np.concatenate([pts[-1:], pts[:-1]]), np.concatenate([pts[1:], pts[:1]])
+    turn = ((pts[:, 0] - before[:, 0]) * (after[:, 1] - pts[:, 1])
+            - (pts[:, 1] - before[:, 1]) * (after[:, 0] - pts[:, 0]))
+    pts = pts[turn != 0]
+    start = int(np.lexsort((pts[:, 1], pts[:, 0]))[0])
+    return np.concatenate([pts[start:], pts[:start + 1]])
+
+
+#####################
+# Output
+
+def write_geojson(path, features, field='gridcode', crs=None):
+    """Write Features to a GeoJSON file as MultiPolygons.
+
+    GeoJSON (RFC 7946) exterior rings are counter-clockwise, so ring orientation is reversed.
+    """
+    out = {'type': 'FeatureCollection', 'features': []}
+    if crs:
+        out['crs'] = {'type': 'name', 'properties': {'name': crs}}
+    for f in features:
+        coords = [[ring[::-1].tolist() for ring in part] for part in f.parts]
+        out['features'].append({'type': 'Feature', 'properties': {field: f.gridcode},
+                                'geometry': {'type': 'MultiPolygon', 'coordinates': coords}})
+    with open(path, 'w') as fp:
+        json.dump(out, fp)
+
+
+def save_features(path, features):
+    """Save Features to a NumPy .npz file, exactly, for reloading with load_features()."""
+    rings = [ring for f in features for part in f.parts for ring in part]
+    np.savez(path,
+             gridcodes=np.array([f.gridcode for f in features], dtype=np.int64),
+             part_counts=np.array([len(f.parts) for f in features], dtype=np.int64),
+             ring_counts=np.array([len(part) for f in features for part in f.parts], dtype=np.int64),
+             ring_lengths=np.array([len(ring) for ring in rings], dtype=np.int64),
+             xy=np.concatenate(rings) if rings else np.zeros((0, 2), dtype=np.float64))
+
+
+def load_features(path):
+    """Load Features saved with save_features()."""
+    with np.load(path) as data:
+        xy = data['xy']
+        ring_lengths = data['ring_lengths']
+        rings = iter(np.split(xy, np.cumsum(ring_lengths)[:-1]) if len(ring_lengths) else [])
+        ring_counts = iter(data['ring_counts'].tolist())
+        features = []
+        for gridcode, part_count in zip(data['gridcodes'].tolist(), data['part_counts'].tolist()):
+            parts = [[next(rings) for _ in range(next(ring_counts))] for _ in range(part_count)]
+            features.append(Feature(gridcode, parts))
+    return features
+
+
+def write_arcpy_features(out_fc, features, field='gridcode', crs=None):
+    """Write Features to a new ArcGIS polygon feature class with a single LONG field.
+
+    crs - coordinate reference system as a string understood by arcpy.SpatialReference.loadFromString
+    """
+    import arcpy
+    spatial_reference = None
+    if crs:
+        spatial_reference = arcpy.SpatialReference()
+        spatial_reference.loadFromString(crs)
+    workspace, name = os.path.split(out_fc.replace('\\', '/'))
+    arcpy.CreateFeatureclass_management(workspace, name, 'POLYGON', spatial_reference=spatial_reference)
+    arcpy.AddField_management(out_fc, field, 'LONG')
+    with arcpy.da.InsertCursor(out_fc, ['SHAPE@', field]) as cursor:
+        for f in features:
+            cursor.insertRow([_arcpy_polygon(arcpy, f, spatial_reference), f.gridcode])
+
+
+def update_arcpy_features(out_fc, features, codes, field='gridcode'):
+    """Replace the features of the given class codes in an existing feature class by those in features.
+
+    Features of other codes are left untouched; a code absent from features has its feature deleted.
+    """
+    import arcpy
+    codes = set(codes)
+    replacements = dict((f.gridcode, f) for f in features if f.gridcode in codes)
+    spatial_reference = arcpy.Describe(out_fc).spatialReference
+    with arcpy.da.UpdateCursor(out_fc, ['SHAPE@', field]) as cursor:
+        for row in cursor:
+            if row[1] not in codes:
+                continue
+            f = replacements.pop(row[1], None)
+            if f is None:
+                cursor.deleteRow()
+            else:
+                cursor.updateRow([_arcpy_polygon(arcpy, f, spatial_reference), f.gridcode])
+    with arcpy.da.InsertCursor(out_fc, ['SHAPE@', field]) as cursor:
+        for code in sorted(replacements):
+            cursor.insertRow([_arcpy_polygon(arcpy, replacements[code], spatial_reference), code])
+
+
+def _arcpy_polygon(arcpy, feature, spatial_reference):
+    rings = arcpy.Array()
+    for part in feature.parts:
+        for ring in part:
+            rings.add(arcpy.Array([arcpy.Point(x, y) for x, y in ring]))
+    return arcpy.Polygon(rings, spatial_reference)
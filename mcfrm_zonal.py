@@ -0,0 +1,275 @@
+# mcfrm_zonal.py
+#
+# Zonal summary: the number of cells, and the area, in each class of each scheme, optionally per zone
+# (town, asset buffer, ...), without vectorizing anything.
+#
+# The probability raster is read block by block in one pass; each block is classified with every
+# scheme requested and its class codes are counted with numpy.unique/bincount. The result is a small
+# table with one row per (scheme, zone, class):
+#
+#    scheme, zone, code, class, cells, area
+#
+# where class is the class's output name (or "background" / "NoData"), and area is in the square map
+# units of the raster (square meters for the MC-FRM rasters). Zones are given either as
+#    * a zone raster on the same grid as the input (any raster mcfrm_io reads); each cell counts in
+#      the zone of its value, NoData cells in none, or as
+#    * zone polygons, from a GeoJSON file or an ArcGIS feature class, with the zone taken from a field.
+#      Each polygon is rasterized onto the input's grid block by block (a cell is in a polygon if its
+#      center is), and counted separately, so overlapping polygons such as asset buffers each get
+#      their full counts. Polygons sharing a zone value are summed. GeoJSON coordinates must be in the
+#      raster's coordinate system; feature classes are projected to it.
+#
+#    python mcfrm_pipeline.py input.tif --scheme CTPS --zonal ctps_by_town.csv --zone-polygons towns.geojson --zone-field TOWN
+
+import collections
+import csv
+import json
+import os
+
+import numpy as np
+
+import mcfrm_io
+import mcfrm_tiles
+from mcfrm_instrument import NULL_RECORDER
+from mcfrm_io import Window
+from mcfrm_schemes import classify, get_scheme
+
+FIELDS = ('scheme', 'zone', 'code', 'class', 'cells', 'area')
+
+
+#####################
+# Zone polygons
+
+def read_zone_polygons(path, zone_field=None, crs=None):
+    """Read zone polygons from a GeoJSON file or an ArcGIS feature class.
+
+    Returns a list of (zone, rings), each ring an (n, 2) array of x, y; holes are rings like any
+    other (cells are inside a polygon if inside an odd number of its rings). Without a zone_field
+    the zone is the feature's id (GeoJSON "id", or ObjectID) or, failing that, its position.
+    crs - coordinate system (WKT) to project feature class geometries to
+    """
+    if os.path.splitext(path)[1].lower() in ('.geojson', '.json'):
+        return _read_geojson_polygons(path, zone_field)
+    return _read_arcpy_polygons(path, zone_field, crs)
+
+
+def _read_geojson_polygons(path, zone_field):
+    with open(path) as f:
+        data = json.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    polygons = []
+    for n, feature in enumerate(features):
+        geometry = feature.get('geometry') or {}
+        if geometry.get('type') == 'Polygon':
+            parts = [geometry['coordinates']]
+        elif geometry.get('type') == 'MultiPolygon':
+            parts = geometry['coordinates']
+        else:
+            continue
+        if zone_field is not None:
+            zone = (feature.get('properties') or {})[zone_field]
+        else:
+            zone = feature.get('id', n)
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2] for part in parts for ring in part if len(ring) >= 3]
+        polygons.append((zone, rings))
+    return polygons
+
+
+def _read_arcpy_polygons(path, zone_field, crs):
+    import arcpy
+    kwargs = {}
+    if crs:
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(crs)
+        kwargs['spatial_reference'] = sr
+    polygons = []
+    with arcpy.da.SearchCursor(path, [zone_field or 'OID@', 'SHAPE@'], **kwargs) as cursor:
+        for zone, shape in cursor:
+            if shape is None:
+                continue
+            rings = []
+            for part in shape:
+                ring = []
+                for point in part:
+                    if point is None:           # separates the rings of a part
+                        if len(ring) >= 3:
+                            rings.append(np.asarray(ring))
+                        ring = []
+                    else:
+                        ring.append((point.X, point.Y))
+                if len(ring) >= 3:
+                    rings.append(np.asarray(ring))
+            polygons.append((zone, rings))
+    return polygons
+
+
+class ZonePolygon(object):
+    """A zone polygon as an (n, 4) array of edges (all rings), with the window of the raster it covers."""
+
+    def __init__(self, zone, rings, info):
+        self.zone = zone
+        ends = [np.roll(r, -1, axis=0) for r in rings]
+        self.edges = np.hstack([np.vstack(rings), np.vstack(ends)]) if rings else np.empty((0, 4))
+        xy = self.edges[:, :2]
+        self.window = None
+        if len(xy):
+            cw, ch = info.cell_size
+            row0 = max(int(np.floor((info.y_max - xy[:, 1].max()) / ch)), 0)
+            row1 = min(int(np.ceil((info.y_max - xy[:, 1].min()) / ch)), info.shape[0])
+            col0 = max(int(np.floor((xy[:, 0].min() - info.x_min) / cw)), 0)
+            col1 = min(int(np.ceil((xy[:, 0].max() - info.x_min) / cw)), info.shape[1])
+            if row1 > row0 and col1 > col0:
+                self.window = Window(row0, col0, row1 - row0, col1 - col0)
+
+
+def rasterize(edges, info, window):
+    """Cells of a window whose centers lie inside a polygon (even-odd rule).
+
+    edges - (n, 4) array of the polygon's edges x0, y0, x1, y1, all rings together
+    Returns a boolean array of the window's shape.
+    """
+    cw, ch = info.cell_size
+    x0, y0, x1, y1 = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    # Rows whose cell centers yc cross each edge, with min(y0, y1) <= yc < max(y0, y1)
+    first = np.floor((info.y_max - np.maximum(y0, y1)) / ch - 0.5).astype(np.int64) + 1
+    last = np.floor((info.y_max - np.minimum(y0, y1)) / ch - 0.5).astype(np.int64)
+    first = np.maximum(first, window.row)
+    last = np.minimum(last, window.row + window.nrows - 1)
+    counts = np.maximum(last - first + 1, 0)
+    total = int(counts.sum())
+    toggles = np.zeros(window.nrows * (window.ncols + 1), dtype=np.int64)
+    if total:
+        edge = np.repeat(np.arange(len(edges)), counts)
+        rows = first[edge] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        yc = info.y_max - (rows + 0.5) * ch
+        x = x0[edge] + (yc - y0[edge]) * (x1[edge] - x0[edge]) / (y1[edge] - y0[edge])
+        # Each crossing toggles the cells whose centers lie to its right
+        cols = np.floor((x - info.x_min) / cw - 0.5).astype(np.int64) + 1
+        cols = np.clip(cols - window.col, 0, window.ncols)
+        toggles = np.bincount((rows - window.row) * (window.ncols + 1) + cols, minlength=toggles.size)
+    inside = np.cumsum(toggles.reshape(window.nrows, window.ncols + 1), axis=1)[:, :window.ncols] & 1
+    return inside.astype(bool)
+
+
+def _intersection(a, b):
+    row, col = max(a.row, b.row), max(a.col, b.col)
+    nrows = min(a.row + a.nrows, b.row + b.nrows) - row
+    ncols = min(a.col + a.ncols, b.col + b.ncols) - col
+    return Window(row, col, nrows, ncols) if nrows > 0 and ncols > 0 else None
+
+
+def _local(window, origin):
+    return (slice(window.row - origin.row, window.row - origin.row + window.nrows),
+            slice(window.col - origin.col, window.col - origin.col + window.ncols))
+
+
+#####################
+# Counting
+
+def _count(counter, codes, zones=None, zone=None):
+    # Add the cells of each (zone, code) to counter
+    if zones is None:
+        values, n = np.unique(codes, return_counts=True)
+        for value, count in zip(values.tolist(), n.tolist()):
+            counter[(zone, value)] += count
+        return
+    zone_values, zone_index = np.unique(zones, return_inverse=True)
+    code_values, code_index = np.unique(codes, return_inverse=True)
+    n = np.bincount(zone_index.ravel() * len(code_values) + code_index.ravel(),
+                    minlength=len(zone_values) * len(code_values))
+    for i in np.flatnonzero(n):
+        z, c = divmod(int(i), len(code_values))
+        counter[(zone_values[z].item(), code_values[c].item())] += int(n[i])
+
+
+def _zone_key(zone):
+    # Numeric zones sort numerically, before named ones
+    if isinstance(zone, (int, float)):
+        return (0, zone, '')
+    return (1, 0, str(zone))
+
+
+def _open_zone_raster(path, info):
+    source = mcfrm_io.open_source(path)
+    zi = source.info
+    if zi.shape != info.shape or not np.allclose((zi.x_min, zi.y_max) + zi.cell_size,
+                                                 (info.x_min, info.y_max) + info.cell_size):
+        source.close()
+        raise ValueError('Zone raster %s is not on the grid of the input raster' % path)
+    return source
+
+
+def zonal_summary(input_path, schemes, zone_raster=None, zone_polygons=None, zone_field=None, envelope=None,
+                  block_shape=mcfrm_tiles.DEFAULT_BLOCK_SHAPE, recorder=None):
+    """Cell counts and areas of the classes of one or more schemes, optionally per zone, in one pass.
+
+    input_path    - probability raster (.npy, GeoTIFF or ArcGIS raster dataset)
+    zone_raster   - optional raster of zone values on the input's grid
+    zone_polygons - optional GeoJSON file or feature class of zone polygons (zone from zone_field)
+    Returns a list of rows (dicts with the keys of FIELDS), sorted by scheme, zone and code.
+    """
+    recorder = recorder or NULL_RECORDER
+    if isinstance(schemes, str):
+        schemes = [schemes]
+    names = [get_scheme(s).name for s in schemes]
+    counts = dict((name, collections.Counter()) for name in names)
+    with recorder.stage('zonal', schemes=','.join(names)) as stage:
+        with mcfrm_io.open_source(input_path, envelope) as source:
+            info = source.info
+            zones = polygons = None
+            if zone_raster is not None:
+                zones = _open_zone_raster(zone_raster, info)
+            elif zone_polygons is not None:
+                polygons = [ZonePolygon(zone, rings, info)
+                            for zone, rings in read_zone_polygons(zone_polygons, zone_field, info.crs)]
+                polygons = [p for p in polygons if p.window is not None]
+            try:
+                for window in mcfrm_tiles.iter_windows(info.shape, block_shape):
+                    classes = classify(source.read(window), names, nodata=info.nodata)
+                    stage.add(cells=window.nrows * window.ncols)
+                    if zones is not None:
+                        z = zones.read(window)
+                        valid = np.ones(z.shape, dtype=bool)
+                        if np.issubdtype(z.dtype, np.floating):
+                            valid &= ~np.isnan(z)
+                        if zones.info.nodata is not None:
+                            valid &= z != zones.info.nodata
+                        for name in names:
+                            _count(counts[name], classes[name][valid], z[valid])
+                    elif polygons is not None:
+                        for polygon in polygons:
+                            part = _intersection(polygon.window, window)
+                            if part is None:
+                                continue
+                            inside = rasterize(polygon.edges, info, part)
+                            for name in names:
+                                _count(counts[name], classes[name][_local(part, window)][inside], zone=polygon.zone)
+                    else:
+                        for name in names:
+                            _count(counts[name], classes[name])
+            finally:
+                if zones is not None:
+                    zones.close()
+    cell_area = info.cell_size[0] * info.cell_size[1]
+    rows = []
+    for name in names:
+        scheme = get_scheme(name)
+        labels = dict((c.code, c.name) for c in scheme.classes)
+        labels.update({scheme.background: 'background', scheme.nodata: 'NoData'})
+        for (zone, code), cells in sorted(counts[name].items(), key=lambda item: (_zone_key(item[0][0]), item[0][1])):
+            rows.append({'scheme': name, 'zone': zone, 'code': code, 'class': labels.get(code, ''),
+                         'cells': cells, 'area': cells * cell_area})
+    return rows
+
+
+def write_table(path, rows):
+    """Write the rows of a zonal summary to a CSV file, or to a JSON file if path ends in .json."""
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=1)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, FIELDS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(row, zone='' if row['zone'] is None else row['zone']))
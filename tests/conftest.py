@@ -0,0 +1,61 @@
+# conftest.py
+#
+# Shared fixtures of the test suite. The modules under test live at the top of the repository,
+# next to the toolbox scripts, so it is put on the import path here.
+#
+#    python -m pytest tests
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcfrm_io  # noqa: E402
+from mcfrm_io import RasterInfo  # noqa: E402
+
+
+def probability_raster(shape=(90, 80), seed=0):
+    """Probability values spanning every class of every scheme, in blobs rather than single cells."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.random((shape[0] // 6 + 1, shape[1] // 6 + 1)) ** 4
+    values = np.kron(coarse, np.ones((6, 6)))[:shape[0], :shape[1]]
+    values = values * (1.0 + 0.3 * rng.random(shape))
+    return np.minimum(values, 1.0).astype(np.float32)
+
+
+@pytest.fixture
+def info():
+    return RasterInfo(230000.0, 900000.0, (10.0, 10.0), (90, 80), -9999.0, 'EPSG:26986')
+
+
+@pytest.fixture
+def probability(info):
+    values = probability_raster(info.shape)
+    values[:8, :12] = info.nodata
+    return values
+
+
+@pytest.fixture
+def envelope_source(probability, info, monkeypatch):
+    """An envelope of the probability raster, the cells it covers, and the envelopes opened.
+
+    Envelopes are only read from ArcGIS raster datasets; mcfrm_io.open_source stands in for one by
+    cutting the envelope's cells, snapped outward to the grid as ArcpySource does, out of the array.
+    """
+    opened = []
+
+    def open_source(path, envelope=None):
+        opened.append(envelope)
+        x_min, y_min, x_max, y_max = [float(v) for v in envelope.split()]
+        cw, ch = info.cell_size
+        row0, row1 = int(np.floor((info.y_max - y_max) / ch)), int(np.ceil((info.y_max - y_min) / ch))
+        col0, col1 = int(np.floor((x_min - info.x_min) / cw)), int(np.ceil((x_max - info.x_min) / cw))
+        cells = probability[row0:row1, col0:col1]
+        return mcfrm_io.ArraySource(cells, info.replace(x_min=info.x_min + col0 * cw, y_max=info.y_max - row0 * ch,
+                                                        shape=cells.shape))
+
+    monkeypatch.setattr(mcfrm_io, 'open_source', open_source)
+    return '230055 899205 230437 899843', (slice(15, 80), slice(5, 44)), opened
@@ -0,0 +1,27 @@
+import pytest
+
+import mcfrm_backends
+import mcfrm_io
+
+
+def test_open_backend_defaults_need_only_numpy():
+    backend = mcfrm_backends.OpenBackend()
+    assert (backend.raster_extension, backend.feature_extension) == ('.mcr', '.gpkg')
+
+
+def test_open_backend_refuses_non_file_rasters():
+    with pytest.raises(ValueError):
+        mcfrm_backends.OpenBackend().open_source('C:/data/probability.gdb/raster_ds')
+
+
+@pytest.mark.parametrize('block_shape', [None, (32, 32)])
+def test_backends_in_different_formats_agree(probability, info, tmp_path, block_shape):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    report = mcfrm_backends.compare(path, ['CTPS', 'MBTA'], mcfrm_backends.OpenBackend(),
+                                    mcfrm_backends.OpenBackend('.npy', '.geojson'), str(tmp_path / 'a'),
+                                    str(tmp_path / 'b'), block_shape=block_shape, log=lambda text: None)
+    assert sorted(report) == ['CTPS', 'MBTA']
+    for result in report.values():
+        assert result['differences'] == []
+        assert sum(result['counts'].values()) == probability.size
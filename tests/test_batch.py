@@ -0,0 +1,129 @@
+import concurrent.futures
+import json
+import threading
+
+import numpy as np
+import pytest
+
+import mcfrm_batch
+import mcfrm_io
+import mcfrm_vectorize
+from mcfrm_schemes import classify
+
+
+@pytest.fixture
+def inputs(probability, info, tmp_path):
+    paths = []
+    for n in range(3):
+        path = str(tmp_path / ('input%d.npy' % n))
+        mcfrm_io.write_raster(path, np.roll(probability, 7 * n, axis=1), info)
+        paths.append(path)
+    return paths
+
+
+def write_manifest(path, rows):
+    with open(path, 'w') as f:
+        f.write('input,scheme,output\n')
+        for row in rows:
+            f.write(','.join(row) + '\n')
+    return path
+
+
+def test_read_manifest(tmp_path):
+    manifest = write_manifest(str(tmp_path / 'jobs.csv'), [('in.npy', 'ctps', 'out/ctps.geojson'),
+                                                           ('//server/share/in.tif', 'MBTA', 'out/mbta.mcr')])
+    jobs = mcfrm_batch.read_manifest(manifest)
+    assert [(j.input, j.scheme, j.output) for j in jobs] == [
+        (str(tmp_path / 'in.npy'), 'CTPS', str(tmp_path / 'out' / 'ctps.geojson')),
+        ('//server/share/in.tif', 'MBTA', str(tmp_path / 'out' / 'mbta.mcr'))]
+    assert [j.kind() for j in jobs] == ['geojson', 'raster']
+    with open(str(tmp_path / 'jobs.json'), 'w') as f:
+        json.dump({'jobs': [{'input': 'in.npy', 'scheme': 'BOS', 'output': 'bos.gpkg/bos', 'envelope': '0 0 1 1'}]}, f)
+    job, = mcfrm_batch.read_manifest(str(tmp_path / 'jobs.json'))
+    assert (job.scheme, job.envelope, job.kind()) == ('BOS', '0 0 1 1', 'geopackage')
+
+
+def test_jobs_on_one_input_are_grouped(tmp_path):
+    jobs = [mcfrm_batch.Job('a.npy', 'CTPS', 'a1.npy'), mcfrm_batch.Job('b.npy', 'CTPS', 'b1.npy'),
+            mcfrm_batch.Job('a.npy', 'MBTA', 'a2.npy'), mcfrm_batch.Job('a.npy', 'MBTA', 'a3.npy', '0 0 1 1')]
+    groups = mcfrm_batch.group_jobs(jobs)
+    assert list(groups) == [('a.npy', None), ('b.npy', None), ('a.npy', '0 0 1 1')]
+    assert groups[('a.npy', None)] == [jobs[0], jobs[2]]
+
+
+@pytest.mark.parametrize('workers, block_shape', [(1, None), (1, (32, 32)), (2, None)])
+def test_batch_continues_past_failures(inputs, probability, info, tmp_path, workers, block_shape):
+    (tmp_path / 'taken.npy').mkdir()            # an output that cannot be written
+    jobs = [mcfrm_batch.Job(inputs[0], 'CTPS', str(tmp_path / 'a_ctps.npy')),
+            mcfrm_batch.Job(str(tmp_path / 'missing.npy'), 'CTPS', str(tmp_path / 'm_ctps.npy')),
+            mcfrm_batch.Job(inputs[0], 'MBTA', str(tmp_path / 'taken.npy')),
+            mcfrm_batch.Job(inputs[0], 'MBTA', str(tmp_path / 'a_mbta.geojson')),
+            mcfrm_batch.Job(inputs[1], 'BOS', str(tmp_path / 'b_bos.mcr'))]
+    log = []
+    results = mcfrm_batch.run_batch(jobs, workers, block_shape=block_shape, log=log.append)
+    assert [r['status'] for r in results] == ['ok', 'failed', 'failed', 'ok', 'ok']
+    assert [r['output'] for r in results] == [job.output for job in jobs]
+    assert 'missing.npy' in results[1]['error'] and results[2]['error']
+    assert len(log) == len(jobs)
+    # The jobs of a group share its classification time
+    assert results[0]['classify_seconds'] == results[3]['classify_seconds']
+
+    whole = classify(probability, ['CTPS', 'MBTA'], nodata=info.nodata)
+    assert np.array_equal(mcfrm_io.read_raster(jobs[0].output)[0], whole['CTPS'])
+    with open(jobs[3].output) as f:
+        codes = [feature['properties']['gridcode'] for feature in json.load(f)['features']]
+    assert codes == [f.gridcode for f in mcfrm_vectorize.vectorize(whole['MBTA'], info)]
+    bos = classify(np.roll(probability, 7, axis=1), 'BOS', nodata=info.nodata)['BOS']
+    assert np.array_equal(mcfrm_io.read_raster(jobs[4].output)[0], bos)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_unknown_scheme_fails_only_its_job(inputs, probability, info, tmp_path, workers):
+    manifest = write_manifest(str(tmp_path / 'jobs.csv'), [(inputs[0], 'CTPS', 'ctps.npy'),
+                                                           (inputs[0], 'NOPE', 'nope.npy'),
+                                                           (inputs[1], 'MBTA', 'mbta.npy')])
+    jobs = mcfrm_batch.read_manifest(manifest)
+    assert [j.scheme for j in jobs] == ['CTPS', 'NOPE', 'MBTA'] and jobs[1].error
+    log = []
+    results = mcfrm_batch.run_batch(jobs, workers, log=log.append)
+    assert [r['status'] for r in results] == ['ok', 'failed', 'ok']
+    assert 'NOPE' in results[1]['error'] and len(log) == 3
+    assert not (tmp_path / 'nope.npy').exists()
+    assert np.array_equal(mcfrm_io.read_raster(jobs[0].output)[0],
+                          classify(probability, 'CTPS', nodata=info.nodata)['CTPS'])
+    assert mcfrm_batch.main([manifest]) == 1
+
+
+def test_estimate_memory():
+    whole = mcfrm_batch.estimate_memory((1000, 1000), 2)
+    assert whole == 10 ** 6 * (8 + 2 * 2 + 16)
+    assert mcfrm_batch.estimate_memory((1000, 1000), 2, (100, 100)) == whole - (10 ** 6 - 10 ** 4) * 8
+
+
+def test_groups_run_concurrently_only_within_the_memory_budget(inputs, tmp_path, monkeypatch):
+    # Run the groups in threads, so that their concurrency can be observed
+    monkeypatch.setattr(concurrent.futures, 'ProcessPoolExecutor', concurrent.futures.ThreadPoolExecutor)
+    memory = {inputs[0]: 40, inputs[1]: 50, inputs[2]: 120}
+    monkeypatch.setattr(mcfrm_batch, '_group_memory', lambda jobs, block_shape: memory[jobs[0].input])
+    lock = threading.Lock()
+    running, overlaps = set(), []
+    run_group = mcfrm_batch.run_group
+
+    def observed(jobs, *args):
+        with lock:
+            running.add(jobs[0].input)
+            overlaps.append(set(running))
+        try:
+            return run_group(jobs, *args)
+        finally:
+            with lock:
+                running.discard(jobs[0].input)
+
+    monkeypatch.setattr(mcfrm_batch, 'run_group', observed)
+    jobs = [mcfrm_batch.Job(path, 'CTPS', str(tmp_path / ('out%d.npy' % n))) for n, path in enumerate(inputs)]
+    results = mcfrm_batch.run_batch(jobs, workers=3, memory_budget=100, log=lambda text: None)
+    assert [r['status'] for r in results] == ['ok', 'ok', 'ok']
+    for together in overlaps:
+        # The budget holds whenever several groups run; a group over budget runs on its own
+        assert len(together) == 1 or sum(memory[path] for path in together) <= 100
+    assert len(overlaps) == 3
@@ -0,0 +1,116 @@
+import os
+
+import numpy as np
+import pytest
+
+import mcfrm_cache
+import mcfrm_io
+import mcfrm_schemes
+import mcfrm_vectorize
+from mcfrm_schemes import ClassDef, Scheme, classify
+
+
+@pytest.fixture
+def path(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    return path
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return mcfrm_cache.Cache(str(tmp_path / 'cache'))
+
+
+def test_key_is_stable(path, cache, tmp_path):
+    key = cache.key(path, 'CTPS')
+    assert mcfrm_cache.Cache(str(tmp_path / 'other')).key(path, 'ctps') == key
+    assert cache.key(path, 'MBTA') != key
+    assert cache.key(path, 'CTPS', envelope='0 0 10 10') != key
+    assert cache.variant(key) == key and cache.variant(key, tolerance=0, max_vertices=None) == key
+    assert cache.variant(key, tolerance=5.0) != key
+
+
+def test_key_follows_the_input(path, probability, info, tmp_path):
+    key = mcfrm_cache.Cache(str(tmp_path / 'cache')).key(path, 'CTPS')
+    by_metadata = mcfrm_cache.input_key(path, by='metadata')
+    os.utime(path, (1000.0, 1000.0))
+    assert mcfrm_cache.input_key(path, by='metadata') != by_metadata
+    assert mcfrm_cache.Cache(str(tmp_path / 'cache')).key(path, 'CTPS') == key
+    revised = probability.copy()
+    revised[50, 50] = 0.5
+    mcfrm_io.write_raster(path, revised, info)
+    assert mcfrm_cache.Cache(str(tmp_path / 'cache')).key(path, 'CTPS') != key
+
+
+def test_changed_scheme_invalidates(path, cache, monkeypatch):
+    key = cache.key(path, 'CTPS')
+    classes = [ClassDef(c.code, c.name, c.bounds) for c in mcfrm_schemes.get_scheme('CTPS').classes]
+    classes[0] = ClassDef(7, 'p_gt_10_pct', '>= 0.10')
+    monkeypatch.setitem(mcfrm_schemes.SCHEMES, 'CTPS', Scheme('CTPS', classes, score_field='score'))
+    assert cache.key(path, 'CTPS') != key
+
+
+def test_changed_tool_invalidates(path, tmp_path, monkeypatch):
+    # Reading and writing rasters (.mcr included) changes the cached class rasters too
+    assert {'mcfrm_io.py', 'mcfrm_compact.py'} <= set(mcfrm_cache._TOOL_MODULES)
+    here = os.path.dirname(os.path.abspath(mcfrm_cache.__file__))
+    tool = tmp_path / 'tool'
+    tool.mkdir()
+    for name in mcfrm_cache._TOOL_MODULES:
+        with open(os.path.join(here, name), 'rb') as f:
+            (tool / name).write_bytes(f.read())
+    monkeypatch.setattr(mcfrm_cache, '__file__', str(tool / 'mcfrm_cache.py'))
+    version = mcfrm_cache.tool_version()
+    for name in mcfrm_cache._TOOL_MODULES:
+        original = (tool / name).read_bytes()
+        (tool / name).write_bytes(original + b'\n# edited\n')
+        assert mcfrm_cache.tool_version() != version, name
+        (tool / name).write_bytes(original)
+    assert mcfrm_cache.tool_version() == version
+
+
+def test_classes_and_features_round_trip(path, cache, probability, info):
+    key = cache.key(path, 'CTPS')
+    assert cache.get_classes(key) is None and not cache.has(key, mcfrm_cache.CLASSES)
+    classes = classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+    class_info = info.replace(nodata=-9999)
+    cache.put_classes(key, classes, class_info, 'CTPS')
+    array, read_info = cache.get_classes(key)
+    assert np.array_equal(array, classes)
+    assert read_info.to_dict() == class_info.to_dict()
+
+    features = mcfrm_vectorize.vectorize(classes, class_info)
+    cache.put_features(key, features, class_info, 'CTPS')
+    loaded, read_info = cache.get_features(key)
+    assert [f.gridcode for f in loaded] == [f.gridcode for f in features]
+    assert all(np.array_equal(a, b) for f, g in zip(features, loaded)
+               for p, q in zip(f.parts, g.parts) for a, b in zip(p, q))
+    assert sorted(e['stage'] for e in cache.entries()) == [mcfrm_cache.CLASSES, mcfrm_cache.FEATURES]
+
+
+def test_least_recently_used_entries_are_evicted_beyond_the_size_limit(cache, probability, info):
+    classes = classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+    keys = ['%032d' % n for n in range(4)]
+    for n, key in enumerate(keys):
+        cache.put_classes(key, classes + n, info, str(n))
+        os.utime(os.path.join(cache.directory, key + '-classes', 'entry.json'), (1000.0 + n, 1000.0 + n))
+    sizes = dict((e['key'], e['size']) for e in cache.entries())
+    assert [e['key'] for e in cache.entries()] == keys[::-1]
+
+    # A hit makes an entry the most recently used
+    assert cache.get_classes(keys[0]) is not None
+    assert [e['key'] for e in cache.entries()][0] == keys[0]
+
+    limit = sizes[keys[0]] + sizes[keys[3]]
+    assert cache.evict(limit) == 2
+    assert sorted(e['key'] for e in cache.entries()) == [keys[0], keys[3]]
+    assert cache.size() <= limit
+    assert not os.path.exists(os.path.join(cache.directory, keys[1] + '-classes'))
+
+    # Storing past max_bytes evicts by itself
+    small = mcfrm_cache.Cache(cache.directory, max_bytes=limit)
+    small.put_classes(keys[1], classes, info)
+    assert keys[1] in [e['key'] for e in small.entries()]
+    assert small.size() <= limit
+    assert small.clear() > 0 and small.entries() == []
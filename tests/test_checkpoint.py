@@ -0,0 +1,148 @@
+import json
+import os
+
+import pytest
+
+import mcfrm_backends
+import mcfrm_checkpoint
+import mcfrm_io
+import mcfrm_pipeline
+from mcfrm_schemes import get_scheme
+
+
+class Failure(Exception):
+    pass
+
+
+def fail_after(monkeypatch, module, name, calls):
+    # Make module.name raise on its calls-th call
+    original = getattr(module, name)
+    count = [0]
+
+    def failing(*args, **kwargs):
+        count[0] += 1
+        if count[0] == calls:
+            raise Failure('simulated failure')
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, failing)
+
+
+@pytest.fixture
+def job(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    outputs = {'CTPS': str(tmp_path / 'out' / 'classes.gpkg') + '/ctps', 'MBTA': str(tmp_path / 'out' / 'mbta.geojson')}
+    return path, outputs, str(tmp_path / 'checkpoint')
+
+
+def run(job, log, **options):
+    path, outputs, checkpoint_dir = job
+    mcfrm_pipeline.run(path, outputs, mcfrm_backends.OpenBackend(), block_shape=(32, 32),
+                       checkpoint_dir=checkpoint_dir, log=log.append, **options)
+
+
+def features(outputs, backend=mcfrm_backends.OpenBackend()):
+    return dict((name, mcfrm_checkpoint.checksum_features(
+        backend.read_features(output, get_scheme(name).score_field or 'gridcode'))) for name, output in outputs.items())
+
+
+def test_resume_after_a_failure_in_classification(job, tmp_path, monkeypatch):
+    path, outputs, checkpoint_dir = job
+    reference = dict((name, str(tmp_path / 'ref' / (name.lower() + '.geojson'))) for name in outputs)
+    mcfrm_pipeline.run(path, reference, mcfrm_backends.OpenBackend(), log=lambda text: None)
+
+    monkeypatch.setattr(mcfrm_checkpoint, 'SAVE_INTERVAL', 0)
+    fail_after(monkeypatch, mcfrm_pipeline, 'classify', 5)
+    log = []
+    with pytest.raises(Failure):
+        run(job, log)
+    assert sum('Classified block' in line for line in log) == 4
+    monkeypatch.undo()
+
+    log = []
+    run(job, log)
+    assert '4 of 9 block(s) were already classified.' in log
+    assert sum('Classified block' in line for line in log) == 5
+    assert features(outputs) == features(reference)
+
+
+def test_resume_after_a_failure_in_writing(job, monkeypatch):
+    path, outputs, checkpoint_dir = job
+    fail_after(monkeypatch, mcfrm_backends.OpenBackend, 'write_features', 2)
+    log = []
+    with pytest.raises(Failure):
+        run(job, log)
+    monkeypatch.undo()
+    log = []
+    run(job, log)
+    assert not any('Classified block' in line for line in log)
+    assert 'Loaded MBTA polygons from the checkpoint.' in log
+    assert log.count('Generated final output feature class ' + outputs['MBTA'] + '.') == 1
+    assert not any(outputs['CTPS'] in line for line in log)
+
+    log = []
+    run(job, log)
+    assert log[0].startswith('All outputs are complete and valid')
+
+
+def test_invalid_artifacts_are_redone(job, monkeypatch):
+    path, outputs, checkpoint_dir = job
+    monkeypatch.setattr(mcfrm_checkpoint, 'SAVE_INTERVAL', 0)
+    fail_after(monkeypatch, mcfrm_pipeline, 'classify', 6)
+    with pytest.raises(Failure):
+        run(job, [])
+    monkeypatch.undo()
+    classes = mcfrm_checkpoint.open_array(os.path.join(checkpoint_dir, 'artifacts', 'ctps_classes.npy'), (90, 80),
+                                          'int16')
+    classes[40, 5] = 99               # in the first block of the second row of blocks
+    classes.flush()
+    del classes
+    log = []
+    run(job, log)
+    assert 'Classified block 4 of 9.' in log
+    assert '4 of 9 block(s) were already classified.' in log
+
+
+def test_changed_output_is_rewritten_and_force_rebuilds(job):
+    path, outputs, checkpoint_dir = job
+    run(job, [])
+    os.remove(outputs['MBTA'])
+    log = []
+    run(job, log)
+    assert 'Vectorized 5 class(es) for MBTA.' in log
+    assert not any('for CTPS' in line for line in log)
+    log = []
+    run(job, log, force=True)
+    assert log[0].startswith('Forced full rebuild')
+    assert sum('Classified block' in line for line in log) == 9
+
+
+def test_clearing_never_touches_other_files(job, tmp_path):
+    path, outputs, checkpoint_dir = job
+    os.makedirs(checkpoint_dir)
+    notes = os.path.join(checkpoint_dir, 'notes.txt')
+    with open(notes, 'w') as f:
+        f.write('keep me')
+    run(job, [])
+    run(job, [], force=True)
+    assert sorted(os.listdir(checkpoint_dir)) == ['checkpoint.json', 'notes.txt']
+    with open(os.path.join(checkpoint_dir, 'checkpoint.json')) as f:
+        assert json.load(f)['complete']
+
+    journal = mcfrm_checkpoint.Journal(checkpoint_dir, {'other': 'header'}, log=lambda text: None)
+    with open(journal.artifact('classes.npy'), 'w') as f:
+        f.write('artifact')
+    journal.clear_artifacts()
+    assert sorted(os.listdir(checkpoint_dir)) == ['checkpoint.json', 'notes.txt']
+
+
+def test_outputs_and_workspace_may_not_be_in_the_checkpoint_directory(job, tmp_path):
+    path, outputs, checkpoint_dir = job
+    with pytest.raises(ValueError):
+        mcfrm_pipeline.run(path, {'CTPS': os.path.join(checkpoint_dir, 'ctps.geojson')}, mcfrm_backends.OpenBackend(),
+                           checkpoint_dir=checkpoint_dir, log=lambda text: None)
+    with pytest.raises(ValueError):
+        mcfrm_pipeline.run(path, outputs, mcfrm_backends.OpenBackend(), checkpoint_dir, keep_intermediates=True,
+                           checkpoint_dir=checkpoint_dir, log=lambda text: None)
+    assert not os.path.exists(checkpoint_dir)
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+import mcfrm_compact
+import mcfrm_io
+import mcfrm_tiles
+from mcfrm_io import Window
+from mcfrm_reclassify import CLASS_DTYPE, NODATA
+from mcfrm_schemes import classify
+
+
+@pytest.fixture
+def classes(probability, info):
+    codes = classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+    codes[-20:, -30:] = 1               # a constant tile or two
+    return codes
+
+
+def test_smallest_dtype_and_narrowing():
+    assert mcfrm_compact.smallest_dtype(-1, 7) == (np.dtype(np.int8), -128)
+    assert mcfrm_compact.smallest_dtype(-1, 300) == (np.dtype(np.int16), -32768)
+    codes = np.array([NODATA, -1, 7], dtype=CLASS_DTYPE)
+    small, compact_nodata = mcfrm_compact.narrow(codes, NODATA)
+    assert small.dtype == np.int8 and small.tolist() == [-128, -1, 7]
+    assert mcfrm_compact.widen(small, compact_nodata, NODATA).tolist() == codes.tolist()
+
+
+def test_round_trip(classes, info, tmp_path):
+    path = str(tmp_path / 'classes.mcr')
+    mcfrm_compact.write_class_raster(path, classes, info.replace(nodata=NODATA), tile_shape=(16, 16))
+    array, read_info = mcfrm_io.read_raster(path)
+    assert array.dtype == CLASS_DTYPE
+    assert np.array_equal(array, classes)
+    assert read_info.nodata == NODATA and read_info.shape == classes.shape
+    assert (read_info.x_min, read_info.y_max, read_info.crs) == (info.x_min, info.y_max, info.crs)
+    with mcfrm_compact.ClassRasterSource(path) as source:
+        encodings = set(t[2] for t in source.tiles)
+        assert mcfrm_compact.CONSTANT in encodings and len(encodings) > 1
+        window = Window(10, 7, 35, 50)
+        assert np.array_equal(source.read(window), classes[window.slices()])
+
+
+def test_windowed_writes_in_any_order(classes, info, tmp_path):
+    path = str(tmp_path / 'classes.mcr')
+    windows = list(mcfrm_tiles.iter_windows(classes.shape, (13, 21)))
+    with mcfrm_compact.ClassRasterSink(path, info.replace(nodata=NODATA), tile_shape=(16, 16)) as sink:
+        for window in reversed(windows):
+            sink.write(window, classes[window.slices()])
+    assert np.array_equal(mcfrm_io.read_raster(path)[0], classes)
+
+
+def test_unwritten_tiles_are_nodata(info, tmp_path):
+    path = str(tmp_path / 'classes.mcr')
+    with mcfrm_compact.ClassRasterSink(path, info.replace(nodata=NODATA), tile_shape=(16, 16)) as sink:
+        sink.write(Window(0, 0, 16, 16), np.full((16, 16), 3, dtype=CLASS_DTYPE))
+    array = mcfrm_io.read_raster(path)[0]
+    assert (array[:16, :16] == 3).all()
+    assert (array[16:] == NODATA).all()
+
+
+@pytest.mark.parametrize('values', [np.full((4, 4), 2.7), np.full((4, 4), 70000, dtype=np.int32)])
+def test_values_that_are_not_class_codes_are_refused(values, info, tmp_path):
+    with pytest.raises(ValueError):
+        mcfrm_io.write_raster(str(tmp_path / 'bad.mcr'), values, info)
+
+
+def test_not_an_mcr_file(tmp_path):
+    path = tmp_path / 'other.mcr'
+    path.write_bytes(b'x' * 64)
+    with pytest.raises(ValueError):
+        mcfrm_compact.ClassRasterSource(str(path))
@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+import pytest
+
+import mcfrm_exposure
+import mcfrm_io
+import mcfrm_vectorize
+from mcfrm_reclassify import BACKGROUND, NODATA
+from mcfrm_schemes import classify
+
+
+@pytest.fixture
+def classes(probability, info):
+    return classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+
+
+@pytest.fixture(params=['array', 'mcr'])
+def index(request, classes, info, tmp_path):
+    # An in-memory class raster, and a .mcr file read block by block
+    class_info = info.replace(nodata=NODATA)
+    if request.param == 'array':
+        return mcfrm_exposure.ExposureIndex(mcfrm_io.ArraySource(classes, class_info))
+    path = str(tmp_path / 'classes.mcr')
+    mcfrm_io.write_raster(path, classes, class_info)
+    return mcfrm_exposure.ExposureIndex.open(path)
+
+
+def sampled(index, classes, line, step=0.001):
+    # Brute force: the codes of points spaced step map units along a line, weighted by step
+    lengths = {}
+    for (x0, y0), (x1, y1) in zip(line[:-1], line[1:]):
+        length = np.hypot(x1 - x0, y1 - y0)
+        n = int(round(length / step))
+        if n == 0:
+            continue
+        t = (np.arange(n) + 0.5) / n
+        codes = index.codes_at(x0 + t * (x1 - x0), y0 + t * (y1 - y0))
+        for code, count in zip(*np.unique(codes, return_counts=True)):
+            lengths[int(code)] = lengths.get(int(code), 0.0) + count * length / n
+    return lengths
+
+
+def test_points(index, classes, info):
+    rng = np.random.default_rng(3)
+    x = rng.uniform(info.x_min, info.x_max, 2000)
+    y = rng.uniform(info.y_min, info.y_max, 2000)
+    rows = ((info.y_max - y) // 10).astype(int)
+    cols = ((x - info.x_min) // 10).astype(int)
+    assert np.array_equal(index.codes_at(x, y), classes[rows, cols])
+
+
+def test_points_on_the_edges_of_the_raster(index, classes, info):
+    # Cells include their top and left edges: the raster covers [x_min, x_max) x (y_min, y_max]
+    x = [info.x_min, info.x_max - 1e-6, info.x_max, info.x_min, info.x_min, info.x_min - 1e-6, 230015.0]
+    y = [info.y_max, info.y_min + 1e-6, info.y_max, info.y_min, info.y_max + 1e-6, info.y_max, 899990.0]
+    codes = index.codes_at(x, y).tolist()
+    assert codes == [classes[0, 0], classes[-1, -1], NODATA, NODATA, NODATA, NODATA, classes[1, 1]]
+
+
+def test_lines_against_brute_force_sampling(index, classes, info):
+    lines = [np.array([[230003.0, 899997.0], [230791.0, 899113.0]]),                 # corner to corner
+             np.array([[230100.0, 899500.0], [230100.0, 899200.0], [230450.5, 899200.0]]),  # along cell edges
+             np.array([[230005.0, 899300.0], [230300.0, 899640.0], [230155.0, 899950.0], [230720.0, 899880.0]])]
+    exposure = index.along(lines)
+    for n, line in enumerate(lines):
+        expected = sampled(index, classes, line)
+        lengths = dict((code, values[n]) for code, values in exposure.lengths.items() if values[n])
+        assert sorted(lengths) == sorted(expected)
+        for code in expected:
+            assert lengths[code] == pytest.approx(expected[code], abs=0.01)
+        exposed = [code for code in expected if code not in (BACKGROUND, NODATA)]
+        assert exposure.max_code[n] == max(exposed)
+
+
+def test_zero_length_segments_add_nothing(index, info):
+    line = np.array([[230105.0, 899505.0], [230305.0, 899505.0]])
+    doubled = np.array([[230105.0, 899505.0], [230105.0, 899505.0], [230305.0, 899505.0], [230305.0, 899505.0]])
+    point = np.array([[230105.0, 899505.0], [230105.0, 899505.0]])
+    exposure = index.along([line, doubled, point])
+    for code, lengths in exposure.lengths.items():
+        assert lengths[0] == pytest.approx(lengths[1])
+        assert lengths[2] == 0.0
+    assert exposure.max_code[0] == exposure.max_code[1]
+    assert exposure.max_code[2] == NODATA          # no length in any class
+
+
+def test_lines_outside_the_raster(index, info):
+    outside = np.array([[229000.0, 899500.0], [229500.0, 899000.0]])
+    partly = np.array([[229900.0, 899905.0], [230050.0, 899905.0]])
+    exposure = index.along([outside, partly, np.zeros((1, 2))])
+    assert exposure.max_code[0] == NODATA and exposure.max_code[2] == NODATA
+    assert exposure.lengths[NODATA][0] == pytest.approx(np.hypot(500.0, 500.0))
+    assert exposure.lengths[NODATA][1] == pytest.approx(100.0)
+    assert sum(values[1] for values in exposure.lengths.values()) == pytest.approx(150.0)
+
+
+def test_from_polygons_matches_the_class_raster(classes, info, tmp_path):
+    features = mcfrm_vectorize.vectorize(classes, info)
+    path = str(tmp_path / 'ctps.geojson')
+    mcfrm_vectorize.write_geojson(path, features, 'score')
+    with mcfrm_exposure.ExposureIndex.from_polygons(path, 'score', 10.0) as index:
+        # The polygons' extent is that of the classified cells; compare at every cell center
+        x0, y1 = index.info.x_min, index.info.y_max
+        rows = np.arange(int(round((info.y_max - y1) / 10.0)), info.shape[0])
+        cols = np.arange(int(round((x0 - info.x_min) / 10.0)), info.shape[1])
+        r, c = np.meshgrid(rows, cols, indexing='ij')
+        codes = index.codes_at(info.x_min + (c + 0.5) * 10.0, info.y_max - (r + 0.5) * 10.0)
+    expected = classes[r, c]
+    expected[np.isin(expected, (BACKGROUND, NODATA))] = NODATA
+    assert np.array_equal(codes, expected)
+
+
+def test_read_points_and_lines(tmp_path):
+    (tmp_path / 'points.csv').write_text('name,x,y\nA,1.5,2.5\nB,3,4\n')
+    records, x, y = mcfrm_exposure.read_points(str(tmp_path / 'points.csv'))
+    assert [r['name'] for r in records] == ['A', 'B'] and x.tolist() == [1.5, 3.0] and y.tolist() == [2.5, 4.0]
+    lines = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': 7, 'properties': {'route': 'Red'},
+         'geometry': {'type': 'MultiLineString', 'coordinates': [[[0, 0], [1, 1]], [[2, 2], [3, 3], [4, 4]]]}},
+        {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'Point', 'coordinates': [0, 0]}}]}
+    (tmp_path / 'lines.geojson').write_text(json.dumps(lines))
+    records, lines = mcfrm_exposure.read_lines(str(tmp_path / 'lines.geojson'))
+    assert [r['id'] for r in records] == [7, 7] and [len(line) for line in lines] == [2, 3]
@@ -0,0 +1,83 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import mcfrm_geopackage
+import mcfrm_vectorize
+from mcfrm_schemes import classify
+
+
+@pytest.fixture
+def features(probability, info):
+    return mcfrm_vectorize.vectorize(classify(probability, 'CTPS', nodata=info.nodata)['CTPS'], info)
+
+
+def assert_same(a, b):
+    assert [f.gridcode for f in a] == [f.gridcode for f in b]
+    for f, g in zip(a, b):
+        assert len(f.parts) == len(g.parts)
+        for p, q in zip(f.parts, g.parts):
+            assert len(p) == len(q)
+            assert all(np.array_equal(r, s) for r, s in zip(p, q))
+
+
+def test_split_path():
+    assert mcfrm_geopackage.split_path('out/north.gpkg/ctps') == ('out/north.gpkg', 'ctps')
+    assert mcfrm_geopackage.split_path('out/north.gpkg') == ('out/north.gpkg', 'north')
+    assert not mcfrm_geopackage.is_geopackage('out/north.geojson')
+
+
+def test_geometry_round_trip(features):
+    for f in features:
+        assert_same([mcfrm_vectorize.Feature(f.gridcode, mcfrm_geopackage.decode_geometry(
+            mcfrm_geopackage.encode_geometry(f, 26986)))], [f])
+
+
+def test_write_and_read(features, info, tmp_path):
+    path = str(tmp_path / 'out.gpkg') + '/ctps'
+    mcfrm_geopackage.write_features(path, features, 'score', info.crs)
+    assert mcfrm_geopackage.exists(path)
+    read, crs = mcfrm_geopackage.read_features(path, 'score')
+    assert_same(read, features)
+    assert crs == 'EPSG:26986'
+    db = sqlite3.connect(str(tmp_path / 'out.gpkg'))
+    try:
+        assert db.execute('PRAGMA application_id').fetchone()[0] == mcfrm_geopackage.APPLICATION_ID
+        min_x, max_y = db.execute("SELECT min_x, max_y FROM gpkg_contents WHERE table_name = 'ctps'").fetchone()
+    finally:
+        db.close()
+    assert (min_x, max_y) == (info.x_min, info.y_max)
+
+
+def test_layers_are_independent(features, tmp_path):
+    filename = str(tmp_path / 'out.gpkg')
+    mcfrm_geopackage.write_features(filename + '/a', features)
+    mcfrm_geopackage.write_features(filename + '/b', features[:2])
+    mcfrm_geopackage.write_features(filename + '/a', features[3:])      # replaces layer a only
+    assert_same(mcfrm_geopackage.read_features(filename + '/a')[0], features[3:])
+    assert_same(mcfrm_geopackage.read_features(filename + '/b')[0], features[:2])
+    mcfrm_geopackage.delete_layer(filename + '/a')
+    assert not mcfrm_geopackage.exists(filename + '/a')
+    assert mcfrm_geopackage.exists(filename + '/b')
+
+
+def test_update_replaces_only_the_given_codes(features, tmp_path):
+    path = str(tmp_path / 'out.gpkg') + '/ctps'
+    mcfrm_geopackage.write_features(path, features)
+    moved = [mcfrm_vectorize.Feature(f.gridcode, [[ring + 5.0 for ring in part] for part in f.parts])
+             for f in features]
+    dropped = features[0].gridcode
+    changed = [dropped, features[1].gridcode]
+    mcfrm_geopackage.update_features(path, moved[1:], changed)
+    read = dict((f.gridcode, f) for f in mcfrm_geopackage.read_features(path)[0])
+    assert dropped not in read
+    assert_same([read[features[1].gridcode]], [moved[1]])
+    assert_same([read[f.gridcode] for f in features[2:]], features[2:])
+
+
+def test_custom_crs(features, tmp_path):
+    wkt = 'LOCAL_CS["site grid",UNIT["metre",1]]'
+    path = str(tmp_path / 'out.gpkg') + '/ctps'
+    mcfrm_geopackage.write_features(path, features[:1], crs=wkt)
+    assert mcfrm_geopackage.read_features(path)[1] == wkt
@@ -0,0 +1,117 @@
+import numpy as np
+import pytest
+
+import mcfrm_horizons
+import mcfrm_io
+from mcfrm_reclassify import BACKGROUND, NODATA
+from mcfrm_schemes import classify
+
+LABELS = ['Present', '2030', '2050', '2070']
+
+
+@pytest.fixture
+def horizons(probability, info, tmp_path):
+    # Probabilities rising with each horizon, each horizon with NoData of its own
+    paths = []
+    for k, label in enumerate(LABELS):
+        nodata = -1.0 if k % 2 else info.nodata
+        values = np.minimum(probability * (1.0 + k), 1.0).astype(np.float32)
+        values[probability == info.nodata] = nodata
+        values[60 + 5 * k:65 + 5 * k, 40:50] = nodata
+        path = str(tmp_path / (label + '.npy'))
+        mcfrm_io.write_raster(path, values, info.replace(nodata=nodata))
+        paths.append((label, path))
+    return paths
+
+
+def reference_scores(horizons, scheme):
+    # Each horizon classified on its own
+    scores = []
+    for label, path in horizons:
+        values, info = mcfrm_io.read_raster(path)
+        scores.append(classify(values, scheme, nodata=info.nodata)[scheme])
+    return np.stack(scores)
+
+
+def reference_first_reaching(scores, threshold):
+    # The first horizon whose score reaches the threshold, cell by cell
+    codes = np.full(scores.shape[1:], BACKGROUND)
+    for index in np.ndindex(*scores.shape[1:]):
+        column = scores[(slice(None),) + index]
+        if (column == NODATA).all():
+            codes[index] = NODATA
+            continue
+        for k, score in enumerate(column):
+            if score != NODATA and score >= threshold:
+                codes[index] = k
+                break
+    return codes
+
+
+def test_first_reaching_matches_a_horizon_by_horizon_search():
+    rng = np.random.default_rng(5)
+    scores = rng.choice([NODATA, BACKGROUND, 1, 2, 3, 4, 5, 6, 7], size=(5, 40, 30)).astype(np.int16)
+    scores[:, 0, :5] = NODATA
+    for threshold in (1, 4, 7):
+        assert np.array_equal(mcfrm_horizons.first_reaching(scores, threshold),
+                              reference_first_reaching(scores, threshold))
+
+
+def test_first_reaching_with_one_horizon_and_too_many():
+    scores = np.array([[[NODATA, BACKGROUND, 3, 5]]], dtype=np.int16)
+    assert mcfrm_horizons.first_reaching(scores, 4).tolist() == [[NODATA, BACKGROUND, BACKGROUND, 0]]
+    with pytest.raises(ValueError):
+        mcfrm_horizons.first_reaching(np.zeros((mcfrm_horizons.MAX_HORIZONS + 1, 2, 2), dtype=np.int16), 1)
+
+
+@pytest.mark.parametrize('block_shape', [None, (32, 32), (13, 80)])
+def test_classify_horizons_matches_separate_runs(horizons, info, tmp_path, block_shape):
+    scores = {'CTPS': str(tmp_path / 'ctps_scores.npy'), 'MBTA': str(tmp_path / 'mbta_scores.npy')}
+    changes = {'CTPS': str(tmp_path / 'ctps_first.mcr'), 'MBTA': str(tmp_path / 'mbta_first.npy')}
+    read_info, counts = mcfrm_horizons.classify_horizons(horizons, ['CTPS', 'MBTA'], 3, scores, changes,
+                                                         block_shape=block_shape)
+    assert read_info.shape == info.shape
+    for name in ('CTPS', 'MBTA'):
+        expected = reference_scores(horizons, name)
+        array, score_info, labels = mcfrm_horizons.read_scores(scores[name])
+        assert labels == LABELS
+        assert np.array_equal(array, expected)
+        assert score_info.shape == info.shape
+        first = reference_first_reaching(expected, 3)
+        assert np.array_equal(mcfrm_io.read_raster(changes[name])[0], first)
+        codes, n = np.unique(first, return_counts=True)
+        assert dict(counts[name]) == dict(zip(codes.tolist(), n.tolist()))
+    # NoData at every horizon only where every horizon is NoData
+    assert counts['CTPS'][NODATA] == 8 * 12
+
+
+def test_horizons_must_share_a_grid(horizons, probability, info, tmp_path):
+    path = str(tmp_path / 'shifted.npy')
+    mcfrm_io.write_raster(path, probability, info.replace(y_max=info.y_max + 10.0))
+    with pytest.raises(ValueError):
+        mcfrm_horizons.classify_horizons(horizons[:1] + [('shifted', path)], 'CTPS', 3)
+
+
+def test_threshold_must_be_a_class_code(horizons):
+    with pytest.raises(ValueError):
+        mcfrm_horizons.classify_horizons(horizons, 'MBTA', 5)
+
+
+def test_describe_changes():
+    counts = {'CTPS': {NODATA: 2, BACKGROUND: 3, 0: 4, 2: 1}}
+    lines = mcfrm_horizons.describe_changes(counts, LABELS, 5, cell_area=100.0)
+    assert lines[0] == 'CTPS: score >= 5'
+    assert [line.split('  ')[1].strip() for line in lines[1:]] == [
+        'NoData at every horizon', 'never reached', 'first reached at Present', 'first reached at 2050']
+
+
+def test_command_line_skips_schemes_without_the_threshold(horizons, tmp_path, capsys):
+    argv = ['--horizon=%s=%s' % pair for pair in horizons] + ['--output-dir', str(tmp_path / 'out'), '--no-scores']
+    assert mcfrm_horizons.main(argv + ['--threshold', '5']) == 0
+    out = capsys.readouterr().out
+    assert 'Skipping BOS' in out and 'Skipping MBTA' in out
+    assert sorted(p.name for p in (tmp_path / 'out').iterdir()) == ['ctps_first_ge5.mcr']
+    with pytest.raises(SystemExit):
+        mcfrm_horizons.main(argv + ['--threshold', '5', '--scheme', 'MBTA'])
+    with pytest.raises(SystemExit):
+        mcfrm_horizons.main(argv + ['--threshold', '9'])
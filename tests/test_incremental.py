@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+import mcfrm_backends
+import mcfrm_incremental
+import mcfrm_io
+import mcfrm_pipeline
+import mcfrm_vectorize
+from mcfrm_schemes import classify, get_scheme
+
+
+def same_features(a, b):
+    return [f.gridcode for f in a] == [f.gridcode for f in b] and \
+        all(mcfrm_incremental._same_feature(f, g) for f, g in zip(a, b))
+
+
+def full_rebuild(path, scheme):
+    values, info = mcfrm_io.read_raster(path)
+    classes = classify(values, scheme, nodata=info.nodata)[scheme]
+    s = get_scheme(scheme)
+    return mcfrm_vectorize.vectorize(classes, info.replace(nodata=s.nodata), (s.background, s.nodata))
+
+
+def test_update_after_a_patch_equals_a_full_rebuild(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    state_dir = str(tmp_path / 'state')
+    mcfrm_io.write_raster(path, probability, info)
+    features, changed, _ = mcfrm_incremental.update(path, 'CTPS', state_dir, (32, 32), log=lambda text: None)
+    assert changed == sorted(f.gridcode for f in features)
+    assert same_features(features, full_rebuild(path, 'CTPS'))
+
+    # Revise a patch straddling tile boundaries: a class appears and another shrinks
+    revised = probability.copy()
+    revised[28:40, 25:70] = 0.2
+    revised[60:64, 5:9] = 0.0
+    mcfrm_io.write_raster(path, revised, info)
+    features, changed, _ = mcfrm_incremental.update(path, 'CTPS', state_dir, (32, 32), log=lambda text: None)
+    assert same_features(features, full_rebuild(path, 'CTPS'))
+    assert 7 in changed
+    assert mcfrm_incremental.verify(state_dir) == []
+
+
+def test_unchanged_input_changes_nothing(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    state_dir = str(tmp_path / 'state')
+    mcfrm_io.write_raster(path, probability, info)
+    first = mcfrm_incremental.update(path, 'MBTA', state_dir, (32, 32), log=lambda text: None)[0]
+    features, changed, _ = mcfrm_incremental.update(path, 'MBTA', state_dir, (32, 32), log=lambda text: None)
+    assert changed == []
+    assert same_features(features, first)
+
+
+def test_changed_block_shape_rebuilds(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    state_dir = str(tmp_path / 'state')
+    mcfrm_io.write_raster(path, probability, info)
+    mcfrm_incremental.update(path, 'BOS', state_dir, (32, 32), log=lambda text: None)
+    features, changed, _ = mcfrm_incremental.update(path, 'BOS', state_dir, (16, 48), log=lambda text: None)
+    assert changed == sorted(f.gridcode for f in features)
+    assert same_features(features, full_rebuild(path, 'BOS'))
+    assert np.array_equal(mcfrm_io.read_raster(str(tmp_path / 'state' / 'classes.npy'))[0],
+                          classify(probability, 'BOS', nodata=info.nodata)['BOS'])
+
+
+@pytest.mark.parametrize('option', [{'tolerance': 5.0}, {'max_vertices': 100}, {'workers': 2},
+                                    {'keep_intermediates': True}, {'cache': 'cache'}])
+def test_pipeline_refuses_options_an_update_would_ignore(probability, info, tmp_path, option):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    with pytest.raises(ValueError):
+        mcfrm_pipeline.run(path, {'CTPS': str(tmp_path / 'ctps.geojson')}, mcfrm_backends.OpenBackend('.npy'),
+                           state_dir=str(tmp_path / 'state'), log=lambda text: None, **option)
+    assert not (tmp_path / 'ctps.geojson').exists()
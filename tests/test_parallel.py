@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import mcfrm_io
+import mcfrm_parallel
+from mcfrm_schemes import classify, scheme_names
+
+
+@pytest.fixture
+def path(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    return path
+
+
+@pytest.mark.parametrize('workers, block_shape', [(2, (32, 32)), (3, (13, 21)), (4, (90, 7))])
+def test_parallel_equals_whole(path, probability, info, tmp_path, workers, block_shape):
+    outputs = dict((name, str(tmp_path / (name + '.npy'))) for name in scheme_names())
+    done = []
+    read_info = mcfrm_parallel.classify_parallel(path, scheme_names(), outputs, block_shape, workers,
+                                                 progress=lambda window, n, total: done.append(window.key()))
+    assert read_info.shape == info.shape
+    # Blocks are written in row-major order, as on the serial path
+    assert done == sorted(done)
+    whole = classify(probability, scheme_names(), nodata=info.nodata)
+    for name in scheme_names():
+        assert np.array_equal(mcfrm_io.read_raster(outputs[name])[0], whole[name])
+
+
+def test_parallel_output_is_byte_identical_to_serial(path, tmp_path):
+    serial, parallel = str(tmp_path / 'serial.npy'), str(tmp_path / 'parallel.npy')
+    mcfrm_parallel.classify_parallel(path, 'MBTA', {'MBTA': serial}, (25, 30), workers=1)
+    mcfrm_parallel.classify_parallel(path, 'MBTA', {'MBTA': parallel}, (25, 30), workers=3)
+    with open(serial, 'rb') as a, open(parallel, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_parallel_envelope(envelope_source, probability, info, tmp_path):
+    envelope, cells, opened = envelope_source
+    outputs = {'BOS': str(tmp_path / 'bos.npy')}
+    mcfrm_parallel.classify_parallel('raster_ds', 'BOS', outputs, (16, 16), workers=2, envelope=envelope)
+    assert opened == [envelope]       # in this process; each worker opens its own
+    assert np.array_equal(mcfrm_io.read_raster(outputs['BOS'])[0],
+                          classify(probability[cells], 'BOS', nodata=info.nodata)['BOS'])
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import mcfrm_io
+from mcfrm_reclassify import BACKGROUND, CLASS_DTYPE, NODATA, BreakpointTable, reclassify
+
+# The CTPS table, as in the original Con() expressions: 0.10 falls in no level
+CTPS_TABLE = BreakpointTable(breaks=[0.001, 0.002, 0.01, 0.02, 0.05, 0.10],
+                             codes=[1, 2, 3, 4, 5, 6, 7],
+                             at_codes=[2, 3, 4, 5, 6, BACKGROUND])
+
+
+def test_default_bounds_are_lower_inclusive():
+    table = BreakpointTable([0.1, 0.5], [1, 2, 3])
+    values = np.array([0.0, 0.1, 0.3, 0.5, 0.7])
+    assert reclassify(values, table).tolist() == [1, 2, 2, 3, 3]
+
+
+def test_breakpoint_codes_override_the_default():
+    table = BreakpointTable([0.1], [1, 2], at_codes=[BACKGROUND])
+    assert reclassify(np.array([0.05, 0.1, 0.2]), table).tolist() == [1, BACKGROUND, 2]
+
+
+@pytest.mark.parametrize('breaks, codes, at_codes', [
+    ([0.5, 0.1], [1, 2, 3], None),
+    ([0.1, 0.1], [1, 2, 3], None),
+    ([0.1], [1, 2, 3], None),
+    ([0.1], [1, 2], [1, 2]),
+])
+def test_invalid_tables(breaks, codes, at_codes):
+    with pytest.raises(ValueError):
+        BreakpointTable(breaks, codes, at_codes)
+
+
+def test_class_codes():
+    assert CTPS_TABLE.class_codes() == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_ctps_boundaries():
+    values = np.array([0.0009, 0.001, 0.0019, 0.002, 0.01, 0.02, 0.05, 0.0999, 0.1, 0.1001])
+    assert reclassify(values, CTPS_TABLE).tolist() == [1, 2, 2, 3, 4, 5, 6, 6, BACKGROUND, 7]
+
+
+def test_every_boundary_matches_the_per_level_conditions():
+    # Each level of the original scripts was a separate Con(); a value is in at most one of them
+    breaks = CTPS_TABLE.breaks
+    values = np.concatenate([breaks, np.nextafter(breaks, -np.inf), np.nextafter(breaks, np.inf), [0.0, 1.0]])
+    levels = [(7, values > 0.10), (6, (values >= 0.05) & (values < 0.10)), (5, (values >= 0.02) & (values < 0.05)),
+              (4, (values >= 0.01) & (values < 0.02)), (3, (values >= 0.002) & (values < 0.01)),
+              (2, (values >= 0.001) & (values < 0.002)), (1, values < 0.001)]
+    expected = np.full(values.shape, BACKGROUND)
+    for code, mask in levels:
+        expected[mask] = code
+    assert reclassify(values, CTPS_TABLE).tolist() == expected.tolist()
+
+
+def test_nodata_and_nan():
+    values = np.array([[np.nan, -9999.0], [0.5, 0.0]])
+    codes = reclassify(values, CTPS_TABLE, nodata=-9999.0)
+    assert codes.dtype == CLASS_DTYPE
+    assert codes.tolist() == [[NODATA, NODATA], [7, 1]]
+
+
+def test_output_array_is_filled(probability, info):
+    out = np.zeros(probability.shape, dtype=CLASS_DTYPE)
+    result = reclassify(probability, CTPS_TABLE, nodata=info.nodata, out=out)
+    assert result is out
+    assert (out[:8, :12] == NODATA).all()
+    assert set(np.unique(out).tolist()) <= {NODATA, BACKGROUND, 1, 2, 3, 4, 5, 6, 7}
+
+
+def test_npy_round_trip(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    array, read_info = mcfrm_io.read_raster(path)
+    assert np.array_equal(array, probability)
+    assert read_info.to_dict() == info.to_dict()
@@ -0,0 +1,145 @@
+import numpy as np
+import pytest
+
+import mcfrm_schemes
+from mcfrm_reclassify import BACKGROUND, NODATA
+from mcfrm_schemes import (BoundaryIssue, Bounds, ClassDef, Scheme, boundary_issues, classify, get_scheme,
+                           register_scheme, scheme_names)
+
+# Codes of the exact breakpoints under the bounds documented in README.md
+README_CODES = {
+    'CTPS': {0.001: 2, 0.002: 3, 0.01: 4, 0.02: 5, 0.05: 6, 0.1: BACKGROUND},
+    'MBTA': {0.002: 2, 0.01: 3, 0.02: 3, 0.05: 3, 0.1: 4},
+    'BOS': {0.002: 1, 0.01: 2, 0.02: 3, 0.05: 4, 0.1: 4},
+}
+
+# Where the implemented bounds give another code, as listed under Known Boundary Inconsistencies
+KNOWN_INCONSISTENCIES = {
+    ('MBTA', 0.001): 1,             # documented as both level 1 and level 0
+    ('MBTA', 0.1): BACKGROUND,      # level 4 is implemented as > 0.10
+    ('BOS', 0.001): 0,              # level 0 is documented as >= 0.001 and < 0.001
+    ('BOS', 0.05): BACKGROUND,      # level 4 is implemented as > 0.05
+}
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(mcfrm_schemes, 'SCHEMES', dict(mcfrm_schemes.SCHEMES))
+    return mcfrm_schemes.SCHEMES
+
+
+def test_registry_lookup():
+    assert scheme_names() == ['BOS', 'CTPS', 'MBTA']
+    assert get_scheme('ctps') is get_scheme('CTPS')
+    assert get_scheme(get_scheme('MBTA')) is get_scheme('MBTA')
+    with pytest.raises(KeyError):
+        get_scheme('NYC')
+
+
+def test_register_scheme(registry):
+    scheme = Scheme('TEST', [ClassDef(2, 'high', '>= 0.5'), ClassDef(1, 'low', '< 0.5')])
+    register_scheme(scheme)
+    assert get_scheme('test') is scheme
+    with pytest.raises(ValueError):
+        register_scheme(Scheme('TEST', []))
+    register_scheme(Scheme('TEST', []), replace=True)
+    assert get_scheme('TEST').classes == []
+
+
+def test_invalid_schemes_are_refused():
+    with pytest.raises(ValueError):
+        Scheme('DUP', [ClassDef(1, 'a', '< 0.5'), ClassDef(1, 'b', '>= 0.5')])
+    with pytest.raises(ValueError):
+        Scheme('BG', [ClassDef(BACKGROUND, 'a', '< 0.5')])
+
+
+@pytest.mark.parametrize('text, lower, lower_inclusive, upper, upper_inclusive', [
+    ('> 0.10', 0.1, False, None, False),
+    ('>= 0.05 and < 0.10', 0.05, True, 0.1, False),
+    ('<= 0.001', None, True, 0.001, True),
+    ('>=0.002 & <0.01', 0.002, True, 0.01, False),
+    ('< 1e-3', None, True, 0.001, False),
+])
+def test_bounds_parse(text, lower, lower_inclusive, upper, upper_inclusive):
+    bounds = Bounds.parse(text)
+    assert (bounds.lower, bounds.upper) == (lower, upper)
+    if lower is not None:
+        assert bounds.lower_inclusive == lower_inclusive
+    if upper is not None:
+        assert bounds.upper_inclusive == upper_inclusive
+    assert Bounds.parse(str(bounds)) == bounds
+
+
+def test_bounds_contains_its_endpoints_as_written():
+    bounds = Bounds.parse('>= 0.05 and < 0.10')
+    assert [bounds.contains(v) for v in (0.0499, 0.05, 0.07, 0.1)] == [False, True, True, False]
+    assert str(Bounds()) == 'any' and Bounds().contains(-5.0)
+
+
+@pytest.mark.parametrize('text', ['= 0.1', '> 0.1 or < 0.5', '>= x', ''])
+def test_bounds_parse_errors(text):
+    with pytest.raises(ValueError):
+        Bounds.parse(text)
+
+
+def test_boundary_issues_of_the_registered_schemes():
+    assert boundary_issues(get_scheme('CTPS')) == [BoundaryIssue('gap', 0.1, 0.1, [])]
+    assert boundary_issues(get_scheme('MBTA')) == [
+        BoundaryIssue('overlap', 0.001, 0.001, [1, 0]),
+        BoundaryIssue('gap', 0.1, 0.1, []),
+        BoundaryIssue('documentation', 0.1, None, [4])]
+    assert boundary_issues(get_scheme('BOS')) == [
+        BoundaryIssue('gap', None, 0.001, []),
+        BoundaryIssue('gap', 0.05, 0.05, []),
+        BoundaryIssue('documentation', 0.05, None, [4]),
+        BoundaryIssue('documentation', 0.001, 0.002, [0])]
+    assert [str(i) for i in boundary_issues(get_scheme('MBTA'))][:2] == ['overlap at 0.001 (classes 1, 0)', 'gap at 0.1']
+
+
+def test_a_tiling_scheme_has_no_issues():
+    scheme = Scheme('TILED', [ClassDef(3, 'high', '>= 0.5'), ClassDef(2, 'mid', '>= 0.1 and < 0.5'),
+                              ClassDef(1, 'low', '< 0.1')])
+    assert boundary_issues(scheme) == []
+
+
+@pytest.mark.parametrize('name', sorted(README_CODES))
+def test_readme_breakpoints(name):
+    values = [0.001, 0.002, 0.01, 0.02, 0.05, 0.1]
+    codes = classify(np.array(values), name)[name].tolist()
+    for value, code in zip(values, codes):
+        expected = KNOWN_INCONSISTENCIES.get((name, value), README_CODES[name].get(value))
+        assert code == expected, 'probability %g' % value
+
+
+def test_known_inconsistencies_are_reported():
+    for (name, value), code in KNOWN_INCONSISTENCIES.items():
+        issues = boundary_issues(get_scheme(name))
+        assert any(i.lower == value or i.upper == value for i in issues), (name, value)
+
+
+@pytest.mark.parametrize('name', scheme_names())
+def test_every_boundary_matches_the_scalar_reference(name):
+    scheme = get_scheme(name)
+    breaks = scheme.compile().breaks
+    values = np.concatenate([breaks, np.nextafter(breaks, -np.inf), np.nextafter(breaks, np.inf),
+                             [0.0, 1.0, 1e-9, 0.5]])
+    expected = [scheme.classify_value(v) for v in values]
+    assert classify(values, name)[scheme.name].tolist() == expected
+
+
+def test_several_schemes_in_one_pass_equal_each_scheme_alone(probability, info):
+    together = classify(probability, scheme_names(), nodata=info.nodata)
+    assert sorted(together) == scheme_names()
+    for name in scheme_names():
+        reference = np.vectorize(get_scheme(name).classify_value)(probability)
+        reference[probability == info.nodata] = NODATA
+        alone = classify(probability, name, nodata=info.nodata)[name]
+        assert np.array_equal(alone, reference)
+        assert together[name].dtype == alone.dtype and np.array_equal(together[name], alone)
+
+
+def test_nodata_and_nan():
+    values = np.array([[np.nan, -9999.0], [0.5, 0.0]])
+    codes = classify(values, ['CTPS', 'MBTA'], nodata=-9999.0)
+    assert codes['CTPS'].tolist() == [[NODATA, NODATA], [7, 1]]
+    assert codes['MBTA'].tolist() == [[NODATA, NODATA], [4, 0]]
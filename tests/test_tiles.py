@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import mcfrm_io
+import mcfrm_tiles
+from mcfrm_io import Window
+from mcfrm_reclassify import CLASS_DTYPE
+from mcfrm_schemes import classify, scheme_names
+
+
+def test_windows_tile_the_raster_with_ragged_edges():
+    windows = list(mcfrm_tiles.iter_windows((90, 80), (32, 25)))
+    assert len(windows) == 3 * 4
+    assert windows[0] == Window(0, 0, 32, 25)
+    assert windows[3] == Window(0, 75, 32, 5)
+    assert windows[-1] == Window(64, 75, 26, 5)
+    covered = np.zeros((90, 80), dtype=int)
+    for window in windows:
+        covered[window.slices()] += 1
+    assert (covered == 1).all()
+    with pytest.raises(ValueError):
+        list(mcfrm_tiles.iter_windows((90, 80), (0, 25)))
+
+
+@pytest.mark.parametrize('block_shape', [(32, 32), (7, 13), (90, 80), (200, 200)])
+def test_tiled_equals_whole(probability, info, tmp_path, block_shape):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    outputs = dict((name, str(tmp_path / (name + '.npy'))) for name in scheme_names())
+    read_info = mcfrm_tiles.classify_file_tiled(path, scheme_names(), outputs, block_shape)
+    assert read_info.shape == info.shape
+    whole = classify(probability, scheme_names(), nodata=info.nodata)
+    for name in scheme_names():
+        array, out_info = mcfrm_io.read_raster(outputs[name])
+        assert array.dtype == CLASS_DTYPE
+        assert np.array_equal(array, whole[name])
+        assert (out_info.x_min, out_info.y_max, out_info.shape) == (info.x_min, info.y_max, info.shape)
+
+
+def test_verify_tiled(probability, info):
+    source = mcfrm_io.ArraySource(probability, info)
+    assert mcfrm_tiles.verify_tiled(source, scheme_names(), (17, 23)) == {'BOS': 0, 'CTPS': 0, 'MBTA': 0}
+
+
+def test_progress_is_reported_for_every_block(probability, info):
+    seen = []
+    sinks = {'CTPS': mcfrm_io.ArraySink(info.shape, CLASS_DTYPE)}
+    n = mcfrm_tiles.classify_tiled(mcfrm_io.ArraySource(probability, info), sinks, (40, 40),
+                                   progress=lambda window, done, total: seen.append((done, total)))
+    assert n == 6
+    assert seen == [(k, 6) for k in range(1, 7)]
+
+
+def test_envelope_is_classified_like_the_same_cells_of_the_whole(envelope_source, probability, info, tmp_path):
+    envelope, cells, opened = envelope_source
+    outputs = {'CTPS': str(tmp_path / 'ctps.npy')}
+    read_info = mcfrm_tiles.classify_file_tiled('raster_ds', 'CTPS', outputs, (16, 16), envelope=envelope)
+    assert opened == [envelope]
+    assert read_info.shape == (65, 39)
+    array, out_info = mcfrm_io.read_raster(outputs['CTPS'])
+    assert (out_info.x_min, out_info.y_max) == (230050.0, 899850.0)
+    assert np.array_equal(array, classify(probability[cells], 'CTPS', nodata=info.nodata)['CTPS'])
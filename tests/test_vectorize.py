@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+
+import mcfrm_vectorize
+from mcfrm_reclassify import BACKGROUND, NODATA
+from mcfrm_schemes import classify
+
+
+def cell_areas(classes, info):
+    cell = info.cell_size[0] * info.cell_size[1]
+    codes, counts = np.unique(classes, return_counts=True)
+    return dict((int(c), n * cell) for c, n in zip(codes, counts) if c not in (BACKGROUND, NODATA))
+
+
+@pytest.fixture
+def classes(probability, info):
+    return classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+
+
+def feature_areas(features):
+    areas = {}
+    for f in features:
+        areas[f.gridcode] = areas.get(f.gridcode, 0.0) + f.area()
+    return areas
+
+
+def test_one_feature_per_class_with_the_area_of_its_cells(classes, info):
+    features = mcfrm_vectorize.vectorize(classes, info)
+    assert [f.gridcode for f in features] == sorted(cell_areas(classes, info))
+    areas = feature_areas(features)
+    for code, area in cell_areas(classes, info).items():
+        assert areas[code] == pytest.approx(area, rel=1e-12)
+
+
+def test_rings_are_closed_and_within_the_raster(classes, info):
+    x_max = info.x_min + info.shape[1] * info.cell_size[0]
+    y_min = info.y_max - info.shape[0] * info.cell_size[1]
+    for f in mcfrm_vectorize.vectorize(classes, info):
+        for part in f.parts:
+            for ring in part:
+                assert (ring[0] == ring[-1]).all()
+                assert ring[:, 0].min() >= info.x_min and ring[:, 0].max() <= x_max
+                assert ring[:, 1].min() >= y_min and ring[:, 1].max() <= info.y_max
+
+
+def test_hole_is_subtracted(info):
+    classes = np.full((5, 5), 1, dtype=np.int16)
+    classes[2, 2] = 2
+    features = mcfrm_vectorize.vectorize(classes, info)
+    assert feature_areas(features) == {1: 24 * 100.0, 2: 100.0}
+    outer = features[0]
+    assert outer.ring_count() == 2
+
+
+def test_save_and_load_features_round_trip(classes, info, tmp_path):
+    features = mcfrm_vectorize.vectorize(classes, info)
+    path = str(tmp_path / 'features.npz')
+    mcfrm_vectorize.save_features(path, features)
+    loaded = mcfrm_vectorize.load_features(path)
+    assert [f.gridcode for f in loaded] == [f.gridcode for f in features]
+    for a, b in zip(features, loaded):
+        assert len(a.parts) == len(b.parts)
+        for pa, pb in zip(a.parts, b.parts):
+            assert all(np.array_equal(ra, rb) for ra, rb in zip(pa, pb))
+
+
+#####################
+# Simplification and the vertex cap
+
+@pytest.fixture
+def full_classes(probability, info):
+    # Every cell in a class, so that the features tile the raster
+    values = np.where(probability == info.nodata, 0.5, probability)
+    return classify(values, 'CTPS')['CTPS']
+
+
+def cover_counts(features, x, y):
+    # Number of features containing each point (even-odd rule over all the rings of a feature)
+    counts = np.zeros(len(x), dtype=int)
+    for f in features:
+        edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for part in f.parts for ring in part])
+        x0, y0, x1, y1 = [edges[:, k][None, :] for k in range(4)]
+        px, py = x[:, None], y[:, None]
+        spans = (y0 > py) != (y1 > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cross = spans & (px < x0 + (py - y0) * (x1 - x0) / (y1 - y0))
+        counts += cross.sum(axis=1) % 2
+    return counts
+
+
+def assert_tiles_the_raster(features, info):
+    # Every point of the raster lies in exactly one feature, and the areas add up to that of the
+    # raster: no gaps, no slivers, no overlaps
+    rng = np.random.default_rng(1)
+    x = rng.uniform(info.x_min, info.x_max, 5000)
+    y = rng.uniform(info.y_min, info.y_max, 5000)
+    assert (cover_counts(features, x, y) == 1).all()
+    area = info.shape[0] * info.shape[1] * info.cell_size[0] * info.cell_size[1]
+    assert sum(f.area() for f in features) == pytest.approx(area, rel=1e-12)
+
+
+@pytest.mark.parametrize('tolerance, max_vertices', [(15.0, None), (40.0, None), (0.0, 60), (25.0, 60)])
+def test_neighbouring_classes_share_their_simplified_boundaries(full_classes, info, tolerance, max_vertices):
+    raw = mcfrm_vectorize.vectorize(full_classes, info)
+    assert_tiles_the_raster(raw, info)
+    simplified = mcfrm_vectorize.vectorize(full_classes, info, tolerance=tolerance, max_vertices=max_vertices)
+    assert_tiles_the_raster(simplified, info)
+    if tolerance and not max_vertices:
+        assert sum(f.vertex_count() for f in simplified) < sum(f.vertex_count() for f in raw)
+
+
+def distances_to_boundary(points, feature):
+    # Distance from each point to the nearest segment of the rings of a feature
+    edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for part in feature.parts for ring in part])
+    a, b = edges[None, :, :2], edges[None, :, 2:]
+    p = points[:, None, :]
+    ab = b - a
+    t = np.clip(((p - a) * ab).sum(axis=2) / (ab * ab).sum(axis=2), 0.0, 1.0)
+    nearest = a + t[:, :, None] * ab
+    return np.hypot(*(p - nearest).transpose(2, 0, 1)).min(axis=1)
+
+
+def test_simplified_boundaries_stay_within_the_tolerance(classes, info):
+    raw = mcfrm_vectorize.vectorize(classes, info)
+    simplified = mcfrm_vectorize.vectorize(classes, info, tolerance=15.0)
+    assert [f.gridcode for f in simplified] == [f.gridcode for f in raw]
+    for f, g in zip(raw, simplified):
+        assert f.ring_count() == g.ring_count()
+        vertices = np.vstack([ring for part in f.parts for ring in part])
+        assert distances_to_boundary(vertices, g).max() <= 15.0 + 1e-6
+    # Shared boundaries move together, so what one class gains another loses
+    total = sum(feature_areas(raw).values())
+    assert sum(feature_areas(simplified).values()) == pytest.approx(total, rel=0.02)
+
+
+def test_vertex_cap_keeps_the_area_of_every_class(classes, info):
+    features = mcfrm_vectorize.vectorize(classes, info, max_vertices=40)
+    assert max(f.vertex_count() for f in features) <= 40
+    areas = feature_areas(features)
+    for code, area in cell_areas(classes, info).items():
+        assert areas[code] == pytest.approx(area, rel=1e-9)
+
+
+def test_vertex_cap_split_is_deterministic(classes, info):
+    first = mcfrm_vectorize.vectorize(classes, info, tolerance=10.0, max_vertices=40)
+    second = mcfrm_vectorize.vectorize(classes.copy(), info, tolerance=10.0, max_vertices=40)
+    assert [f.gridcode for f in first] == [f.gridcode for f in second]
+    for f, g in zip(first, second):
+        assert len(f.parts) == len(g.parts)
+        for p, q in zip(f.parts, g.parts):
+            assert all(np.array_equal(r, s) for r, s in zip(p, q))
+    # Pieces of a class follow one another, from the top left
+    codes = [f.gridcode for f in first]
+    assert codes == sorted(codes)
+    assert len(codes) > len(set(codes))
+
+
+def test_vertex_cap_must_leave_room_for_a_ring(classes, info):
+    with pytest.raises(ValueError):
+        mcfrm_vectorize.vectorize(classes, info, max_vertices=4)
+
+
+def test_generalize_stats(classes, info):
+    raw = mcfrm_vectorize.vectorize(classes, info)
+    stats = {}
+    features = mcfrm_vectorize.generalize(raw, classes, info, tolerance=15.0, stats=stats)
+    assert sorted(stats) == ['arcs', 'refined_arcs', 'splits', 'vertices', 'vertices_in']
+    assert stats['vertices_in'] == sum(f.vertex_count() for f in raw)
+    assert stats['vertices'] == sum(f.vertex_count() for f in features) < stats['vertices_in']
+    assert stats['arcs'] > 0 and 0 <= stats['refined_arcs'] <= stats['arcs']
+    assert stats['splits'] == 0
+
+    stats = {}
+    features = mcfrm_vectorize.generalize(raw, classes, info, max_vertices=40, stats=stats)
+    assert stats['splits'] > 0
+    assert len(features) - len(raw) <= stats['splits']
+    assert stats['vertices'] == sum(f.vertex_count() for f in features)
+
+
+@pytest.mark.parametrize('fill', [BACKGROUND, NODATA])
+@pytest.mark.parametrize('tolerance, max_vertices', [(1.0, None), (0.0, 40), (5.0, 40)])
+def test_nothing_to_simplify(info, fill, tolerance, max_vertices):
+    classes = np.full((5, 5), fill, dtype=np.int16)
+    assert mcfrm_vectorize.vectorize(classes, info, tolerance=tolerance, max_vertices=max_vertices) == []
+    stats = {}
+    assert mcfrm_vectorize.generalize([], classes, info, tolerance, max_vertices, stats) == []
+    assert stats == {'vertices_in': 0, 'vertices': 0, 'arcs': 0, 'refined_arcs': 0, 'splits': 0}
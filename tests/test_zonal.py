@@ -0,0 +1,125 @@
+import json
+
+import numpy as np
+import pytest
+
+import mcfrm_io
+import mcfrm_zonal
+from mcfrm_io import Window
+from mcfrm_reclassify import BACKGROUND, NODATA
+from mcfrm_schemes import classify, get_scheme
+
+
+@pytest.fixture
+def path(probability, info, tmp_path):
+    path = str(tmp_path / 'input.npy')
+    mcfrm_io.write_raster(path, probability, info)
+    return path
+
+
+def brute_force(classes, zones, cell_area):
+    # {(zone, code): (cells, area)} by np.unique over the (zone, code) pairs
+    pairs, counts = np.unique(np.column_stack([zones.ravel(), classes.ravel()]), axis=0, return_counts=True)
+    return dict(((int(z), int(c)), (int(n), n * cell_area)) for (z, c), n in zip(pairs.tolist(), counts.tolist()))
+
+
+def table(rows, scheme):
+    return dict(((row['zone'], row['code']), (row['cells'], row['area'])) for row in rows if row['scheme'] == scheme)
+
+
+@pytest.mark.parametrize('block_shape', [(32, 32), (90, 80), (7, 50)])
+def test_class_counts_and_areas(path, probability, info, block_shape):
+    rows = mcfrm_zonal.zonal_summary(path, ['CTPS', 'MBTA'], block_shape=block_shape)
+    classes = classify(probability, ['CTPS', 'MBTA'], nodata=info.nodata)
+    for name in ('CTPS', 'MBTA'):
+        expected = brute_force(classes[name], np.zeros(info.shape, dtype=int), 100.0)
+        assert table(rows, name) == dict(((None, c), v) for (z, c), v in expected.items())
+    assert sum(row['cells'] for row in rows if row['scheme'] == 'CTPS') == probability.size
+    labels = dict((row['code'], row['class']) for row in rows if row['scheme'] == 'CTPS')
+    assert labels[NODATA] == 'NoData' and labels[7] == get_scheme('CTPS').class_by_code(7).name
+
+
+def test_zone_raster(path, probability, info, tmp_path):
+    zones = (np.arange(info.shape[0])[:, None] // 20 * 10 + np.arange(info.shape[1])[None, :] // 30).astype(np.int32)
+    zones[40:45, :] = -1                      # NoData of the zone raster: counted in no zone
+    zone_path = str(tmp_path / 'zones.npy')
+    mcfrm_io.write_raster(zone_path, zones, info.replace(nodata=-1))
+    rows = mcfrm_zonal.zonal_summary(path, 'BOS', zone_raster=zone_path, block_shape=(32, 32))
+    classes = classify(probability, 'BOS', nodata=info.nodata)['BOS']
+    valid = zones != -1
+    assert table(rows, 'BOS') == brute_force(classes[valid], zones[valid], 100.0)
+    assert [row['zone'] for row in rows] == sorted(row['zone'] for row in rows)
+
+
+def test_zone_raster_must_share_the_grid(path, info, tmp_path):
+    zone_path = str(tmp_path / 'zones.npy')
+    mcfrm_io.write_raster(zone_path, np.zeros(info.shape, dtype=np.int32), info.replace(x_min=info.x_min + 5.0))
+    with pytest.raises(ValueError):
+        mcfrm_zonal.zonal_summary(path, 'BOS', zone_raster=zone_path)
+
+
+def square(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+def test_rasterize_takes_the_cells_whose_centers_are_inside(info):
+    # A triangle and a square hole; compare with testing every cell center
+    outer = np.array([[230013.0, 899991.0], [230555.0, 899402.0], [230041.0, 899150.0], [230013.0, 899991.0]])
+    hole = np.array(square(230100.0, 899500.0, 230200.0, 899700.0), dtype=float)
+    polygon = mcfrm_zonal.ZonePolygon('z', [outer, hole], info)
+    window = Window(0, 0, *info.shape)
+    inside = mcfrm_zonal.rasterize(polygon.edges, info, window)
+    xc = info.x_min + (np.arange(info.shape[1]) + 0.5) * 10.0
+    yc = info.y_max - (np.arange(info.shape[0]) + 0.5) * 10.0
+    x, y = np.meshgrid(xc, yc)
+    expected = np.zeros(info.shape, dtype=int)
+    for ring in (outer, hole):
+        x0, y0, x1, y1 = ring[:-1, 0], ring[:-1, 1], ring[1:, 0], ring[1:, 1]
+        for k in range(len(x0)):
+            spans = (y0[k] > y) != (y1[k] > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                expected += spans & (x < x0[k] + (y - y0[k]) * (x1[k] - x0[k]) / (y1[k] - y0[k]))
+    assert np.array_equal(inside, expected % 2 == 1)
+    # Any window of the polygon's cells gives the same cells
+    part = Window(polygon.window.row + 5, polygon.window.col + 3, 30, 17)
+    assert np.array_equal(mcfrm_zonal.rasterize(polygon.edges, info, part), inside[part.slices()])
+
+
+def test_zone_polygons(path, probability, info, tmp_path):
+    # Overlapping polygons each get their full counts; polygons sharing a zone are summed; a polygon
+    # off the raster counts nothing
+    features = [
+        {'type': 'Feature', 'properties': {'TOWN': 'A'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(230000.0, 899600.0, 230400.0, 900000.0)]}},
+        {'type': 'Feature', 'properties': {'TOWN': 'B'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(230200.0, 899400.0, 230800.0, 899800.0)]}},
+        {'type': 'Feature', 'properties': {'TOWN': 'A'},
+         'geometry': {'type': 'MultiPolygon', 'coordinates': [[square(230600.0, 899100.0, 230800.0, 899300.0)]]}},
+        {'type': 'Feature', 'properties': {'TOWN': 'C'},
+         'geometry': {'type': 'Polygon', 'coordinates': [square(240000.0, 899100.0, 240800.0, 899300.0)]}},
+    ]
+    zone_path = str(tmp_path / 'towns.geojson')
+    with open(zone_path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    rows = mcfrm_zonal.zonal_summary(path, 'CTPS', zone_polygons=zone_path, zone_field='TOWN', block_shape=(32, 32))
+    classes = classify(probability, 'CTPS', nodata=info.nodata)['CTPS']
+    # Rows and columns of the cells of each square (their edges are on cell edges)
+    cells = {'A': [classes[0:40, 0:40], classes[70:90, 60:80]], 'B': [classes[20:60, 20:80]]}
+    expected = {}
+    for zone, blocks in cells.items():
+        codes, counts = np.unique(np.concatenate([b.ravel() for b in blocks]), return_counts=True)
+        for code, n in zip(codes.tolist(), counts.tolist()):
+            expected[(zone, code)] = (n, n * 100.0)
+    assert table(rows, 'CTPS') == expected
+
+
+def test_write_table(tmp_path):
+    rows = [{'scheme': 'CTPS', 'zone': None, 'code': 7, 'class': 'p_gt_10_pct', 'cells': 3, 'area': 300.0},
+            {'scheme': 'CTPS', 'zone': None, 'code': BACKGROUND, 'class': 'background', 'cells': 1, 'area': 100.0}]
+    mcfrm_zonal.write_table(str(tmp_path / 'areas.csv'), rows)
+    with open(str(tmp_path / 'areas.csv')) as f:
+        assert f.read().splitlines() == ['scheme,zone,code,class,cells,area', 'CTPS,,7,p_gt_10_pct,3,300.0',
+                                         'CTPS,,-1,background,1,100.0']
+    mcfrm_zonal.write_table(str(tmp_path / 'areas.json'), rows)
+    with open(str(tmp_path / 'areas.json')) as f:
+        assert json.load(f) == rows